@@ -142,6 +142,48 @@ class Person(odm.StdModel):
     name = odm.SymbolField()
     group = odm.ForeignKey(Group)
 
+
+class SortedDateModel(odm.StdModel):
+    person = odm.SymbolField()
+    name = odm.SymbolField(sort_index=True)
+    dt = odm.DateField(sort_index=True)
+    
+    
+class SortedGroup(odm.StdModel):
+    name = odm.SymbolField(sort_index=True)
+    
+    
+class SortedPerson(odm.StdModel):
+    name = odm.SymbolField(sort_index=True)
+    group = odm.ForeignKey(SortedGroup)
+    
+    
+class CachedCurrency(odm.StdModel):
+    code = odm.SymbolField(unique=True)
+    name = odm.CharField()
+    rounding = odm.IntegerField(default=2)
+    
+    class Meta:
+        cache_size = 3
+        
+        
+class LoggedItem(odm.StdModel):
+    name = odm.SymbolField()
+    value = odm.IntegerField(default=0)
+    
+    class Meta:
+        changelog = 5
+        
+        
+class Trade(odm.StdModel):
+    account = odm.SymbolField()
+    symbol = odm.SymbolField()
+    dt = odm.DateField()
+    size = odm.FloatField(default=1)
+    
+    class Meta:
+        indexes = [('account', 'symbol', 'dt')]
+
     
 # A model for testing a recursive foreign key
 class Node(odm.StdModel):
@@ -156,6 +198,23 @@ class Page(odm.StdModel):
     in_navigation = odm.IntegerField(default = 1)
     
 
+# A model for testing bitmap indices
+class Subscriber(odm.StdModel):
+    name = odm.SymbolField()
+    active = odm.BooleanField(index = 'bitmap')
+    plan = odm.SymbolField(index = 'bitmap')
+    
+    def __unicode__(self):
+        return self.name
+    
+
+# A model for testing counted indices
+class Ticket(odm.StdModel):
+    status = odm.SymbolField(counts = True)
+    priority = odm.IntegerField(index = 'bitmap', counts = True)
+    assignee = odm.SymbolField(required = False, counts = True)
+    
+
 class Collection(odm.StdModel):
     numbers = odm.SetField()
     groups = odm.SetField(model = Group)
@@ -3,7 +3,8 @@ from collections import namedtuple
 
 from stdnet.conf import settings
 from stdnet.exceptions import *
-from stdnet.utils import zip, iteritems, itervalues, encoders, UnicodeMixin
+from stdnet.utils import zip, iteritems, itervalues, encoders, UnicodeMixin,\
+                         JSPLITTER
 
 
 __all__ = ['BackendRequest',
@@ -156,8 +157,17 @@ queries specified by :class:`stdnet.odm.Query`.
         self.execute_query()
         return self._has(val)
         
-    def items(self, slic):
+    def sample(self, n):
         if self.execute_query():
+            return self._sample(n)
+        else:
+            return ()
+        
+    def items(self, slic):
+        if self.__count is None:
+            self.__count, items = self._execute_load(slic)
+            return items
+        elif self.__count:
             return self._items(slic)
         else:
             return ()
@@ -175,6 +185,9 @@ queries specified by :class:`stdnet.odm.Query`.
     def _items(self, slic):     # pragma: no cover
         raise NotImplementedError()
     
+    def _sample(self, n):     # pragma: no cover
+        raise NotImplementedError()
+    
     def _build(self, **kwargs):     # pragma: no cover
         raise NotImplementedError()
     
@@ -183,6 +196,13 @@ queries specified by :class:`stdnet.odm.Query`.
  be implemented by data-server backends.'''
         raise NotImplementedError()
     
+    def _execute_load(self, slic):
+        '''Execute the query and load the elements in *slic*. It returns
+the number of elements in the query and the loaded elements. Backends can
+override it to perform both operations in one request to the server.'''
+        count = self._execute_query()
+        return count, self._items(slic) if count else ()
+    
 
 class BackendDataServer(object):
     '''\
@@ -204,6 +224,8 @@ It must implement the *loads* and *dumps* methods.'''
         self.__name = name
         self._cachepipe = {}
         self._keys = {}
+        # composite indices known to include all instances
+        self._complete_indices = set()
         self.charset = charset
         self.pickler = pickler or encoders.NoEncoder()
         self.connection_string = connection_string
@@ -252,11 +274,18 @@ from database.
 
 :parameter meta: instance of model :class:`stdnet.odm.Metaclass`.
 :parameter data: iterator over instances data.
+:parameter related_fields: optional dictionary of related data. Data of
+    models related to a related model are keyed by the double underscore
+    separated path of field names.
 '''
         make_object = meta.maker
+        cache = meta.cache
         related_data = []
         if related_fields:
             for fname,fdata in iteritems(related_fields):
+                if JSPLITTER in fname:
+                    # loaded by the related model
+                    continue
                 field = meta.dfields[fname]
                 if field in meta.multifields:
                     related = dict(fdata)
@@ -264,14 +293,37 @@ from database.
                 else:
                     multi = False
                     relmodel = field.relmodel
-                    related = dict(((obj.id,obj)\
-                            for obj in self.make_objects(relmodel._meta,fdata)))
+                    prefix = fname + JSPLITTER
+                    nested = dict(((name[len(prefix):], d) for name, d in\
+                                   iteritems(related_fields)\
+                                   if name.startswith(prefix)))
+                    related = dict(((obj.id,obj) for obj in\
+                        self.make_objects(relmodel._meta, fdata, nested)))
                 related_data.append((field,related,multi))
                 
+        decode = None
         for state in data:
+            # All rows from a query share the same loaded fields, the
+            # decoder is obtained once and reused for the following rows.
+            # Each row carries its own list of fields, which is compared by
+            # value with the list of the previous row.
+            fields = state[1]
+            if decode is None or (fields is not loadedfields and\
+                                  fields != loadedfields):
+                loadedfields = fields
+                decode = meta.decoder(loadedfields if loadedfields is None\
+                                       else tuple(loadedfields))
             obj = make_object()
-            obj.__setstate__(state)
-            obj._dbdata['id'] = obj.id
+            decode(obj, state)
+            # The decoder doesn't consume the row, which is kept as the
+            # serialized values loaded from the server so that only fields
+            # which have changed are sent during a commit.
+            original = state[2]
+            dbdata = obj._dbdata
+            dbdata['id'] = obj.id
+            dbdata['original'] = original
+            if cache is not None and loadedfields is None:
+                cache.set(self, obj.id, original)
             for field,rdata,multi in related_data:
                 if multi:
                     field.set_cache(obj, rdata.get(str(obj.id)))
@@ -282,6 +334,24 @@ from database.
                         setattr(obj,field.name,value)
             yield obj
             
+    def make_records(self, meta, data):
+        '''Generator of read-only :class:`stdnet.odm.Record` with data
+from database. Used by :meth:`stdnet.odm.Query.records` queries, related
+fields are not loaded.
+
+:parameter meta: instance of model :class:`stdnet.odm.Metaclass`.
+:parameter data: iterator over instances data.
+'''
+        decode = None
+        for state in data:
+            fields = state[1]
+            if decode is None or (fields is not loadedfields and\
+                                  fields != loadedfields):
+                loadedfields = fields
+                decode = meta.record_decoder(loadedfields if\
+                            loadedfields is None else tuple(loadedfields))
+            yield decode(state)
+            
     def structure(self, instance, client = None):
         '''Create a backend :class:`stdnet.odm.Structure` handler.'''
         struct = self.struct_map.get(instance._meta.name)
@@ -318,6 +388,116 @@ must return a instance of the backend handler.'''
         '''Execute a :class:`stdnet.odm.Session` in the backend server.'''
         raise NotImplementedError()
     
+    def update_query(self, backend_query, data, removed,
+                     score=''):     # pragma: no cover
+        '''Update the fields of instances matched by *backend_query* in the
+backend server. It returns the list of updated ids and a list of errors.'''
+        raise NotImplementedError()
+    
+    def incr_field(self, meta, field, delta, backend_query=None,
+                   ids=None):    # pragma: no cover
+        '''Atomically increment the numeric *field* of instances matched by
+*backend_query*, or with the given *ids*, by *delta*. It returns a list of
+``(id, value)`` tuples with the new values.'''
+        raise NotImplementedError()
+    
+    def load_unique(self, meta, field, value, fields=None,
+                    readonly=False):    # pragma: no cover
+        '''Load the instance of model *meta* with *value* of the unique
+*field* in one call. It returns a list containing the instance, or an empty
+list if no instance is available.'''
+        raise NotImplementedError()
+    
+    def prefetch(self, field, ids, target=None):    # pragma: no cover
+        '''Load the instances related to each of *ids* by the foreign key
+*field*. If *target* is given, the instances of the model of the foreign key
+*target* of the through model are loaded. It returns a list containing
+the list of related instances of each id.'''
+        raise NotImplementedError()
+    
+    def load_fields(self, meta, ids, fields):    # pragma: no cover
+        '''Load the serialized values of the field attribute names *fields*
+of the instances of model *meta* with primary keys *ids*. It returns a
+list containing the list of values of each id.'''
+        raise NotImplementedError()
+    
+    def invalidation_channel(self, meta):
+        '''The channel where the ids of committed instances of model *meta*
+are published, when the model has an :class:`stdnet.odm.InstanceCache`.'''
+        return self.basekey(meta, 'inv')
+    
+    def invalidate(self, meta, ids):
+        '''Evict *ids* from the :class:`stdnet.odm.InstanceCache` of model
+*meta*, after they have been changed on the server without a commit.
+Backends supporting it publish the *ids* on the
+:meth:`invalidation_channel`.'''
+        if meta.cache is not None:
+            meta.cache.evict(self, ids)
+    
+    def read_changes(self, meta, count):    # pragma: no cover
+        '''Read at most *count* records from the head of the change log of
+model *meta*. It returns a list of ``(seq, id, action, fields, score)``
+tuples, where *fields* is the comma separated list of fields changed.'''
+        raise NotImplementedError()
+    
+    def ack_changes(self, meta, seq):    # pragma: no cover
+        '''Remove the records of the change log of model *meta* with
+sequence number up to *seq*.'''
+        raise NotImplementedError()
+    
+    def scan_instances(self, meta, cursor=0, count=1000):  # pragma: no cover
+        '''Incrementally scan the instances of model *meta*, starting at
+*cursor*. It returns a two elements tuple with the next cursor, 0 when the
+scan is complete, and a list of about *count* ids.'''
+        raise NotImplementedError()
+    
+    def rebuild_indices(self, meta, ids, fields=None):  # pragma: no cover
+        '''Add the instances of model *meta* with *ids* to the indices of
+the attribute names *fields*, or all indices. It returns the number of
+index entries added and a list of unique constraints violated.'''
+        raise NotImplementedError()
+    
+    def scan_indices(self, meta, cursor=0, count=1000):  # pragma: no cover
+        '''Incrementally scan the index keys of model *meta*, as
+:meth:`scan_instances`.'''
+        raise NotImplementedError()
+    
+    def check_index(self, meta, key, cursor=0, count=1000,
+                    fix=False):    # pragma: no cover
+        '''Check a batch of entries of the index *key* of model *meta*
+against the instances they refer to. It returns the next cursor, the
+number of entries checked and a list of ``(key, entry)`` stale entries.'''
+        raise NotImplementedError()
+    
+    def field_counts(self, meta, field):    # pragma: no cover
+        '''Return a dictionary mapping the serialized values of the counted
+*field* of model *meta* to the number of instances with that value, or
+``None`` if the counts of *field* are not complete.'''
+        raise NotImplementedError()
+    
+    def index_complete(self, meta, index):    # pragma: no cover
+        '''Return ``True`` if the composite *index*, or the sort index of
+field *index*, of model *meta* includes all instances. It is not the case
+when the index is added to a model with instances, until the index is
+rebuilt.'''
+        raise NotImplementedError()
+    
+    def set_indices_complete(self, meta, attnames):  # pragma: no cover
+        '''Record that the composite and sort indices *attnames* of model
+*meta* include all instances.'''
+        raise NotImplementedError()
+    
+    def set_counts_complete(self, meta, attnames):  # pragma: no cover
+        '''Record that the counts of the counted fields *attnames* of model
+*meta* are complete, for example once they have been rebuilt.'''
+        raise NotImplementedError()
+    
+    def bulk_commit(self, meta, instances):     # pragma: no cover
+        '''Add a list of new *instances* of model *meta* to the backend server
+without a :class:`stdnet.odm.Session`. It returns a list of
+:class:`stdnet.instance_session_result` or exceptions, one for each instance.'''
+        raise NotImplementedError()
+    
     def model_keys(self, meta):     # pragma: no cover
         '''Return a list of database keys used by model *model*'''
         raise NotImplementedError()
@@ -1,21 +1,24 @@
 '''Redis backend implementation'''
 from copy import copy
 import json
+from random import randint
 from hashlib import sha1
 from itertools import chain
 from functools import partial
 from collections import namedtuple
 
 import stdnet
-from stdnet import FieldValueError, CommitException
+from stdnet import FieldValueError, CommitException, QuerySetError
 from stdnet.utils import to_string, map, gen_unique_id, zip,\
-                             native_str, flat_mapping
+                             native_str, flat_mapping, iteritems, JSPLITTER
 from stdnet.lib import redis
 
 from .base import BackendStructure, query_result, session_result,\
                     instance_session_result
 
 pairs_to_dict = redis.pairs_to_dict
+load_result = namedtuple('load_result', 'items')
+delete_result = namedtuple('delete_result', 'results remaining resume')
 MIN_FLOAT =-1.e99
 EMPTY_DICT = {}
 
@@ -26,7 +29,12 @@ ID = 'id'       # the set of all ids
 OBJ = 'obj'     # the hash table for a instance
 UNI = 'uni'     # the hashtable for the unique field value to id mapping
 IDX = 'idx'     # the set of indexes for a field value
+CNT = 'cnt'     # the hashtable for the field value to count mapping
+COUNTED = 'counted' # the set of fields with complete counts
+BUILT = 'built' # the set of complete composite indices
 TMP = 'tmp'     # temorary key
+BIT = 'bit'     # the bitmap of ids for a field value
+SRT = 'srt'     # the sorted set of ids scored by a field value
 ################################################################################
 
 def redis_before_send(sender, request, command, **kwargs):
@@ -41,14 +49,39 @@ redis.redis_before_send.connect(redis_before_send)
 
 class build_query(redis.RedisScript):
     script = (redis.read_lua_file('commands.utils'),
+              redis.read_lua_file('odm.bitmap'),
               redis.read_lua_file('odm.build_query'))
     
 
-class add_recursive(redis.RedisScript):
-    script = (redis.read_lua_file('commands.utils'),
-              redis.read_lua_file('odm.add_recursive'))
-    
+class bitmap_query(redis.RedisScript):
+    '''Evaluate a query on bitmap indices and return the number of
+matched elements.'''
+    script = (redis.read_lua_file('tabletools'),
+              redis.read_lua_file('odm.bitmap_query'))
+    
+    
+class bitmap_store(redis.RedisScript):
+    '''Store the ids of a bitmap, which are in the model id set, into
+a set or a sorted set.'''
+    script = (redis.read_lua_file('odm.bitmap'),
+              '''local idset = KEYS[1] .. ':id'
+local s = ARGV[1]
+for _,id in ipairs(bitmap_members(KEYS[2])) do
+    if s == 's' then
+        if redis.call('sismember', idset, id) + 0 == 1 then
+            redis.call('sadd', KEYS[3], id)
+        end
+    else
+        local score = redis.call('zscore', idset, id)
+        if score then
+            redis.call('zadd', KEYS[3], score, id)
+        end
+    end
+end
+redis.call('del', KEYS[2])
+redis.call('expire', KEYS[3], ARGV[2])''')
     
+
 class load_query(redis.RedisScript):
     '''Rich script for loading a query result into stdnet. It handles
 loading of different fields, loading of related fields, sorting and
@@ -71,7 +104,10 @@ limiting.'''
                 yield id,None,dict(pairs_to_dict(fdata, encoding))
     
     def callback(self, request, response, args, query=None, get=None,
-                 fields=None, fields_attributes=None, **kwargs):
+                 fields=None, fields_attributes=None, store=False, **kwargs):
+        if store:
+            # the number of ids stored
+            return response
         meta = query.meta
         if get:
             tpy = meta.dfields[get].to_python
@@ -80,6 +116,8 @@ limiting.'''
             data, related = response
             encoding = request.client.encoding
             data = self.build(data, fields, fields_attributes, encoding)
+            if query.queryelem.readonly:
+                return query.backend.make_records(meta, data)
             related_fields = {}
             if related:
                 for fname,rdata,fields in related:
@@ -91,7 +129,10 @@ limiting.'''
         
     def load_related(self, meta, fname, data, fields, encoding):
         '''Parse data for related objects.'''
-        field = meta.dfields[fname]
+        names = fname.split(JSPLITTER)
+        for name in names[:-1]:
+            meta = meta.dfields[name].relmodel._meta
+        field = meta.dfields[names[-1]]
         if field in meta.multifields:
             fmeta = field.structure_class()._meta
             if fmeta.name in ('hashtable','zset','ts'):
@@ -101,29 +142,152 @@ limiting.'''
             else:
                 return data
         else:
-            # this is data for stdmodel instances
-            return self.build(data, fields, fields, encoding)
+            # this is data for stdmodel instances, fields are loaded by
+            # attribute name.
+            attnames = dict(((f.attname, f.name) for f in\
+                             field.relmodel._meta.scalarfields))
+            names = tuple((attnames.get(f, f) for f in fields))
+            return self.build(data, names, fields, encoding)
+        
+
+class load_unique(load_query):
+    '''Load an instance from a lookup on the id or on a unique field in
+one call.'''
+    script = (redis.read_lua_file('tabletools'),
+              redis.read_lua_file('odm.load_unique'))
+    
+    def callback(self, request, response, args, meta=None, backend=None,
+                 fields=None, fields_attributes=None, readonly=False,
+                 **kwargs):
+        data = self.build(response, fields, fields_attributes,
+                          request.client.encoding)
+        if readonly:
+            return list(backend.make_records(meta, data))
+        else:
+            return list(backend.make_objects(meta, data))
+        
+
+class load_prefetch(load_query):
+    '''Load the instances related to a list of ids in one call. It returns
+a list with the related instances of each id.'''
+    script = (redis.read_lua_file('commands.utils'),
+              redis.read_lua_file('odm.load_prefetch'))
+    
+    def callback(self, request, response, args, meta=None, backend=None,
+                 **kwargs):
+        related, data = response
+        data = list(self.build(data, None, None, request.client.encoding))
+        instances = dict(zip((d[0] for d in data),
+                             backend.make_objects(meta, data)))
+        return [[instances[id] for id in ids] for ids in related]
         
 
 class delete_query(redis.RedisScript):
     '''Lua script for bulk delete of an odm query, including cascade items.
-The first parameter is the model'''
+The relation graph is walked on the server and the callback returns a
+``delete_result`` with a :class:`stdnet.session_result` for each model with
+deleted instances and the number of entries left for the next call.'''
     script = (redis.read_lua_file('tabletools'),
+              redis.read_lua_file('commands.utils'),
+              redis.read_lua_file('odm.bitmap'),
+              redis.read_lua_file('odm.counts'),
+              redis.read_lua_file('odm.composite'),
+              redis.read_lua_file('odm.sort_index'),
+              redis.read_lua_file('odm.changelog'),
               redis.read_lua_file('odm.delete_query'))
     
-    def callback(self, request, response, args, meta = None, client = None,
+    def callback(self, request, response, args, metas=None, resume=None,
                  **kwargs):
-        res = (instance_session_result(r,False,r,True,0) for r in response)
-        return session_result(meta, res)
+        deleted, remaining = response
+        results = tuple(session_result(meta, [instance_session_result(
+                                           r, False, r, True, 0) for r in ids])
+                        for meta, ids in zip(metas, deleted) if ids)
+        return delete_result(results, remaining, resume)
+    
+
+class changelog_ack(redis.RedisScript):
+    '''Lua script for removing the acknowledged records of a change log.
+It returns the number of records removed.'''
+    script = redis.read_lua_file('odm.changelog_ack')
+    
+    
+class index_rebuild(redis.RedisScript):
+    '''Lua script adding a batch of instances to the indices of their model.
+It returns the number of index entries added and the list of errors.'''
+    script = (redis.read_lua_file('tabletools'),
+              redis.read_lua_file('odm.bitmap'),
+              redis.read_lua_file('odm.counts'),
+              redis.read_lua_file('odm.composite'),
+              redis.read_lua_file('odm.sort_index'),
+              redis.read_lua_file('odm.index_rebuild'))
+    
+    def callback(self, request, response, args, **kwargs):
+        added, errors = response
+        return int(added), [to_string(e) for e in errors]
+    
+    
+class index_check(redis.RedisScript):
+    '''Lua script checking a batch of entries of an index. It returns the
+number of entries checked and the list of stale entries.'''
+    script = (redis.read_lua_file('tabletools'),
+              redis.read_lua_file('odm.bitmap'),
+              redis.read_lua_file('odm.counts'),
+              redis.read_lua_file('odm.composite'),
+              redis.read_lua_file('odm.sort_index'),
+              redis.read_lua_file('odm.index_check'))
+    
+    def callback(self, request, response, args, key=None, **kwargs):
+        checked, stale = response
+        return int(checked), [(key, to_string(e)) for e in stale]
+    
+    
+class incr_field(redis.RedisScript):
+    '''Lua script for atomic increments of a numeric field. It returns a
+flat list of ids and new values and the number of ids processed.'''
+    script = (redis.read_lua_file('tabletools'),
+              redis.read_lua_file('odm.bitmap'),
+              redis.read_lua_file('odm.counts'),
+              redis.read_lua_file('odm.composite'),
+              redis.read_lua_file('odm.sort_index'),
+              redis.read_lua_file('odm.changelog'),
+              redis.read_lua_file('odm.incr_field'))
+    
+    def callback(self, request, response, args, **kwargs):
+        result, processed = response
+        return result, int(processed)
+    
+
+class update_query(redis.RedisScript):
+    '''Lua script for bulk update of fields of instances in a query. It
+processes a chunk of ids and returns the list of ids updated, the list of
+errors and the number of ids processed.'''
+    script = (redis.read_lua_file('tabletools'),
+              redis.read_lua_file('odm.bitmap'),
+              redis.read_lua_file('odm.counts'),
+              redis.read_lua_file('odm.composite'),
+              redis.read_lua_file('odm.sort_index'),
+              redis.read_lua_file('odm.changelog'),
+              redis.read_lua_file('odm.update_query'))
+    
+    def callback(self, request, response, args, **kwargs):
+        updated, failures, processed = response
+        failures = [f.decode(request.encoding) for f in failures]
+        return updated, failures, int(processed)
     
 
 class commit_session(redis.RedisScript):
     script = (redis.read_lua_file('tabletools'),
+              redis.read_lua_file('odm.bitmap'),
+              redis.read_lua_file('odm.counts'),
+              redis.read_lua_file('odm.composite'),
+              redis.read_lua_file('odm.sort_index'),
+              redis.read_lua_file('odm.changelog'),
               redis.read_lua_file('odm.commit_session'))
     
-    def callback(self, request, response, args, sm=None, iids=None, **kwargs):
+    def callback(self, request, response, args, sm=None, iids=None,
+                 meta=None, **kwargs):
         response = self._wrap(request, response, iids)
-        return session_result(sm.meta, response)
+        return session_result(meta or sm.meta, response)
     
     def _wrap(self, request, response, iids):
         for id, iid in zip(response, iids):
@@ -158,6 +322,19 @@ def results_and_erros(results, result_type):
                 yield v
                 
                 
+def merge_request_info(infos):
+    # The request info of pipes executed in turn. The commands of all pipes
+    # are included and the request and raw command are the ones of the last
+    # pipe, the requests of all pipes are in "requests".
+    infos = [info for info in infos if info]
+    if len(infos) < 2:
+        return infos[0] if infos else None
+    info = dict(infos[-1])
+    info['commands'] = list(chain(*(i.get('commands', ()) for i in infos)))
+    info['requests'] = [i.get('request') for i in infos]
+    return info
+    
+    
 def redis_execution(pipe, result_type):
     pipe.request_info = {}
     results = pipe.execute(load_script=True)
@@ -171,6 +348,11 @@ def redis_execution(pipe, result_type):
 class RedisQuery(stdnet.BackendQuery):
     card = None
     script_dep = {'script_dependency': ('build_query','move2set')}
+    # temporary is True when the query key is a temporary key created by
+    # the query, released is True once that key was deleted after use.
+    temporary = False
+    released = False
+    consumed = ()
     
     def zism(self, r):
         return r is not None
@@ -193,16 +375,38 @@ class RedisQuery(stdnet.BackendQuery):
                 be = child.backend_query(pipe = pipe)
                 keys.append(be.query_key)
                 args.extend(('key',be.query_key))
+                if be.pipe is pipe:
+                    self.consumed.append(be)
+        
+        # Identical queries built in the pipe of a query share one temporary
+        # key. The fingerprint contains the keys of the children, which are
+        # shared in the same way.
+        gf = qs._get_field
+        temp_keys = getattr(pipe, 'temp_keys', None)
+        fingerprint = None
+        if temp_keys is not None and (not gf or gf == 'id'):
+            fingerprint = repr((meta.modelkey, p, qs.keyword,
+                                getattr(qs, 'name', None),
+                                getattr(qs, 'lookup', None),
+                                getattr(qs, 'unique', None),
+                                getattr(qs, 'bitmap', None), gf, args))
+            if fingerprint in temp_keys:
+                self.temporary = True
+                return 'key', temp_keys[fingerprint]
         
         temp_key = True
         if qs.keyword == 'set':
             if qs.name == 'id' and not args:
                 key = backend.basekey(meta,'id')
                 temp_key = False
+            elif qs.composite and len(args) == 2 and not args[0]:
+                # A lookup on a composite index is the index itself
+                key = backend.basekey(meta, IDX, qs.name, args[1])
+                temp_key = False
             else:
                 bk = backend.basekey(meta)
                 key = backend.tempkey(meta)
-                unique = 'u' if qs.unique else ''
+                unique = 'u' if qs.unique else ('b' if qs.bitmap else '')
                 keys = [bk, key, bk+':*'] + keys
                 pipe.script_call('build_query', keys, p, qs.name,
                                  unique, qs.lookup, *args)
@@ -222,7 +426,6 @@ class RedisQuery(stdnet.BackendQuery):
     
         # If e requires a different field other than id, perform a sort
         # by nosort and get the object field.
-        gf = qs._get_field
         if gf and gf != 'id':
             field_attribute = meta.dfields[gf].attname
             bkey = key
@@ -235,21 +438,181 @@ class RedisQuery(stdnet.BackendQuery):
             
         if temp_key:
             pipe.expire(key, self.expire)
+            if fingerprint is not None:
+                temp_keys[fingerprint] = key
+            self.temporary = True
             
         return 'key',key
+    
+    def release(self, *queries):
+        '''Add to the pipe the deletion of the temporary keys of *queries*,
+which are marked as released so that their key is built again if they are
+used afterwards.'''
+        keys = set()
+        temp_keys = getattr(self.pipe, 'temp_keys', {})
+        for query in queries:
+            if query.temporary and not query.released:
+                query.released = True
+                keys.add(query._query_key)
+        if keys:
+            for fingerprint, key in tuple(temp_keys.items()):
+                if key in keys:
+                    temp_keys.pop(fingerprint)
+            self.pipe.delete(*sorted(keys), **self.script_dep)
+    
+    def descendants(self):
+        '''Generator of the backend queries built in the pipe of this query
+to evaluate it.'''
+        for query in self.consumed:
+            yield query
+            for q in query.descendants():
+                yield q
         
+    def bitmap_program(self, qs, dest, program):
+        '''Add the instructions for the ``bitmap_query`` script which
+evaluate *qs* into the bitmap at *dest*. Return ``False`` if *qs* is not
+a combination of lookups on bitmap indices.'''
+        if qs.keyword == 'set':
+            if not getattr(qs, 'bitmap', False) or\
+                    getattr(qs.underlying, 'backend', None) is not None:
+                return False
+            values = list(qs)
+            for v in values:
+                if getattr(v, 'backend', None) is not None:
+                    return False
+            program.extend(('set', dest, qs.name, len(values)))
+            program.extend(values)
+        elif qs.keyword in ('intersect', 'union', 'diff'):
+            dests = []
+            for child in qs:
+                d = self.backend.tempkey(self.meta)
+                if not self.bitmap_program(child, d, program):
+                    return False
+                dests.append(d)
+            op = 'and' if qs.keyword == 'intersect' else\
+                 ('or' if qs.keyword == 'union' else 'diff')
+            program.extend((op, dest, len(dests)))
+            program.extend(dests)
+        else:
+            return False
+        return True
+    
+    def counted_values(self, qs):
+        '''The values of *qs* if it is a lookup on a counted index, in which
+case the number of matched elements is given by the index counts. Return
+``None`` otherwise.'''
+        if qs.keyword != 'set' or not getattr(qs, 'counts', False) or\
+                qs.lookup != 'in' or\
+                getattr(qs.underlying, 'backend', None) is not None:
+            return
+        values = set()
+        for v in qs:
+            if getattr(v, 'backend', None) is not None:
+                return
+            values.add('' if v is None else v)
+        return tuple(values)
+    
     def _build(self, pipe = None, **kwargs):
         '''Set up the query for redis'''
-        self.pipe = pipe if pipe is not None else self.backend.client.pipeline()
+        self.bitmap = None
+        self.counts = None
+        if pipe is None:
+            # A top level lookup on a counted index is counted from the
+            # index counts. Ids are stored only when needed.
+            self.counts = self.counted_values(self.queryelem)
+            if self.counts:
+                self.pipe = None
+                return
+            # A top level query on bitmap indices only is evaluated with
+            # bitwise operations. Ids are stored only when needed.
+            key = self.backend.tempkey(self.meta)
+            program = []
+            if self.bitmap_program(self.queryelem, key + ':bits', program):
+                self.bitmap = program
+                self._query_key = key
+                return
+        self._accumulate(pipe)
+    
+    def _accumulate(self, pipe):
+        self.consumed = []
+        if pipe is None:
+            self.pipe = self.backend.client.pipeline()
+            self.pipe.temp_keys = {}
+        else:
+            self.pipe = pipe
         what, key = self.accumulate(self.queryelem)
         if what == 'key':
-            self.query_key = key
+            self._query_key = key
         else:
             raise ValueError('Critical error while building query')
+        if pipe is None:
+            # The keys of the queries used to build this one are not needed
+            # once the pipe is executed.
+            self.release(*self.descendants())
+    
+    @property
+    def query_key(self):
+        '''The key of the set (or sorted set) containing the ids of matched
+elements.'''
+        if self.counts:
+            self.execute_query()
+            self.counts = None
+            self._accumulate(None)
+            redis_execution(self.pipe, query_result)
+        elif self.released:
+            # The temporary key was deleted after use, build it again
+            self.released = False
+            self.temporary = False
+            self._accumulate(None)
+            redis_execution(self.pipe, query_result)
+        elif self.bitmap:
+            self.execute_query()
+            meta = self.meta
+            bk = self.backend.basekey(meta)
+            key = self._query_key
+            self.backend.client.script_call('bitmap_store',
+                                            (bk, key + ':bits', key),
+                                            'z' if meta.ordering else 's',
+                                            self.expire)
+            self.bitmap = None
+        return self._query_key
     
     def _execute_query(self):
         '''Execute the query without fetching data. Returns the number of
 elements in the query.'''
+        if self.counts:
+            return self._execute_counts()
+        elif self.bitmap:
+            return self._execute_bitmap()
+        # The key is kept after a count, it is likely to be loaded next
+        self._count_query()
+        self.commands, res = redis_execution(self.pipe, query_result)
+        self.query_results = list(res)
+        return self.query_results[-1].count
+    
+    def _execute_load(self, slic):
+        '''Build, count and load the query in a single round trip.'''
+        if self.counts or self.bitmap or self.backend.script_slice:
+            return super(RedisQuery, self)._execute_load(slic)
+        pipe = self.pipe
+        self._count_query()
+        keys, args, options = self._load_args(slic)
+        pipe.script_call('load_query', keys, *args, **options)
+        pipe.add_callback(lambda processed, result : load_result(result))
+        if slic is None:
+            # All the elements are loaded and cached by the query
+            self.release(self)
+        self.commands, res = redis_execution(pipe,
+                                             (query_result, load_result))
+        results = list(res)
+        loaded = results.pop()
+        if isinstance(loaded, Exception):
+            raise loaded
+        self.query_results = results
+        return self.query_results[-1].count, loaded.items
+    
+    def _count_query(self):
+        # Add the command which count the elements of the query to the pipe
         pipe = self.pipe
         if not self.card:
             if self.meta.ordering:
@@ -262,17 +625,54 @@ elements in the query.'''
                 self._check_member = self.sism
         else:
             self.ismember = None
-        self.card(self.query_key, script_dependency = 'build_query')
-        pipe.add_callback(lambda processed, result :
-                                    query_result(self.query_key, result))
-        self.commands, res = redis_execution(pipe, query_result)
-        self.query_results = list(res)
-        return self.query_results[-1].count
+        key = self.query_key
+        self.card(key, script_dependency = 'build_query')
+        pipe.add_callback(lambda processed, result : query_result(key, result))
+    
+    def _execute_bitmap(self):
+        bk = self.backend.basekey(self.meta)
+        key = self._query_key
+        if self.meta.ordering:
+            self.ismember = getattr(self.backend.client,'zrank')
+            self._check_member = self.zism
+        else:
+            self.ismember = getattr(self.backend.client,'sismember')
+            self._check_member = self.sism
+        count = self.backend.client.script_call('bitmap_query',
+                                                (bk, key + ':bits'),
+                                                self.expire, *self.bitmap)
+        self.query_results = [query_result(key, count)]
+        return count
+    
+    def _execute_counts(self):
+        name = self.queryelem.name
+        backend = self.backend
+        key = backend.basekey(self.meta, CNT, name)
+        pipe = backend.client.pipeline()
+        pipe.sismember(backend.basekey(self.meta, COUNTED), name)
+        pipe.hmget(key, *self.counts)
+        complete, counts = pipe.execute()
+        if not complete:
+            # Counts of instances added before the field was counted are
+            # missing, count the ids instead.
+            self.counts = None
+            self._accumulate(None)
+            return self._execute_query()
+        if self.meta.ordering:
+            self.ismember = getattr(backend.client,'zrank')
+            self._check_member = self.zism
+        else:
+            self.ismember = getattr(backend.client,'sismember')
+            self._check_member = self.sism
+        count = sum((int(c) for c in counts if c))
+        self.query_results = [query_result(key, count)]
+        return count
     
     def order(self, last):
         '''Perform ordering with respect model fields.'''
         desc = 'DESC' if last.desc else ''
         field = last.name
+        first = last.field
         nested = last.nested
         nested_args = []
         while nested:
@@ -283,10 +683,18 @@ elements in the query.'''
         meth = ''
         if last.field.internal_type == 'text':
             meth = 'ALPHA'
-        
+        # The sort index of the ordering field is used for direct sorting
+        # and for sorting on one foreign key with a set based index, once it
+        # includes all instances.
+        sort = ''
+        if last.field.sort_index and (not nested_args or
+                (len(nested_args) == 2 and first.index and
+                 not (first.bitmap or first.unique))) and\
+                self.backend.index_complete(last.model._meta, last.field):
+            sort = 't' if meth else 'n'
         if field == last.model._meta.pkname():
             field = ''
-        args = [field, meth, desc, len(nested_args)//2]
+        args = [field, meth, desc, sort, len(nested_args)//2]
         args.extend(nested_args)
         return args
             
@@ -304,33 +712,64 @@ elements in the query.'''
         return start,stop
     
     def _items(self, slic):
+        keys, args, options = self._load_args(slic)
+        size = self.backend.script_slice
+        client = self.backend.client
+        if not size or options['get']:
+            return client.script_call('load_query', keys, *args, **options)
+        # Store the ids of the slice, in order, into a list and load
+        # instances from the list with one script call for each slice.
+        key = self.backend.tempkey(self.meta)
+        count = client.script_call('load_query', keys + (key,), *args,
+                                   store=True)
+        items = []
+        try:
+            for start in range(0, count, size):
+                keys, args, options = self._load_args(
+                                        slice(start, start+size), ordered=False)
+                keys = (key,) + keys[1:]
+                items.extend(client.script_call('load_query', keys, *args,
+                                                **options))
+        finally:
+            client.delete(key)
+        return items
+    
+    def _sample(self, n):
+        keys, args, options = self._load_args(None, n)
+        return self.backend.client.script_call('load_query', keys, *args,
+                                               **options)
+        
+    def _load_args(self, slic, sample=None, ordered=True):
         # Unwind the database query by creating a list of arguments for
-        # the load_query lua script
+        # the load_query lua script. Unordered queries are sliced in the
+        # set iteration order, without sorting.
         backend = self.backend
         meta = self.meta
         name = ''
         order = ()
         start, stop = self.get_redis_slice(slic)
-        if self.queryelem.ordering:
+        if not ordered:
+            # the ids are already in order, as in the lists of _items
+            pass
+        elif sample is not None:
+            name = 'random'
+            order = (sample, randint(1, 1000000000))
+        elif isinstance(self.queryelem.ordering, tuple):
+            # sort by several fields
+            name = 'multi'
+            order = [len(self.queryelem.ordering)]
+            for ordering in self.queryelem.ordering:
+                order.extend(self.order(ordering))
+        elif self.queryelem.ordering:
             order = self.order(self.queryelem.ordering)
         elif meta.ordering:
             name = 'DESC' if meta.ordering.desc else 'ASC'
-        elif start or stop is not None:
-            order = self.order(meta.get_sorting(meta.pkname()))
-        # Wen using the sort algorithm redis requires the number of element
-        # not the stop index
-        if order:
+        if order and not name:
             name = 'explicit'
-            N = self.execute_query()
-            if stop is None:
-                stop = N
-            elif stop < 0:
-                stop += N
-            if start < 0:
-                start += N
-            stop -= start
-        elif stop is None:
-            stop = -1
+        # The script converts the slice bounds, so that the number of
+        # elements is not needed in advance.
+        if stop is None:
+            stop = ''
                 
         get = self.queryelem._get_field or ''
         fields_attributes = None
@@ -365,7 +804,7 @@ elements in the query.'''
                    'fields_attributes':fields_attributes,
                    'query':self,
                    'get':get}
-        return backend.client.script_call('load_query', keys, *args, **options)    
+        return keys, args, options
 
     def related_lua_args(self):
         '''Generator of load_related arguments'''
@@ -373,18 +812,30 @@ elements in the query.'''
         if not related:
             yield 0
         else:
-            meta = self.meta
             yield len(related)
-            for rel in related:
-                field = meta.dfields[rel]
+            # Parents are loaded before the models they relate to. Each
+            # relation is followed from the ids of its parent, 0 for the
+            # query itself.
+            parents = {}
+            for n, rel in enumerate(sorted(related, key=lambda r:\
+                                           r.count(JSPLITTER)), 1):
+                parents[rel] = n
+                names = rel.split(JSPLITTER)
+                meta = self.meta
+                for name in names[:-1]:
+                    meta = meta.dfields[name].relmodel._meta
+                field = meta.dfields[names[-1]]
                 typ = 'structure' if field in meta.multifields else ''
                 relmodel = field.relmodel
                 bk = self.backend.basekey(relmodel._meta) if relmodel else ''
                 fi = related[rel]
+                if relmodel and fi:
+                    fi = relmodel._meta.backend_fields(fi)[1]
                 yield bk
-                yield field.name
+                yield rel
                 yield field.attname
                 yield typ
+                yield parents.get(JSPLITTER.join(names[:-1]), 0)
                 yield len(fi)
                 for v in fi:
                     yield v
@@ -707,6 +1158,7 @@ class BackendDataServer(stdnet.BackendDataServer):
     Query = RedisQuery
     connection_pools = {}
     _redis_clients = {}
+    script_slice = 0
     struct_map = {'set':Set,
                   'list':List,
                   'zset':Zset,
@@ -715,7 +1167,10 @@ class BackendDataServer(stdnet.BackendDataServer):
                   'numberarray':NumberArray,
                   'string': String}
         
-    def setup_connection(self, address, **params):
+    def setup_connection(self, address, script_slice=0, **params):
+        # Maximum number of instances processed by a script call, 0 for no
+        # limit. See execute_session and RedisQuery._items.
+        self.script_slice = int(script_slice)
         addr = address.split(':')
         if len(addr) == 2:
             try:
@@ -790,10 +1245,16 @@ class BackendDataServer(stdnet.BackendDataServer):
             return EMPTY_DICT
     
     def flat_indices(self, meta):
-        for idx in meta.indices:
+        indices = meta.indices + meta.composite_indices
+        for idx in chain(indices, meta.sort_indices):
             yield idx.attname
-        for idx in meta.indices:
-            yield 1 if idx.unique else 0
+        for idx in indices:
+            flag = 2 if idx.bitmap else (1 if idx.unique else 0)
+            # counted indices are flagged with an offset of 10
+            yield flag + 10 if idx.counts else flag
+        for field in meta.sort_indices:
+            # sort indices are flagged 3 for numbers and 4 for text
+            yield 4 if field.internal_type == 'text' else 3
             
     def load_scripts(self, *names):
         if not names:
@@ -814,10 +1275,93 @@ class BackendDataServer(stdnet.BackendDataServer):
         else:
             return ('',)
         
+    def changed_data(self, meta, data, original):
+        '''Compare the serialized *data* of a persistent instance with the
+*original* values loaded from the server.
+
+:rtype: a two elements tuple containing the dictionary of changed data and
+    the list of fields to remove from the instance hash, or ``None`` if
+    the instance cannot be committed by sending changed fields only.'''
+        if meta.pk.type == 'composite':
+            return
+        charset = self.charset
+        def encode(value):
+            if isinstance(value, bytes):
+                return value
+            return ('%s' % value).encode(charset)
+        changed = {}
+        for name, value in iteritems(data):
+            ovalue = original.get(name)
+            if ovalue is None or encode(value) != encode(ovalue):
+                changed[name] = value
+        removed = [name for name, value in iteritems(original)\
+                   if value is not None and name not in data]
+        ordering = meta.ordering
+        if ordering:
+            # a change in the ordering field changes the score of all indices
+            if ordering.auto:
+                return
+            attname = ordering.field.attname
+            for name in chain(changed, removed):
+                if name.split(JSPLITTER)[0] == attname:
+                    return
+        return changed, removed
+        
+    def instance_score(self, meta, instance):
+        '''The score of a new or modified *instance* in the id set.'''
+        score = MIN_FLOAT
+        if meta.ordering:
+            if meta.ordering.auto:
+                score = 'auto {0}'.format(meta.ordering.name.incrby) 
+            else:
+                v = getattr(instance,meta.ordering.name,None)
+                if v is not None:
+                    score = meta.ordering.field.scorefun(v)
+        return score
+    
+    def commit_header(self, meta, N):
+        '''The first arguments of the ``commit_session`` script for *N*
+instances of model *meta*.'''
+        indices = list(self.flat_indices(meta))
+        lua_data = ['z' if meta.ordering else 's', N, len(indices)//2]
+        lua_data.extend(self.pk_info(meta))
+        lua_data.extend(indices)
+        lua_data.append(meta.changelog or 0)
+        return lua_data
+    
+    def bulk_commit(self, meta, instances):
+        '''Add a batch of new *instances* of model *meta* in one call to the
+``commit_session`` script, without session bookkeeping.'''
+        bk = self.basekey(meta)
+        lua_data = self.commit_header(meta, len(instances))
+        for instance in instances:
+            if not meta.is_valid(instance):
+                raise FieldValueError(json.dumps(instance._dbdata['errors']))
+            data = flat_mapping(instance._dbdata['cleaned_data'])
+            lua_data.extend(('a', instance.pkvalue() or '',
+                             self.instance_score(meta, instance), len(data)))
+            lua_data.extend(data)
+        pipe = self.client.pipeline()
+        keys = (bk, bk+':*') + self.notify_keys(meta)
+        pipe.script_call('commit_session', keys, *lua_data,
+                         meta=meta, iids=range(len(instances)))
+        command, result = redis_execution(pipe, session_result)
+        result = list(result)
+        if len(result) != 1:
+            raise CommitException('Expected one result from commit_session '
+                                  'for {0}, got {1}'.format(meta, len(result)))
+        if isinstance(result[0], Exception):
+            raise result[0]
+        return list(result[0].results)
+        
     def execute_session(self, session, callback):
-        '''Execute a session in redis.'''
+        '''Execute a session in redis. If :attr:`script_slice` is set, each
+``commit_session`` call saves at most that number of instances and runs in
+its own round trip, while deletes are resumed until all instances, including
+the related ones, are removed. Other clients are served in between.'''
         basekey = self.basekey
         pipe = self.client.pipeline()
+        pipes = [pipe]
         for sm in session:
             meta = sm.meta
             model_type = meta.model._model_type
@@ -826,33 +1370,32 @@ class BackendDataServer(stdnet.BackendDataServer):
             elif model_type == 'object':
                 delquery = sm.get_delete_query(pipe = pipe)
                 self.accumulate_delete(pipe, delquery)
-                dirty = tuple(sm.iterdirty())
-                N = len(dirty)
-                if N:
+                for dirty in self.script_slices(tuple(sm.iterdirty())):
+                    if self.script_slice and pipe.command_stack:
+                        pipe = self.client.pipeline()
+                        pipes.append(pipe)
+                    N = len(dirty)
                     bk = basekey(meta)
-                    s = 'z' if meta.ordering else 's'
-                    indices = list(self.flat_indices(meta))
-                    lua_data = [s,N,len(indices)//2]
-                    lua_data.extend(self.pk_info(meta))
-                    lua_data.extend(indices)
+                    lua_data = self.commit_header(meta, N)
                     processed = []
                     for instance in dirty:
                         state = instance.state()
                         if not instance.is_valid():
                             raise FieldValueError(
                                         json.dumps(instance._dbdata['errors']))
-                        score = MIN_FLOAT
-                        if meta.ordering:
-                            if meta.ordering.auto:
-                                score = 'auto {0}'.format(\
-                                                    meta.ordering.name.incrby) 
-                            else:
-                                v = getattr(instance,meta.ordering.name,None)
-                                if v is not None:
-                                    score = meta.ordering.field.scorefun(v)
+                        score = self.instance_score(meta, instance)
                         data = instance._dbdata['cleaned_data']
+                        changed = None
                         if state.persistent:
-                            action = 'o' if instance.has_all_data else 'c'
+                            original = instance._dbdata.get('original')
+                            if original is not None:
+                                changed = self.changed_data(meta, data,
+                                                            original)
+                            if changed is not None:
+                                action = 'u'
+                                data, removed = changed
+                            else:
+                                action = 'o' if instance.has_all_data else 'c'
                             id = state.iid
                         else:
                             action = 'a'
@@ -860,48 +1403,313 @@ class BackendDataServer(stdnet.BackendDataServer):
                         data = flat_mapping(data)
                         lua_data.extend((action, id, score, len(data)))
                         lua_data.extend(data)
+                        if changed is not None:
+                            lua_data.append(len(removed))
+                            lua_data.extend(removed)
                         processed.append(state.iid)
                     options = {'sm': sm, 'iids': processed}
-                    pipe.script_call('commit_session',
-                                     (bk,bk+':*'), *lua_data, **options)
+                    keys = (bk, bk+':*') + self.notify_keys(meta)
+                    pipe.script_call('commit_session', keys, *lua_data,
+                                     **options)
+        results = []
+        infos = []
+        for pipe in pipes:
+            info, result = redis_execution(pipe, (session_result,
+                                                  delete_result))
+            infos.append(info)
+            results.extend(result)
+        return callback(self.resume_deletes(results),
+                        merge_request_info(infos))
+    
+    def script_slices(self, instances):
+        '''Split *instances* into tuples of at most :attr:`script_slice`
+elements.'''
+        size = self.script_slice or len(instances) or 1
+        for start in range(0, len(instances), size):
+            yield instances[start:start+size]
+            
+    def resume_deletes(self, results):
+        # Generator of session results. Deletes which did not process all
+        # the ids are resumed with one script call for each slice.
+        for result in results:
+            if isinstance(result, delete_result):
+                while True:
+                    for r in result.results:
+                        yield r
+                    if not result.remaining:
+                        break
+                    keys, args, metas = result.resume
+                    args = list(args)
+                    args[2] = 0
+                    result = self.client.script_call('delete_query', keys,
+                                                     *args, metas=metas,
+                                                     resume=result.resume)
+            else:
+                yield result
     
-        command, result = redis_execution(pipe, session_result)
-        return callback(result, command)
+    def update_query(self, backend_query, data, removed, score='',
+                     chunk_size=1000):
+        '''Update the fields of all instances matched by *backend_query*
+without loading them. The ids are processed in chunks of *chunk_size* so that
+each script call runs in a bounded time.
+
+:parameter data: dictionary of serialized values to set.
+:parameter removed: list of fields to remove.
+:parameter score: the new score if the ordering field is updated.
+:rtype: a two elements tuple containing the list of updated ids and the list
+    of errors.'''
+        meta = backend_query.meta
+        indices = list(self.flat_indices(meta))
+        data = flat_mapping(data)
+        lua_data = ['z' if meta.ordering else 's', score, len(indices)//2]
+        lua_data.extend(indices)
+        lua_data.append(len(data))
+        lua_data.extend(data)
+        lua_data.append(len(removed))
+        lua_data.extend(removed)
+        lua_data.extend(self.changelog_info(meta))
+        ids = []
+        errors = []
+        for updated, failures, processed in self.query_chunks(
+                backend_query, 'update_query', lua_data, chunk_size):
+            ids.extend(updated)
+            errors.extend(failures)
+        return ids, errors
+    
+    def incr_field(self, meta, field, delta, backend_query=None, ids=None,
+                   chunk_size=1000):
+        '''Atomically increment the numeric *field* by *delta* for the
+instances matched by *backend_query* or with the given *ids*. Indices are
+updated by the server.
+
+:rtype: a list of two elements tuples containing the id and the new value.'''
+        s = 'z' if meta.ordering else 's'
+        rescore = meta.ordering and meta.ordering.field is field
+        indices = ()
+        if rescore:
+            indices = [idx.attname for idx in\
+                       chain(meta.indices, meta.composite_indices)\
+                       if not (idx.unique or idx.bitmap) and idx is not field]
+        index = 0
+        if field.index:
+            index = 2 if field.bitmap else 1
+            if field.counts:
+                index += 10
+        lua_data = [field.attname, delta,
+                    'f' if field.python_type is float else 'i', s,
+                    index, 1 if rescore else 0, 1 if field.sort_index else 0]
+        lua_data.extend(self.changelog_info(meta))
+        lua_data.append(len(indices))
+        lua_data.extend(indices)
+        result = []
+        if backend_query is None:
+            bk = self.basekey(meta)
+            lua_data.extend(ids)
+            values, _ = self.client.script_call('incr_field', (bk,), 0, 0,
+                                                *lua_data)
+            result.extend(values)
+        else:
+            for values, _ in self.query_chunks(backend_query, 'incr_field',
+                                               lua_data, chunk_size):
+                result.extend(values)
+        return list(zip(result[::2], result[1::2]))
+    
+    def load_unique(self, meta, field, value, fields=None, readonly=False):
+        '''Load the instance of model *meta* with the serialized *value*
+of the unique *field* in one call.
+
+:parameter fields: optional fields to load.
+:parameter readonly: if ``True`` a :class:`stdnet.odm.Record` is loaded.
+:rtype: a list with the instance, empty if the instance does not exist.'''
+        if fields:
+            fields = tuple(set(fields))
+            if fields == ('id',):
+                fields_attributes = fields
+            else:
+                fields, fields_attributes = meta.backend_fields(fields)
+        else:
+            fields = None
+            fields_attributes = ()
+        name = '' if field is meta.pk else field.attname
+        options = {'meta': meta, 'backend': self, 'fields': fields,
+                   'fields_attributes': fields_attributes,
+                   'readonly': readonly}
+        return self.client.script_call('load_unique', (self.basekey(meta),),
+                                       name, value,
+                                       'z' if meta.ordering else 's',
+                                       len(fields_attributes),
+                                       *fields_attributes, **options)
+    
+    def prefetch(self, field, ids, target=None):
+        '''Load the instances related to each of *ids* by the foreign key
+*field* in one call. If *target* is given, the model of *field* is a through
+model and the instances of the model of the foreign key *target* are loaded.
+
+:rtype: a list containing the list of related instances of each id.'''
+        meta = field.model._meta
+        tbk, tname = '', ''
+        if target is not None:
+            tbk = self.basekey(target.relmodel._meta)
+            tname = target.attname
+        rmeta = target.relmodel._meta if target is not None else meta
+        return self.client.script_call('load_prefetch', (self.basekey(meta),),
+                                       field.attname, tbk, tname, *ids,
+                                       meta=rmeta, backend=self)
+        
+    def notify_keys(self, meta):
+        # The channel where commit scripts publish the ids of committed
+        # instances of models with an instance cache and the change log
+        # key. Empty strings are passed for the disabled ones.
+        if meta.cache is None and not meta.changelog:
+            return ()
+        channel = self.invalidation_channel(meta) if meta.cache else ''
+        log = self.changelog_key(meta) if meta.changelog else ''
+        return (channel, log)
+    
+    def changelog_key(self, meta):
+        return self.basekey(meta, 'log')
+    
+    def changelog_info(self, meta):
+        # The change log key and size passed to the update scripts, an
+        # empty key and 0 if the model has no change log.
+        if meta.changelog:
+            return (self.changelog_key(meta), meta.changelog)
+        return ('', 0)
+    
+    def read_changes(self, meta, count):
+        '''Read at most *count* records from the head of the change log
+of model *meta*.
+
+:rtype: a list of ``(seq, id, action, fields, score)`` tuples.'''
+        records = self.client.lrange(self.changelog_key(meta), 0, count - 1)
+        return [tuple(json.loads(to_string(r))) for r in records]
+    
+    def ack_changes(self, meta, seq):
+        '''Remove the records of the change log of model *meta* with
+sequence number up to *seq*. Return the number of records removed.'''
+        return self.client.script_call('changelog_ack',
+                                       (self.changelog_key(meta),), seq)
+        
+    def invalidate(self, meta, ids):
+        if meta.cache is not None and ids:
+            meta.cache.evict(self, ids)
+            self.client.execute_command('PUBLISH',
+                                        self.invalidation_channel(meta),
+                                        ','.join((to_string(id) for id in ids)))
+        
+    def load_fields(self, meta, ids, fields):
+        '''Load the serialized values of the attribute names *fields* of the
+instances of model *meta* with *ids*, with one pipelined ``HMGET`` for each
+instance.
+
+:rtype: a list containing the list of values of each id.'''
+        pipe = self.client.pipeline()
+        for id in ids:
+            pipe.hmget(self.basekey(meta, OBJ, id), *fields)
+        return pipe.execute()
+        
+    def field_counts(self, meta, field):
+        '''The dictionary of values of the counted *field* and the number of
+instances with that value, read from the index counts in one call. Return
+``None`` if the counts are not complete.'''
+        pipe = self.client.pipeline()
+        pipe.sismember(self.basekey(meta, COUNTED), field.attname)
+        pipe.hgetall(self.basekey(meta, CNT, field.attname))
+        complete, counts = pipe.execute()
+        if complete:
+            return dict(((k, int(v)) for k, v in counts))
+    
+    def set_counts_complete(self, meta, attnames):
+        if attnames:
+            self.client.sadd(self.basekey(meta, COUNTED), *attnames)
+    
+    def index_complete(self, meta, index):
+        # Once complete, an index is kept complete by the commit scripts and
+        # the answer is cached.
+        key = self.basekey(meta, BUILT)
+        if (key, index.attname) in self._complete_indices:
+            return True
+        if self.client.sismember(key, index.attname):
+            self._complete_indices.add((key, index.attname))
+            return True
+        return False
+    
+    def set_indices_complete(self, meta, attnames):
+        if attnames:
+            self.client.sadd(self.basekey(meta, BUILT), *attnames)
+    
+    def query_chunks(self, backend_query, script, lua_data, chunk_size):
+        '''Generator of results of *script* called on chunks of *chunk_size*
+ids of *backend_query*. The script receives the model base key and a list
+key containing the ids, followed by the start and stop of the chunk and
+*lua_data*. The last element of the script result must be the number of ids
+processed.'''
+        meta = backend_query.meta
+        bk = self.basekey(meta)
+        key = self.tempkey(meta)
+        client = self.client
+        # Snapshot the query ids into a list so that chunks are stable
+        client.sort(backend_query.query_key, by='nosort', store=key)
+        try:
+            start = 0
+            while True:
+                result = client.script_call(script, (bk, key), start,
+                                            start + chunk_size - 1, *lua_data)
+                yield result
+                if result[-1] < chunk_size:
+                    break
+                start += chunk_size
+        finally:
+            client.delete(key)
     
     def accumulate_delete(self, pipe, backend_query):
-        # Accumulate models queries for a delete. It loops through the
-        # related models to build related queries.
-        # We pass the pipe since the backend_query may have been evaluated
-        # using a different pipe
+        # Delete a query and, in cascade, the instances of the related models
+        # with one script call. The relation graph of the model is collected
+        # breadth-first and passed to the script which walks it depth-first
+        # on the server. We pass the pipe since the backend_query may have been
+        # evaluated using a different pipe
         if backend_query is None:
             return
         query = backend_query.queryelem
         meta = query.meta
         bk = self.basekey(meta)
-        s = 'z' if meta.ordering else 's'
-        recursive = []
-        rel_managers = []
-        for name in meta.related:
-            rmanager = getattr(meta.model,name)
-            if rmanager.model == meta.model:
-                pipe.script_call('add_recursive',
-                                 (bk, backend_query.query_key, bk + ':*'),
-                                 s, rmanager.field.attname)
-            else:
-                rel_managers.append(rmanager)
-        
-        for rmanager in rel_managers:
-            rq = rmanager.query_from_query(query).backend_query(pipe = pipe)
-            self.accumulate_delete(pipe, rq)
-        indices = list(self.flat_indices(meta))
-        multi_fields = [field.name for field in meta.multifields]
-        keys = (bk, backend_query.query_key, bk + ':*')
-        lua_data = [s, len(indices)//2]
-        lua_data.extend(indices)
-        lua_data.append(len(multi_fields))
-        lua_data.extend(multi_fields)
-        options = {'meta':meta}
-        pipe.script_call('delete_query', keys, *lua_data, **options)
+        metas = [meta]
+        positions = {meta.model: 1}
+        lua_data = []
+        for rmeta in metas:
+            related = []
+            for name in rmeta.related:
+                rmanager = getattr(rmeta.model, name)
+                model = rmanager.model
+                if model not in positions:
+                    metas.append(model._meta)
+                    positions[model] = len(metas)
+                field = rmanager.field
+                flag = 2 if field.bitmap else (1 if field.index else 0)
+                if not flag and self.script_slice:
+                    # Related instances are found by scanning the model,
+                    # which is not bounded by the script slice
+                    raise QuerySetError('Cannot delete {0} in slices, the\
+ foreign key "{1}" of {2} has no index.'.format(meta, field.name,
+                                                model._meta))
+                related.extend((positions[model], field.attname, flag))
+            indices = list(self.flat_indices(rmeta))
+            multi_fields = [field.name for field in rmeta.multifields]
+            lua_data.extend((self.basekey(rmeta),
+                             'z' if rmeta.ordering else 's',
+                             len(indices)//2))
+            lua_data.extend(indices)
+            lua_data.append(len(multi_fields))
+            lua_data.extend(multi_fields)
+            lua_data.append(rmeta.changelog or 0)
+            lua_data.extend(self.notify_keys(rmeta) or ('', ''))
+            lua_data.append(len(related)//3)
+            lua_data.extend(related)
+        keys = (bk, backend_query.query_key, bk + ':*', self.tempkey(meta))
+        args = [self.script_slice, backend_query.expire, 1, len(metas)]
+        args.extend(lua_data)
+        pipe.script_call('delete_query', keys, *args, metas=metas,
+                         resume=(keys, args, metas))
         return query
     
     def tempkey(self, meta, name = None):
@@ -915,9 +1723,124 @@ class BackendDataServer(stdnet.BackendDataServer):
         if pattern:
             return self.client.delpattern(pattern)
         
-    def clean(self, meta):
-        return self.client.delpattern(self.tempkey(meta, '*'))
+    def clean(self, meta, count=1000):
+        '''Remove the temporary keys of *meta*, such as the keys of queries
+not yet expired. Keys are found with ``SCAN`` in batches of about *count*
+keys, so that, unlike ``KEYS``, the server is not blocked. Return the number
+of keys removed.'''
+        pattern = self.tempkey(meta, '*')
+        client = self.client
+        cursor, removed = 0, 0
+        while True:
+            cursor, keys = client.scan(cursor, match=pattern, count=count)
+            if keys:
+                client.delete(*keys)
+                removed += len(keys)
+            if not cursor:
+                return removed
             
+    def index_flags(self, meta, fields=None):
+        # Pairs of index attribute names and flags, as in flat_indices,
+        # restricted to the attribute names in fields if given
+        flat = list(self.flat_indices(meta))
+        n = len(flat)//2
+        pairs = zip(flat[:n], flat[n:])
+        if fields is not None:
+            pairs = [(name, flag) for name, flag in pairs if name in fields]
+        return list(pairs)
+    
+    def scan_instances(self, meta, cursor=0, count=1000):
+        '''Scan the instance hashes of *meta* with ``SCAN``, starting at
+*cursor* and returning about *count* keys. Return a two elements tuple with
+the next cursor, 0 when the scan is complete, and the list of ids found.'''
+        prefix = self.basekey(meta, OBJ, '')
+        suffixes = tuple((':' + f.name for f in meta.multifields))
+        cursor, keys = self.client.scan(cursor, match=prefix + '*',
+                                        count=count)
+        ids = [k[len(prefix):] for k in keys\
+               if not (suffixes and k.endswith(suffixes))]
+        return cursor, ids
+    
+    def rebuild_indices(self, meta, ids, fields=None):
+        '''Add the instances of *meta* with *ids* to the indices of the
+attribute names *fields*, all indices if not given, in one script call.
+Entries already in an index are not changed. Return the number of index
+entries added and the list of unique constraints violated.'''
+        flags = self.index_flags(meta, fields)
+        if not ids or not flags:
+            return 0, []
+        args = ['z' if meta.ordering else 's', len(flags)]
+        args.extend((name for name, _ in flags))
+        args.extend((flag for _, flag in flags))
+        args.extend(ids)
+        return self.client.script_call('index_rebuild', (self.basekey(meta),),
+                                       *args)
+    
+    def scan_indices(self, meta, cursor=0, count=1000):
+        '''Scan the keys of *meta* with ``SCAN`` as :meth:`scan_instances`.
+Return a two elements tuple with the next cursor and the list of index keys
+found: the keys of indices, unique indices, bitmap indices, sort indices
+and counts.'''
+        bk = self.basekey(meta)
+        prefixes = tuple((self.basekey(meta, p, '')\
+                          for p in (IDX, UNI, BIT, SRT, CNT)))
+        cursor, keys = self.client.scan(cursor, match=bk + ':*', count=count)
+        return cursor, [k for k in keys if k.startswith(prefixes)]
+    
+    def check_index(self, meta, key, cursor=0, count=1000, fix=False):
+        '''Check about *count* entries, starting at *cursor*, of the index
+*key* of *meta* as returned by :meth:`scan_indices`. Entries are stale if
+the instance they refer to does not exist or has a different value. When
+*fix* is ``True`` stale entries are removed, sort index entries are
+rescored and counts are set to the number of instances.
+
+:rtype: a three elements tuple with the next cursor, the number of entries
+    checked and a list of ``(key, entry)`` stale entries, or ``None`` if *key*
+    is not the key of an index of *meta*.'''
+        bk = self.basekey(meta)
+        kind, name = key[len(bk)+1:].split(':', 1)
+        value = ''
+        if kind in (IDX, BIT):
+            name, value = name.split(':', 1)
+        # A field can have more than one index, for example an index and a
+        # sort index, the flag is the one of the index of this kind
+        for _, flag in self.index_flags(meta, (name,)):
+            index = flag % 10
+            if (kind == IDX and index == 0) or (kind == UNI and index == 1)\
+                    or (kind == BIT and index == 2)\
+                    or (kind == SRT and index > 2)\
+                    or (kind == CNT and flag >= 10):
+                break
+        else:
+            return
+        s = 'z' if meta.ordering else 's'
+        client = self.client
+        entries = ()
+        if kind == BIT:
+            cursor = 0
+        elif kind in (UNI, CNT):
+            cursor, pairs = client.hscan(key, cursor, count=count)
+            entries = [f for f, _ in pairs]
+        elif kind == SRT or s == 'z':
+            cursor, pairs = client.zscan(key, cursor, count=count)
+            entries = [v for v, _ in pairs]
+        else:
+            cursor, entries = client.sscan(key, cursor, count=count)
+        fix = 1 if fix else 0
+        # For counts, only values with no instances are checked here. The
+        # counts of other values are checked with their index.
+        checked, stale = client.script_call('index_check', (bk, key), s,
+                                            kind, name,
+                                            '1' if kind == CNT else value,
+                                            flag, fix, *entries, key=key)
+        if not cursor and flag >= 10 and kind != CNT:
+            ckey = self.basekey(meta, CNT, name)
+            _, cstale = client.script_call('index_check', (bk, ckey), s, CNT,
+                                           name, '', flag, fix, value,
+                                           key=ckey)
+            stale.extend(cstale)
+        return cursor, checked, stale
+    
     def model_keys(self, meta):
         pattern = '{0}*'.format(self.basekey(meta))
         return self.client.keys(pattern)            
@@ -0,0 +1,39 @@
+-- Utilities for bitmap indices. A bitmap index stores, for each value of
+-- a field, a string where bit n is set if the instance with id n has
+-- that value.
+
+-- Return the list of ids with a bit set in the bitmap at key
+local function bitmap_members(key)
+    local ids = {}
+    local bits = redis.call('get', key)
+    if bits then
+        for i = 1, # bits do
+            local byte = bits:byte(i)
+            local mask = 128
+            local b = 0
+            while byte > 0 do
+                if byte >= mask then
+                    byte = byte - mask
+                    table.insert(ids, 8*(i-1) + b)
+                end
+                mask = mask / 2
+                b = b + 1
+            end
+        end
+    end
+    return ids
+end
+
+-- Set or clear the bit of id in the bitmap index for field name and value.
+-- Return 1 if the bit was changed, 0 otherwise.
+local function bitmap_update(bk, name, value, id, add)
+    local key = bk .. ':bit:' .. name .. ':'
+    if value then
+        key = key .. value
+    end
+    if add then
+        return 1 - redis.call('setbit', key, id, 1)
+    else
+        return redis.call('setbit', key, id, 0)
+    end
+end
@@ -0,0 +1,51 @@
+-- Script to evaluate a query on bitmap indices without materialising ids
+-- The query is a list of instructions, each one storing a bitmap at dest:
+--      'set', dest, name, N, value1, ..., valueN
+--      'and'|'or'|'diff', dest, N, key1, ..., keyN
+-- The last instruction stores the result at KEYS[2], intermediate
+-- results are removed. It returns the number of bits set in the result.
+local bk = KEYS[1] -- base key for model
+local rkey = KEYS[2] -- the key where to store the resulting bitmap
+local expire = ARGV[1] + 0
+local temps = {}
+local i = 1
+local n
+while i < # ARGV do
+    local op = ARGV[i+1]
+    local dest = ARGV[i+2]
+    local srcs = {}
+    if op == 'set' then
+        local name = ARGV[i+3]
+        n = ARGV[i+4] + 0
+        for _,value in ipairs(tabletools.slice(ARGV,i+5,i+4+n)) do
+            table.insert(srcs, bk .. ':bit:' .. name .. ':' .. value)
+        end
+        i = i + 4 + n
+        op = 'or'
+    else
+        n = ARGV[i+3] + 0
+        srcs = tabletools.slice(ARGV,i+4,i+3+n)
+        i = i + 3 + n
+    end
+    if op == 'diff' then
+        -- dest = first AND NOT (OR of the others)
+        local length = redis.call('strlen', srcs[1]) + 0
+        redis.call('bitop', 'or', dest, unpack(tabletools.slice(srcs,2)))
+        if length > redis.call('strlen', dest) + 0 then
+            -- pad so that NOT covers all the bits of the first bitmap
+            redis.call('setbit', dest, 8*length - 1, 0)
+        end
+        redis.call('bitop', 'not', dest, dest)
+        redis.call('bitop', 'and', dest, srcs[1], dest)
+    else
+        redis.call('bitop', op, dest, unpack(srcs))
+    end
+    if dest ~= rkey then
+        table.insert(temps, dest)
+    end
+end
+if # temps > 0 then
+    redis.call('del', unpack(temps))
+end
+redis.call('expire', rkey, expire)
+return redis.call('bitcount', rkey)
@@ -3,7 +3,7 @@ local bk = KEYS[1] -- base key for model
 local rkey = KEYS[2] -- the key where to store the structure containing the resuls
 local s = ARGV[1] -- 's' for set or 'z' for sorted sets
 local name = ARGV[2] -- Field name
-local unique = ARGV[3] -- 'u' if field is unique '' otherwise
+local unique = ARGV[3] -- 'u' if field is unique, 'b' for bitmap index, '' otherwise
 local lookup = ARGV[4] -- Not yet used
 
 
@@ -35,6 +35,13 @@ local function add (val)
 	end
 end
 
+-- Add the ids in the bitmap index for value val to the 'rkey' set
+local function addbitmap (val)
+	for _,id in ipairs(bitmap_members(bk .. ':bit:' .. name .. ':' .. val)) do
+		add(id)
+	end
+end
+
 -- Add values stored at key to the 'rkey' set. `oper` is the operation
 -- to perform for the values in container at `key` (either add or union)
 local function addkey(key, oper)
@@ -77,6 +84,12 @@ while i < # ARGV do
 		else
 			add(redis.call('hget', mapkey, val))
 		end
+	elseif unique == 'b' then
+		if what == 'key' then
+		    addkey(val, addbitmap)
+		else
+			addbitmap(val)
+		end
 	elseif what == 'key' then
 	    addkey(val, union)
 	else
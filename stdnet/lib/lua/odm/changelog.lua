@@ -0,0 +1,13 @@
+-- Utilities for the change log of a model. The list at key log contains
+-- the JSON encoded records [seq, id, action, fields, score] of committed
+-- writes, where fields is the comma separated list of fields changed and
+-- seq is an increasing sequence number used by consumers to acknowledge
+-- the records processed. The list is capped at size records.
+local function changelog_append(log, size, id, action, fields, score)
+    local seq = redis.call('incr', log .. ':seq')
+    local record = {seq, id, action, table.concat(fields, ','), score}
+    redis.call('rpush', log, cjson.encode(record))
+    if size > 0 then
+        redis.call('ltrim', log, -size, -1)
+    end
+end
@@ -0,0 +1,15 @@
+-- ACKNOWLEDGE RECORDS OF A CHANGE LOG
+-- Remove the records at the head of the change log with sequence number
+-- up to ARGV[1] and return the number of records removed.
+local log = KEYS[1]
+local seq = ARGV[1] + 0
+local removed = 0
+while true do
+    local head = redis.call('lindex', log, 0)
+    if not head or cjson.decode(head)[1] > seq then
+        break
+    end
+    redis.call('lpop', log)
+    removed = removed + 1
+end
+return removed
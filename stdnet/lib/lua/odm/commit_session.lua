@@ -19,45 +19,75 @@ end
 i = idx1 + 2*length_indices
 local indices = tabletools.slice(ARGV,idx1+1,idx1+length_indices)
 local uniques = tabletools.slice(ARGV,idx1+length_indices+1,i)
+local counted = index_counts(uniques)
+-- Size of the change log at KEYS[4], 0 if the model has no change log
+local log_size = ARGV[i+1] + 0
+i = i + 1
 local idset = bk .. ':id'
 local j = 0
+-- The counts, composite and sort indices of a model without instances are
+-- complete. Mark them so that queries can use them.
+if redis.call('exists', idset) + 0 == 0 then
+    for c, name in ipairs(indices) do
+        if counted[c] then
+            redis.call('sadd', bk .. ':counted', name)
+        end
+        if name:find(',') or sort_kinds[uniques[c]] then
+            redis.call('sadd', bk .. ':built', name)
+        end
+    end
+end
 local result = {}
 
 -- Add or remove indices for an instance.
+-- If the optional table `only` is given, only indices of fields in `only`
+-- are updated.
 -- Return nothing if the update was succesful otherwise it returns the
 -- error message (constaints were violated)
-local function update_indices(score, id, idkey, oldid, add)
+local function update_indices(score, id, idkey, oldid, add, only)
     local errors = {}
     local idxkey
     for i,name in pairs(indices) do
-        local value = redis.call('hget', idkey, name)
-        if uniques[i] == '1' then
-            idxkey = bk .. ':uni:' .. name
-            if add then
-                if redis.call('hsetnx', idxkey, value, id) + 0 == 0 then
-                    if oldid == id or not redis.call('hget', idxkey, value) == oldid then
-	                    -- remove field `name` from the instance hashtable so that
-	                    -- the next call to update_indices won't delete the index
-	                    redis.call('hdel', idkey, name)
-	                    table.insert(errors, 'Unique constraint "' .. name .. '" violated.')
-	                end
+        if not only or index_changed(only, name) then
+            local value = index_value(idkey, name)
+            if uniques[i] == '1' then
+                idxkey = bk .. ':uni:' .. name
+                if add then
+                    if redis.call('hsetnx', idxkey, value, id) + 0 == 0 then
+                        if oldid == id or not redis.call('hget', idxkey, value) == oldid then
+                            -- remove field `name` from the instance hashtable so that
+                            -- the next call to update_indices won't delete the index
+                            redis.call('hdel', idkey, name)
+                            table.insert(errors, 'Unique constraint "' .. name .. '" violated.')
+                        end
+                    end
+                else
+                    redis.call('hdel', idxkey, value)
                 end
+            elseif sort_kinds[uniques[i]] then
+                sort_index_update(bk, name, sort_kinds[uniques[i]], value, id, add)
             else
-                redis.call('hdel', idxkey, value)
-            end
-        else
-            idxkey = bk .. ':idx:' .. name .. ':'
-            if value then
-                idxkey = idxkey .. value
-            end
-            if add then
-                if s == 's' then
-                    redis.call('sadd', idxkey, id)
+                local changed
+                if uniques[i] == '2' then
+                    changed = bitmap_update(bk, name, value, id, add)
                 else
-                    redis.call('zadd', idxkey, score, id)
+                    idxkey = bk .. ':idx:' .. name .. ':'
+                    if value then
+                        idxkey = idxkey .. value
+                    end
+                    if add then
+                        if s == 's' then
+                            changed = redis.call('sadd', idxkey, id)
+                        else
+                            changed = redis.call('zadd', idxkey, score, id)
+                        end
+                    else
+                        changed = redis.call(s .. 'rem', idxkey, id)
+                    end
+                end
+                if counted[i] and changed + 0 == 1 then
+                    count_update(bk, name, value, add and 1 or -1)
                 end
-            else
-                redis.call(s .. 'rem', idxkey, id)
             end
         end
     end
@@ -104,6 +134,14 @@ while j < num_instances do
     end
     j = j + 1
     i = idx0 + length_data
+    -- Update action. Only changed fields are sent, followed by the
+    -- fields to remove from the instance hashtable.
+    local removed = {}
+    if action == 'u' then
+        local length_removed = ARGV[i+1] + 0
+        removed = tabletools.slice(ARGV,i+2,i+1+length_removed)
+        i = i + 1 + length_removed
+    end
 
     -- AUTO ID
     if auto_id then
@@ -127,7 +165,33 @@ while j < num_instances do
         local oldid = id
 	    local idkey = bk .. ':obj:' .. oldid
 	    local original_values = {}
-	    if action == 'o' or action == 'c' then  -- override or change
+	    local changed = nil
+	    local changed_names = {}
+	    if action == 'u' then  -- update changed fields only
+	        changed = {}
+	        local k = 0
+	        while k < # data do
+	            table.insert(changed_names, data[k+1])
+	            k = k + 2
+	        end
+	        for _,name in ipairs(removed) do
+	            table.insert(changed_names, name)
+	        end
+	        if # changed_names > 0 then
+	            local values = redis.call('hmget', idkey, unpack(changed_names))
+	            for k,name in ipairs(changed_names) do
+	                changed[name] = true
+	                if values[k] then
+	                    table.insert(original_values, name)
+	                    table.insert(original_values, values[k])
+	                end
+	            end
+	            update_indices(score, id, idkey, oldid, false, changed)
+	        end
+	        if # removed > 0 then
+	            redis.call('hdel', idkey, unpack(removed))
+	        end
+	    elseif action == 'o' or action == 'c' then  -- override or change
 	        original_values = redis.call('hgetall', idkey)
 	        update_indices(score, id, idkey, oldid, false)
 	        if action == 'o' then
@@ -156,11 +220,13 @@ while j < num_instances do
 	    if length_data > 0 then
 	        redis.call('hmset', idkey, unpack(data))
 	    end
-	    errors = update_indices(score, id, idkey, oldid, true)
+	    if action ~= 'u' or # changed_names > 0 then
+	        errors = update_indices(score, id, idkey, oldid, true, changed)
+	    end
 	    -- An error has occured. Rollback changes.
 	    if # errors > 0 then
 	        -- Remove indices
-	        update_indices(score, id, idkey, oldid, false)
+	        update_indices(score, id, idkey, oldid, false, changed)
 	        if action == 'a' then
 	            redis.call('del', idkey)
 	            redis.call(s .. 'rem', idset, id)
@@ -168,6 +234,12 @@ while j < num_instances do
 	                redis.call('decr', bk .. ':ids')
 	                id = ''
 	            end
+	        elseif action == 'u' then
+	            redis.call('hdel', idkey, unpack(changed_names))
+	            if # original_values > 0 then
+	                redis.call('hmset', idkey, unpack(original_values))
+	            end
+	            update_indices(score, id, idkey, oldid, true, changed)
 	        elseif # original_values > 0 then
 	            id = oldid
                 idkey = bk .. ':obj:' .. id
@@ -175,6 +247,17 @@ while j < num_instances do
 	            update_indices(score, id, idkey, oldid, true)
 	        end
 	    end
+	    if log_size > 0 and # errors == 0 then
+	        local fields = changed_names
+	        if action ~= 'u' then
+	            fields = {}
+	            for k = 1, # data, 2 do
+	                table.insert(fields, data[k])
+	            end
+	        end
+	        changelog_append(KEYS[4], log_size, id,
+	                         action == 'a' and 'add' or 'update', fields, score)
+	    end
 	end
 	if # errors > 0 then
         result[j] = {id, 0, errors[1]}
@@ -183,4 +266,17 @@ while j < num_instances do
     end
 end
 
+-- Publish the ids of committed instances for the instance caches
+if KEYS[3] and KEYS[3] ~= '' then
+    local ids = {}
+    for _,r in ipairs(result) do
+        if r[2] == 1 and r[1] ~= '' then
+            table.insert(ids, r[1])
+        end
+    end
+    if # ids > 0 then
+        redis.call('publish', KEYS[3], table.concat(ids, ','))
+    end
+end
+
 return result
@@ -0,0 +1,40 @@
+-- Utilities for composite indices. The name of a composite index is the
+-- comma separated list of the fields it indexes and its value is given by
+-- the values of the fields joined by colons. Backslashes and colons in the
+-- values are escaped with a backslash.
+
+-- Escape a value of a field in a composite index
+local function index_escape(value)
+    return (value:gsub('\\', '\\\\'):gsub(':', '\\:'))
+end
+
+-- Return the value of the index name for the instance hash at idkey
+local function index_value(idkey, name)
+    if name:find(',') then
+        local names = {}
+        for n in name:gmatch('[^,]+') do
+            table.insert(names, n)
+        end
+        local values = redis.call('hmget', idkey, unpack(names))
+        for i = 1, # names do
+            values[i] = index_escape(values[i] or '')
+        end
+        return table.concat(values, ':')
+    else
+        return redis.call('hget', idkey, name)
+    end
+end
+
+-- Return true if the index name depends on a field in the table changed
+local function index_changed(changed, name)
+    if changed[name] then
+        return true
+    elseif name:find(',') then
+        for n in name:gmatch('[^,]+') do
+            if changed[n] then
+                return true
+            end
+        end
+    end
+    return false
+end
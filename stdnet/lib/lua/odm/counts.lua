@@ -0,0 +1,26 @@
+-- Utilities for counted indices. The hash at bk:cnt:name maps each value
+-- of field name to the number of instances with that value.
+
+-- Index flags of counted fields are offset by 10. Return a table indicating
+-- which indices are counted and reset the flags to the index type.
+local function index_counts(flags)
+    local counted = {}
+    for i, flag in ipairs(flags) do
+        local f = flag + 0
+        counted[i] = f >= 10
+        if counted[i] then
+            flags[i] = tostring(f - 10)
+        end
+    end
+    return counted
+end
+
+-- Add delta to the count of value for field name. Values with no instances
+-- are removed from the hash.
+local function count_update(bk, name, value, delta)
+    local key = bk .. ':cnt:' .. name
+    value = value or ''
+    if redis.call('hincrby', key, value, delta) + 0 <= 0 then
+        redis.call('hdel', key, value)
+    end
+end
@@ -1,62 +1,278 @@
---DELETE A QUERY for a model
+-- DELETE A QUERY for a model and, in cascade, the instances of all models
+-- related to it via foreign keys.
+-- Instances are deleted after the instances related to them, so that no
+-- instance is left with a foreign key to a deleted instance when a call
+-- stops before the cascade is complete. The work left is stored in a list
+-- at KEYS[4], used as a stack of entries "m:e:id", to find the instances
+-- related to instance id of the model at position m, and "m:d:id", to
+-- delete it. A call processes at most ARGV[1] entries (0 for no limit) and
+-- can be resumed, with ARGV[3] set to 0, until no entries are left.
+-- ARGV[2] is the expiry of the keys of the entries left, ARGV[4] the number
+-- of models followed by the description of each model, the first being the
+-- model of the query:
+--      bk, s, N, index1, ..., indexN, flag1, ..., flagN,
+--      M, multifield1, ..., multifieldM, log_size, channel, log,
+--      R, model1, attname1, flag1, ..., modelR, attnameR, flagR
+-- where the last R triplets are the related models (their position in the
+-- list), the name of the foreign key and its index flag ('0' for no index,
+-- '1' for an index and '2' for a bitmap index). Foreign keys without index
+-- are only supported without limit.
+-- It returns a list with the deleted ids of each model and the number of
+-- entries left.
 
 -- Add or remove indices for an instance
-local function update_indices(s, bk, id, idkey, indices, uniques)
+local function update_indices(s, bk, id, idkey, indices, uniques, counted)
     local idxkey
     for i, name in pairs(indices) do
-        local value = redis.call('hget', idkey, name)
+        local value = index_value(idkey, name)
         if uniques[i] == '1' then
             idxkey = bk .. ':uni:' .. name
             redis.call('hdel', idxkey, value)
+        elseif sort_kinds[uniques[i]] then
+            sort_index_update(bk, name, sort_kinds[uniques[i]], value, id, false)
         else
-            idxkey = bk .. ':idx:' .. name .. ':'
-            if value then
-                idxkey = idxkey .. value
-            end
-            redis.call(s .. 'rem', idxkey, id)
-        end
-    end
-end
-
-local bk = KEYS[1] -- base key for model
-local rkey = KEYS[2] -- the key where to store the structure containing the resuls
-local s = ARGV[1]
-local length_indices = ARGV[2]
-local idx1 = 2
-local indices = tabletools.slice(ARGV,idx1+1,idx1+length_indices)
-local uniques = tabletools.slice(ARGV,idx1+length_indices+1,idx1+2*length_indices)
-idx1 = idx1 + 2*length_indices + 1
-local length_multifields = ARGV[idx1]
-local multifields = tabletools.slice(ARGV, idx1+1, idx1+length_multifields)
---i = idx1 + length_multifields
-local idset = bk .. ':id'
-local ty = redis.call('type',rkey)['ok']
-local ids
-if ty == 'set' then
-    ids = redis.call('smembers', rkey)
-elseif ty == 'zset' then
-    ids = redis.call('zrange', rkey, 0, -1)
-elseif ty == 'list' then
-    ids = redis.call('lrange', rkey, 0, -1)
-else
-	ids = {}
+            local removed
+            if uniques[i] == '2' then
+                removed = bitmap_update(bk, name, value, id, false)
+            else
+                idxkey = bk .. ':idx:' .. name .. ':'
+                if value then
+                    idxkey = idxkey .. value
+                end
+                removed = redis.call(s .. 'rem', idxkey, id)
+            end
+            if counted[i] and removed + 0 == 1 then
+                count_update(bk, name, value, -1)
+            end
+        end
+    end
+end
+
+local rkey = KEYS[2] -- the key containing the ids of the query
+local pending = KEYS[4] -- the stack of entries left
+local limit = ARGV[1] + 0
+local expire = ARGV[2] + 0
+local models = {}
+local i = 4
+for m = 1, ARGV[4] + 0 do
+    local model = {bk = ARGV[i+1], s = ARGV[i+2], related = {}}
+    local n = ARGV[i+3] + 0
+    i = i + 3
+    model.indices = tabletools.slice(ARGV, i+1, i+n)
+    model.uniques = tabletools.slice(ARGV, i+n+1, i+2*n)
+    model.counted = index_counts(model.uniques)
+    i = i + 2*n + 1
+    n = ARGV[i] + 0
+    model.multifields = tabletools.slice(ARGV, i+1, i+n)
+    i = i + n
+    -- Size of the change log, 0 if the model has no change log
+    model.log_size = ARGV[i+1] + 0
+    model.channel = ARGV[i+2]
+    model.log = ARGV[i+3]
+    n = ARGV[i+4] + 0
+    i = i + 4
+    for r = 1, n do
+        table.insert(model.related, {ARGV[i+1] + 0, ARGV[i+2], ARGV[i+3]})
+        i = i + 3
+    end
+    models[m] = model
+end
+
+local stack = pending
+local seen = pending .. ':seen' -- entries "m:id" of the instances expanded
+
+-- Maps of the ids of the instances of a model by the value of their foreign
+-- key, for foreign keys without index, keyed by position and attribute name
+local reverse = {}
+
+-- Ids of the instances of the model at position r whose foreign key
+-- attname points to one of the ids
+local function related_ids(r, attname, flag, ids)
+    local model = models[r]
+    local result = {}
+    if flag == '0' then
+        -- Not an index. The instances of the model are scanned once for
+        -- the whole delete, which is never sliced, and mapped by the value
+        -- of their foreign key.
+        local name = r .. ':' .. attname
+        local map = reverse[name]
+        if not map then
+            map = {}
+            for _,id in ipairs(redis_members(model.bk .. ':id')) do
+                local value = redis.call('hget', model.bk .. ':obj:' .. id,
+                                         attname)
+                if value and value ~= '' then
+                    local rids = map[value]
+                    if not rids then
+                        rids = {}
+                        map[value] = rids
+                    end
+                    table.insert(rids, id)
+                end
+            end
+            reverse[name] = map
+        end
+        for _,id in ipairs(ids) do
+            for _,rid in ipairs(map[id] or {}) do
+                table.insert(result, rid)
+            end
+        end
+    else
+        for _,id in ipairs(ids) do
+            local members
+            if flag == '2' then
+                members = bitmap_members(model.bk .. ':bit:' .. attname .. ':' .. id)
+            else
+                members = redis_members(model.bk .. ':idx:' .. attname .. ':' .. id)
+            end
+            for _,rid in ipairs(members) do
+                table.insert(result, tostring(rid))
+            end
+        end
+    end
+    return result
+end
+
+-- Push the entries of action ('e' or 'd') for ids of the model at
+-- position m on the stack
+local function push(m, action, ids)
+    local entries = {}
+    for _,id in ipairs(ids) do
+        table.insert(entries, m .. ':' .. action .. ':' .. id)
+    end
+    for k = 1, # entries, 1000 do
+        redis.call('rpush', stack, unpack(tabletools.slice(entries, k, k + 999)))
+    end
+end
+
+-- Push the deletion of the existing instances of the model at position m
+-- with ids and, above them, the instances related to them. Instances
+-- already expanded are skipped, so that self-relations and cycles
+-- terminate.
+local function expand(m, model, ids)
+    local existing = {}
+    for _,id in ipairs(ids) do
+        local entry = m .. ':' .. id
+        if redis.call('sismember', seen, entry) + 0 == 0 and
+                redis.call('exists', model.bk .. ':obj:' .. id) + 0 == 1 then
+            redis.call('sadd', seen, entry)
+            table.insert(existing, id)
+        end
+    end
+    if # existing > 0 then
+        push(m, 'd', existing)
+        for _,rel in ipairs(model.related) do
+            push(rel[1], 'e', related_ids(rel[1], rel[2], rel[3], existing))
+        end
+    end
 end
 
-local j = 0
+-- Instances related to the instances of the model at position m with ids
+-- which were not expanded, because they were committed after it, grouped
+-- by the position of their model. Return nil if there are none.
+local function not_expanded(m, model, ids)
+    local result
+    for _,rel in ipairs(model.related) do
+        local rmodel = models[rel[1]]
+        for _,rid in ipairs(related_ids(rel[1], rel[2], rel[3], ids)) do
+            if redis.call('sismember', seen, rel[1] .. ':' .. rid) + 0 == 0 and
+                    redis.call('exists', rmodel.bk .. ':obj:' .. rid) + 0 == 1 then
+                result = result or {}
+                result[rel[1]] = result[rel[1]] or {}
+                table.insert(result[rel[1]], rid)
+            end
+        end
+    end
+    return result
+end
+
+-- Delete the instances of the model at position m with ids. When a call is
+-- limited, instances related to them may have been committed by other
+-- clients since they were expanded, they are expanded and deleted first.
+local function delete_instances(m, model, ids, deleted)
+    if limit > 0 then
+        local related = not_expanded(m, model, ids)
+        if related then
+            push(m, 'd', ids)
+            for r, rids in pairs(related) do
+                push(r, 'e', rids)
+            end
+            return
+        end
+    end
+    local bk = model.bk
+    local s = model.s
+    local idset = bk .. ':id'
+    for _,id in ipairs(ids) do
+        local idkey = bk .. ':obj:' .. id
+        if redis.call('exists', idkey) + 0 == 1 then
+            update_indices(s, bk, id, idkey, model.indices, model.uniques,
+                           model.counted)
+            redis.call('del', idkey)
+            table.insert(deleted, id)
+            if model.log_size > 0 then
+                changelog_append(model.log, model.log_size, id, 'delete', {}, '')
+            end
+        end
+        redis.call(s .. 'rem', idset, id)
+        for _,name in ipairs(model.multifields) do
+            redis.call('del', idkey .. ':' .. name)
+        end
+    end
+end
+
+if ARGV[3] == '1' then
+    push(1, 'e', redis_members(rkey))
+end
+
+-- Walk the relation graph depth-first, processing together the entries at
+-- the top of the stack with the same model and action.
 local results = {}
--- Loop over query ids and remove all keys associated with instances and update indices
-for _,id in ipairs(ids) do
-    local idkey = bk .. ':obj:' .. id
-    update_indices(s, bk, id, idkey, indices, uniques)
-    local num = redis.call('del', idkey) + 0
-    redis.call(s .. 'rem', idset, id)
-    for _,name in ipairs(multifields) do
-        redis.call('del', idkey .. ':' .. name)
-    end 
-    if num == 1 then
-    	j = j + 1
-        results[j] = id
-    end
-end
-
-return results
\ No newline at end of file
+for m = 1, # models do
+    results[m] = {}
+end
+local processed = 0
+while limit == 0 or processed < limit do
+    local count = 1000
+    if limit > 0 then
+        count = math.min(count, limit - processed)
+    end
+    local entries = redis.call('lrange', stack, -count, -1)
+    if # entries == 0 then
+        break
+    end
+    local m, action = string.match(entries[# entries], '^(%d+):(%a):')
+    local ids = {}
+    for k = # entries, 1, -1 do
+        local em, eaction, id = string.match(entries[k], '^(%d+):(%a):(.*)$')
+        if em ~= m or eaction ~= action then
+            break
+        end
+        table.insert(ids, id)
+    end
+    redis.call('ltrim', stack, 0, -(# ids) - 1)
+    processed = processed + # ids
+    m = m + 0
+    if action == 'e' then
+        expand(m, models[m], ids)
+    else
+        delete_instances(m, models[m], ids, results[m])
+    end
+end
+
+-- Publish the ids of deleted instances for the instance caches
+for m, model in ipairs(models) do
+    if model.channel ~= '' and # results[m] > 0 then
+        redis.call('publish', model.channel, table.concat(results[m], ','))
+    end
+end
+
+local left = redis.call('llen', stack) + 0
+if left > 0 then
+    redis.call('expire', stack, expire)
+    redis.call('expire', seen, expire)
+else
+    redis.call('del', seen)
+end
+
+return {results, left}
@@ -0,0 +1,99 @@
+-- ATOMIC INCREMENT OF A NUMERIC FIELD
+-- Increment `field` by `delta` for a list of ids and move the ids between
+-- index values. If a second key is given, ids are taken from the list
+-- at that key from start to stop, otherwise they are the last arguments.
+local bk = KEYS[1] -- base key for model
+local start = ARGV[1] + 0
+local stop = ARGV[2] + 0
+local field = ARGV[3]
+local delta = ARGV[4]
+local float = ARGV[5] == 'f'
+local s = ARGV[6] -- 's' for sets, 'z' for zsets
+local index = ARGV[7] -- '1' if field is an index, '2' for a bitmap index
+local flags = {index}
+local counted = index_counts(flags)[1]
+index = flags[1]
+local rescore = ARGV[8] == '1' -- field is the ordering field
+local sorted = ARGV[9] == '1' -- field has a sort index
+local log = ARGV[10] -- change log key or empty
+local log_size = ARGV[11] + 0
+local length_indices = ARGV[12] + 0
+-- Other indices which need a new score when rescore is true
+local indices = tabletools.slice(ARGV,13,12+length_indices)
+local idset = bk .. ':id'
+local ids
+if # KEYS > 1 then
+    ids = redis.call('lrange', KEYS[2], start, stop)
+else
+    ids = tabletools.slice(ARGV,13+length_indices)
+end
+local idxkey = bk .. ':idx:' .. field .. ':'
+local result = {}
+for _,id in ipairs(ids) do
+    local idkey = bk .. ':obj:' .. id
+    if redis.call('exists', idkey) + 0 == 1 then
+        local old = redis.call('hget', idkey, field)
+        local value
+        if float then
+            value = redis.call('hincrbyfloat', idkey, field, delta)
+            -- keep the python representation of floats
+            if not value:find('[%.eEn]') then
+                value = value .. '.0'
+                redis.call('hset', idkey, field, value)
+            end
+        else
+            value = tostring(redis.call('hincrby', idkey, field, delta))
+        end
+        local score
+        if s == 'z' then
+            if rescore then
+                score = value
+                redis.call('zadd', idset, score, id)
+                -- bitmap indices have no score
+                for _,name in ipairs(indices) do
+                    local v = index_value(idkey, name)
+                    local key = bk .. ':idx:' .. name .. ':'
+                    if v then
+                        key = key .. v
+                    end
+                    redis.call('zadd', key, score, id)
+                end
+            else
+                score = redis.call('zscore', idset, id)
+            end
+        end
+        if sorted then
+            sort_index_update(bk, field, 'n', value, id, true)
+        end
+        if counted and old ~= value then
+            count_update(bk, field, old, -1)
+            count_update(bk, field, value, 1)
+        end
+        if index == '2' then
+            bitmap_update(bk, field, old, id, false)
+            bitmap_update(bk, field, value, id, true)
+        elseif index == '1' then
+            local oldkey = idxkey
+            if old then
+                oldkey = oldkey .. old
+            end
+            redis.call(s .. 'rem', oldkey, id)
+            if s == 's' then
+                redis.call('sadd', idxkey .. value, id)
+            else
+                redis.call('zadd', idxkey .. value, score, id)
+            end
+        end
+        if log_size > 0 then
+            changelog_append(log, log_size, id, 'update', {field}, score or '')
+        end
+        table.insert(result, id)
+        table.insert(result, value)
+    end
+end
+
+if # KEYS > 1 then
+    return {result, # ids}
+else
+    return {result, 0}
+end
@@ -0,0 +1,119 @@
+-- CHECK THE ENTRIES OF AN INDEX AGAINST THE INSTANCES OF THE MODEL
+-- KEYS[1] is the base key of the model and KEYS[2] the index key.
+-- ARGV: s, kind, name, value, flag, fix, entry1, ..., entryM
+-- where kind is one of
+--      'idx'   a set or zset index, the entries are ids
+--      'bit'   a bitmap index, the entries are read by the script
+--      'uni'   a unique index, the entries are values
+--      'srt'   a sort index, the entries are ids
+--      'cnt'   the counts of a field, the entries are values. If value is
+--              '1' only values with no instances are checked.
+-- An entry is stale if the instance it refers to does not exist or if its
+-- value for the index is different. Entries which are no longer in the
+-- index are skipped. When fix is '1' stale entries are removed, sort index
+-- entries are rescored and counts are set to the number of instances.
+-- It returns the number of entries checked and the list of stale entries.
+local bk = KEYS[1] -- base key for model
+local key = KEYS[2]
+local s = ARGV[1] -- 's' for sets, 'z' for zsets
+local kind = ARGV[2]
+local name = ARGV[3]
+local value = ARGV[4]
+local flags = {ARGV[5]}
+local counted = index_counts(flags)[1]
+local flag = flags[1]
+local fix = ARGV[6] == '1'
+local entries = tabletools.slice(ARGV, 7)
+local idset = bk .. ':id'
+
+-- Check if the instance with id exists
+local function exists(id)
+    local found
+    if s == 'z' then
+        found = redis.call('zscore', idset, id)
+    else
+        found = redis.call('sismember', idset, id) + 0 == 1
+    end
+    return found and redis.call('exists', bk .. ':obj:' .. id) + 0 == 1
+end
+
+-- Number of instances with value in the index of field name
+local function instances(v)
+    if flag == '2' then
+        return redis.call('bitcount', bk .. ':bit:' .. name .. ':' .. v)
+    else
+        return redis.call(s .. 'card', bk .. ':idx:' .. name .. ':' .. v)
+    end
+end
+
+if kind == 'bit' then
+    entries = bitmap_members(key)
+end
+local stale = {}
+for _,entry in ipairs(entries) do
+    local ok = true
+    if kind == 'cnt' then
+        local count = tonumber(redis.call('hget', key, entry) or 0)
+        local n = instances(entry)
+        if count ~= n and (value ~= '1' or n == 0) then
+            ok = false
+            if fix then
+                if n > 0 then
+                    redis.call('hset', key, entry, n)
+                else
+                    redis.call('hdel', key, entry)
+                end
+            end
+        end
+    elseif kind == 'uni' then
+        local id = redis.call('hget', key, entry)
+        if id then
+            ok = exists(id) and index_value(bk .. ':obj:' .. id, name) == entry
+            if fix and not ok then
+                redis.call('hdel', key, entry)
+            end
+        end
+    else
+        local id = tostring(entry)
+        local member
+        if kind == 'bit' then
+            member = true
+        elseif s == 's' and kind == 'idx' then
+            member = redis.call('sismember', key, id) + 0 == 1
+        else
+            member = redis.call('zscore', key, id)
+        end
+        if member then
+            local idkey = bk .. ':obj:' .. id
+            local remove = not exists(id)
+            ok = not remove
+            if ok and kind == 'srt' then
+                local score = sort_score(redis.call('hget', idkey, name), sort_kinds[flag])
+                ok = tonumber(member) == score
+                if fix and not ok then
+                    redis.call('zadd', key, score, id)
+                end
+            elseif ok then
+                ok = (index_value(idkey, name) or '') == value
+                remove = not ok
+            end
+            if fix and remove then
+                local removed
+                if kind == 'bit' then
+                    removed = redis.call('setbit', key, id, 0)
+                elseif kind == 'srt' then
+                    removed = redis.call('zrem', key, id)
+                else
+                    removed = redis.call(s .. 'rem', key, id)
+                end
+                if counted and removed + 0 == 1 then
+                    count_update(bk, name, value, -1)
+                end
+            end
+        end
+    end
+    if not ok then
+        table.insert(stale, tostring(entry))
+    end
+end
+return {# entries, stale}
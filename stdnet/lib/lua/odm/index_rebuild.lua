@@ -0,0 +1,65 @@
+-- REBUILD THE INDICES OF A BATCH OF INSTANCES
+-- Add the instances with ids given after the indices to the indices of the
+-- model. Entries already in an index are left untouched and counts are only
+-- incremented for new entries, so that the script can be called several
+-- times on the same instances while the database is in use.
+-- ARGV: s, N, index1, ..., indexN, flag1, ..., flagN, id1, ..., idM
+-- It returns the number of index entries added and the list of errors
+-- (unique constraints violated by existing instances).
+local bk = KEYS[1] -- base key for model
+local s = ARGV[1] -- 's' for sets, 'z' for zsets
+local length_indices = ARGV[2] + 0
+local indices = tabletools.slice(ARGV, 3, 2 + length_indices)
+local uniques = tabletools.slice(ARGV, 3 + length_indices, 2 + 2*length_indices)
+local counted = index_counts(uniques)
+local ids = tabletools.slice(ARGV, 3 + 2*length_indices)
+local idset = bk .. ':id'
+local added = 0
+local errors = {}
+for _,id in ipairs(ids) do
+    local idkey = bk .. ':obj:' .. id
+    local score
+    if s == 'z' then
+        score = redis.call('zscore', idset, id)
+    elseif redis.call('sismember', idset, id) + 0 == 1 then
+        score = 0
+    end
+    -- instances not in the id set are being added or deleted
+    if score and redis.call('exists', idkey) + 0 == 1 then
+        for i,name in ipairs(indices) do
+            local value = index_value(idkey, name)
+            local changed = 0
+            if uniques[i] == '1' then
+                if value then
+                    local idxkey = bk .. ':uni:' .. name
+                    if redis.call('hsetnx', idxkey, value, id) + 0 == 1 then
+                        changed = 1
+                    elseif redis.call('hget', idxkey, value) ~= id then
+                        table.insert(errors, id .. ': Unique constraint "' .. name .. '" violated.')
+                    end
+                end
+            elseif sort_kinds[uniques[i]] then
+                changed = sort_index_update(bk, name, sort_kinds[uniques[i]], value, id, true)
+            elseif uniques[i] == '2' then
+                changed = bitmap_update(bk, name, value, id, true)
+            else
+                local idxkey = bk .. ':idx:' .. name .. ':'
+                if value then
+                    idxkey = idxkey .. value
+                end
+                if s == 's' then
+                    changed = redis.call('sadd', idxkey, id)
+                else
+                    changed = redis.call('zadd', idxkey, score, id)
+                end
+            end
+            if changed + 0 == 1 then
+                added = added + 1
+                if counted[i] then
+                    count_update(bk, name, value, 1)
+                end
+            end
+        end
+    end
+end
+return {added, errors}
@@ -0,0 +1,33 @@
+-- LOAD THE INSTANCES RELATED TO A LIST OF IDS
+-- For each id, instance ids are read from the index of the foreign key
+-- field of the model at KEYS[1]. If a target model is given the model at
+-- KEYS[1] is a through model and the ids of the target model are read
+-- from the target field of its instances. Each instance is loaded once.
+local bk = KEYS[1] -- base key for model
+local field = ARGV[1]
+local tbk = ARGV[2] -- base key of the target model or empty
+local target = ARGV[3]
+local rbk = bk
+if tbk ~= '' then
+    rbk = tbk
+end
+local related = {}
+local data = {}
+local loaded = {}
+for i = 4, # ARGV do
+    local ids = {}
+    for _,id in ipairs(redis_members(bk .. ':idx:' .. field .. ':' .. ARGV[i])) do
+        if tbk ~= '' then
+            id = redis.call('hget', bk .. ':obj:' .. id, target)
+        end
+        if id then
+            if not loaded[id] then
+                loaded[id] = true
+                table.insert(data, {id, redis.call('hgetall', rbk .. ':obj:' .. id)})
+            end
+            table.insert(ids, id)
+        end
+    end
+    table.insert(related, ids)
+end
+return {related, data}
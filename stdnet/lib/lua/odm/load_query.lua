@@ -3,8 +3,9 @@ local function get_related_fields (args, i, num)
 	local all = {}
 	local count = 0
 	while count < num do
-		local related = {bk = args[i+1], name = args[i+2], field = args[i+3], type = args[i+4]}
-		i = i + 5
+		local related = {bk = args[i+1], name = args[i+2], field = args[i+3],
+						 type = args[i+4], parent = args[i+5] + 0}
+		i = i + 6
 		local nf = args[i] + 0
 		related['fields'] = tabletools.slice(args, i+1, i+nf)
 		i = i + nf
@@ -17,6 +18,7 @@ end
 -- Handle input arguments
 local rkey = KEYS[1]  -- Key containing the ids of the query
 local bk = KEYS[2] -- Base key for model
+local store = KEYS[3] -- Optional list where to store the ids, in order
 local get_field = ARGV[1]
 local ids
 local result
@@ -27,80 +29,400 @@ local related
 io = io + num_fields + 1
 related, io = unpack(get_related_fields(ARGV, io, ARGV[io] + 0))
 local ordering = ARGV[io+1]
+-- Python slice bounds, which can be negative. stop is empty when not given.
 local start = ARGV[io+2] + 0
-local stop = ARGV[io+3] + 0
+local stop = ARGV[io+3]
 io = io + 3
 
 if get_field ~= '' then
 	return redis_members(rkey)
 end
 
+-- Return count members of the set at key after skipping offset members,
+-- without reading the whole set.
+local function scan_members(key, offset, count)
+	local ids = {}
+	local processed = {}
+	local seen = 0
+	local cursor = '0'
+	repeat
+		local res = redis.call('sscan', key, cursor, 'COUNT', math.max(count, 10))
+		cursor = res[1]
+		for _,id in ipairs(res[2]) do
+			if not processed[id] then
+				processed[id] = true
+				seen = seen + 1
+				if seen > offset then
+					table.insert(ids, id)
+					if # ids == count then
+						return ids
+					end
+				end
+			end
+		end
+	until cursor == '0'
+	return ids
+end
+
+-- Return n members of the query chosen at random
+local function random_members(key, n)
+	if redis_type(key) == 'set' then
+		return redis.call('srandmember', key, n)
+	end
+	local N = redis_len(key) or 0
+	if n >= N then
+		return redis.call('zrange', key, 0, -1)
+	end
+	local chosen = {}
+	local ids = {}
+	while # ids < n do
+		local r = math.random(0, N - 1)
+		if not chosen[r] then
+			chosen[r] = true
+			table.insert(ids, redis.call('zrange', key, r, r)[1])
+		end
+	end
+	return ids
+end
+
+-- Convert the slice bounds into an offset and a number of elements
+local limit
+if start ~= 0 or stop ~= '' then
+	local N = redis_len(rkey) or 0
+	if start < 0 then
+		start = math.max(N + start, 0)
+	end
+	local last = N
+	if stop ~= '' then
+		last = stop + 0
+		if last < 0 then
+			last = N + last
+		end
+		last = math.min(last, N)
+	end
+	limit = {start, last - start}
+end
+
+-- Return the ids of the query in the order of the sort index at skey of
+-- field name, from offset for count ids (all ids when count is nil).
+-- Text indices score the value prefix only, ids with the same score are
+-- sorted by value.
+local function sort_index_range(skey, name, kind, desc, offset, count)
+	local key = skey
+	local tkey
+	if rkey ~= bk .. ':id' then
+		tkey = redis_randomkey(bk)
+		redis.call('zinterstore', tkey, 2, rkey, skey, 'WEIGHTS', 0, 1)
+		key = tkey
+	end
+	local N = redis.call('zcard', key) + 0
+	local first, last = offset, N - 1
+	if count then
+		last = math.min(offset + count, N) - 1
+	end
+	local ids = {}
+	if first <= last then
+		if desc then
+			first, last = N - 1 - last, N - 1 - first
+		end
+		local scored = redis.call('zrange', key, first, last, 'WITHSCORES')
+		if kind == 't' then
+			local lo, hi = scored[2], scored[# scored]
+			local before = redis.call('zcount', key, '-inf', '(' .. lo) + 0
+			local values = {}
+			ids = redis.call('zrangebyscore', key, lo, hi)
+			for _,id in ipairs(ids) do
+				values[id] = redis.call('hget', bk .. ':obj:' .. id, name) or ''
+			end
+			table.sort(ids, function (a, b)
+				if values[a] == values[b] then
+					return a < b
+				end
+				return values[a] < values[b]
+			end)
+			ids = tabletools.slice(ids, first - before + 1, last - before + 1)
+		else
+			for i = 1, # scored, 2 do
+				table.insert(ids, scored[i])
+			end
+		end
+		if desc then
+			local reversed = {}
+			for i = # ids, 1, -1 do
+				table.insert(reversed, ids[i])
+			end
+			ids = reversed
+		end
+	end
+	if tkey then
+		redis.call('del', tkey)
+	end
+	return ids
+end
+
+-- Return the ids of the query sorted by the field name of the model related
+-- by the foreign key fk. The sort index of the related model is walked in
+-- order and ids are taken from the index of fk, so that only the related
+-- instances preceding the slice are visited.
+local function related_sort_range(fk, rbk, name, kind, desc, offset, count)
+	local skey = rbk .. ':srt:' .. name
+	local all = rkey == bk .. ':id'
+	local typ = redis_type(rkey)
+	local ids = {}
+	local seen = 0
+	-- Add the ids of the query related to rid. Return true when done.
+	local function add_related(rid)
+		for _,id in ipairs(redis_members(bk .. ':idx:' .. fk .. ':' .. rid)) do
+			if all or (typ == 'set' and redis.call('sismember', rkey, id) + 0 == 1)
+			       or (typ == 'zset' and redis.call('zscore', rkey, id)) then
+				seen = seen + 1
+				if seen > offset then
+					table.insert(ids, id)
+					if # ids == count then
+						return true
+					end
+				end
+			end
+		end
+		return false
+	end
+	-- Instances with no related instance sort first
+	if not desc and add_related('') then
+		return ids
+	end
+	local range, byscore = 'zrange', 'zrangebyscore'
+	if desc then
+		range, byscore = 'zrevrange', 'zrevrangebyscore'
+	end
+	local pos = 0
+	while true do
+		local entry = redis.call(range, skey, pos, pos, 'WITHSCORES')
+		if # entry == 0 then
+			break
+		end
+		local group = redis.call(byscore, skey, entry[2], entry[2])
+		pos = pos + # group
+		if kind == 't' and # group > 1 then
+			local values = {}
+			for _,rid in ipairs(group) do
+				values[rid] = redis.call('hget', rbk .. ':obj:' .. rid, name) or ''
+			end
+			table.sort(group, function (a, b)
+				if values[a] == values[b] then
+					return a < b
+				end
+				if desc then
+					return values[a] > values[b]
+				end
+				return values[a] < values[b]
+			end)
+		end
+		for _,rid in ipairs(group) do
+			if add_related(rid) then
+				return ids
+			end
+		end
+	end
+	if desc then
+		add_related('')
+	end
+	return ids
+end
+
+-- Return the ids of the query sorted by several fields. The values of the
+-- fields of an id are loaded with one HMGET, nested values are read from the
+-- related models. Ties keep the order of the query.
+local function multi_sort(args, i)
+	local keys = {}
+	local names = {}
+	local n = args[i+1] + 0
+	i = i + 1
+	for k = 1, n do
+		local key = {field = args[i+1], alpha = args[i+2] == 'ALPHA',
+					 desc = args[i+3] == 'DESC', nested = {}}
+		local nested = args[i+5] + 0
+		i = i + 5
+		for j = 1, nested do
+			table.insert(key.nested, {args[i+1], args[i+2]})
+			i = i + 2
+		end
+		if key.field ~= '' then
+			table.insert(names, key.field)
+			key.pos = # names
+		end
+		keys[k] = key
+	end
+	local ids = redis_members(rkey)
+	local values = {}
+	local order = {}
+	for p, id in ipairs(ids) do
+		local row = {}
+		local tuple = {}
+		if # names > 0 then
+			row = redis.call('hmget', bk .. ':obj:' .. id, unpack(names))
+		end
+		for k, key in ipairs(keys) do
+			local value = id
+			if key.pos then
+				value = row[key.pos]
+				for _, rel in ipairs(key.nested) do
+					if not value then
+						break
+					end
+					value = redis.call('hget', rel[1] .. ':obj:' .. value, rel[2])
+				end
+			end
+			if key.alpha then
+				tuple[k] = value or ''
+			else
+				tuple[k] = tonumber(value) or 0
+			end
+		end
+		order[id] = p
+		values[id] = tuple
+	end
+	table.sort(ids, function (a, b)
+		local va, vb = values[a], values[b]
+		for k, key in ipairs(keys) do
+			if va[k] ~= vb[k] then
+				if key.desc then
+					return va[k] > vb[k]
+				end
+				return va[k] < vb[k]
+			end
+		end
+		return order[a] < order[b]
+	end)
+	return ids
+end
+
 -- Perform explicit custom ordering if required
 if ordering == 'explicit' then
 	local field = ARGV[io+1]
 	local alpha = ARGV[io+2]
 	local desc = ARGV[io+3]
-	local nested = ARGV[io+4] + 0
+	local sort = ARGV[io+4]
+	local nested = ARGV[io+5] + 0
 	local tkeys = {}
 	local sortargs = {}
 	local bykey
-	io = io + 4
-    -- nested sorting for foreign key fields
-	if nested > 0 then
-		-- generate a temporary key where to store the hash table holding
-		-- the values to sort with
-		local ion, key, name
-		local skey = redis_randomkey(bk)
-		for i,id in pairs(redis_members(rkey)) do
-			local value = redis.call('hget', bk .. ':obj:' .. id, field)
-			local n = 0
-			while n < nested do
-				ion = io + 2*n
-				n = n + 1
-				key = ARGV[ion+1] .. ':obj:' .. value
-				name = ARGV[ion+2]
-				value = redis.call('hget', key, name)
-			end
-			-- store value on temporary hash table
-			--redis.call('hset', skey, id, value)
-			tkeys[i] = skey .. id
-			-- store value on temporary key
-			redis.call('set', tkeys[i], value)
-		end
-		--bykey = skey .. '->*'
-		bykey = skey .. '*'
-		--redis.call('expire', skey, 5)
-	elseif field == '' then
-	    bykey = nil
-	else
-		bykey = bk .. ':obj:*->' .. field
-	end
-	if bykey then
-	   sortargs = {'BY',bykey}
+	local offset, count = 0, nil
+	if limit then
+		offset, count = limit[1], limit[2]
 	end
-	if start > 0 or stop > 0 then
-		table.insert(sortargs, 'LIMIT')
-		table.insert(sortargs, start)
-		table.insert(sortargs, stop)
+	io = io + 5
+	-- Use the sort index when available. Queries with fewer ids than the
+	-- related sort index are sorted directly.
+	if sort ~= '' and nested == 1 and (redis_len(rkey) or 0) <
+	   redis.call('zcard', ARGV[io+1] .. ':srt:' .. ARGV[io+2]) + 0 then
+		sort = ''
 	end
-	if alpha == 'ALPHA' then
-		table.insert(sortargs, alpha)
+	if count and count <= 0 then
+		ids = {}
+	elseif sort ~= '' and nested == 0 then
+		ids = sort_index_range(bk .. ':srt:' .. field, field, sort, desc == 'DESC', offset, count)
+	elseif sort ~= '' then
+		ids = related_sort_range(field, ARGV[io+1], ARGV[io+2], sort, desc == 'DESC', offset, count)
+	else
+		-- nested sorting for foreign key fields
+		if nested > 0 then
+			-- generate a temporary key where to store the hash table holding
+			-- the values to sort with
+			local ion, key, name
+			local skey = redis_randomkey(bk)
+			for i,id in pairs(redis_members(rkey)) do
+				local value = redis.call('hget', bk .. ':obj:' .. id, field)
+				local n = 0
+				while n < nested do
+					ion = io + 2*n
+					n = n + 1
+					key = ARGV[ion+1] .. ':obj:' .. value
+					name = ARGV[ion+2]
+					value = redis.call('hget', key, name)
+				end
+				-- store value on temporary hash table
+				--redis.call('hset', skey, id, value)
+				tkeys[i] = skey .. id
+				-- store value on temporary key
+				redis.call('set', tkeys[i], value)
+			end
+			--bykey = skey .. '->*'
+			bykey = skey .. '*'
+			--redis.call('expire', skey, 5)
+		elseif field == '' then
+		    bykey = nil
+		else
+			bykey = bk .. ':obj:*->' .. field
+		end
+		if bykey then
+		   sortargs = {'BY',bykey}
+		end
+		if limit then
+			table.insert(sortargs, 'LIMIT')
+			table.insert(sortargs, limit[1])
+			table.insert(sortargs, limit[2])
+		end
+		if alpha == 'ALPHA' then
+			table.insert(sortargs, alpha)
+		end
+		if desc == 'DESC' then
+			table.insert(sortargs, desc)
+		end
+		if limit and limit[2] <= 0 then
+			ids = {}
+		else
+			ids = redis.call('sort', rkey, unpack(sortargs))
+		end
+		redis_delete(tkeys)
 	end
-	if desc == 'DESC' then
-		table.insert(sortargs, desc)
+elseif ordering == 'multi' then
+	if limit and limit[2] <= 0 then
+		ids = {}
+	else
+		ids = multi_sort(ARGV, io)
+		if limit then
+			ids = tabletools.slice(ids, limit[1] + 1, limit[1] + limit[2])
+		end
 	end
-	ids = redis.call('sort', rkey, unpack(sortargs))
-	redis_delete(tkeys)
 else
-	if ordering == 'DESC' then
-		ids = redis.call('zrevrange', rkey, start, stop)
+	local first, last = 0, -1
+	if limit then
+		first = limit[1]
+		last = limit[1] + limit[2] - 1
+	end
+	if limit and limit[2] <= 0 then
+		ids = {}
+	elseif ordering == 'DESC' then
+		ids = redis.call('zrevrange', rkey, first, last)
 	elseif ordering == 'ASC' then
-		ids = redis.call('zrange', rkey, start, stop)
+		ids = redis.call('zrange', rkey, first, last)
+	elseif ordering == 'random' then
+		math.randomseed(ARGV[io+2] + 0)
+		ids = random_members(rkey, ARGV[io+1] + 0)
+	elseif limit and redis_type(rkey) == 'list' then
+		-- ids stored by a previous call
+		ids = redis.call('lrange', rkey, first, last)
+	elseif limit and not store then
+		-- unordered slice, members are read in the set iteration order
+		ids = scan_members(rkey, limit[1], limit[2])
+	elseif limit then
+		-- scripts storing ids cannot scan, which is not deterministic
+		ids = tabletools.slice(redis.call('smembers', rkey), first + 1, last + 1)
 	else
 		ids = redis.call('smembers', rkey)
 	end
 end
 
+-- store the ids without loading data, they are loaded in slices by
+-- subsequent calls
+if store then
+	redis.call('del', store)
+	for k = 1, # ids, 1000 do
+		redis.call('rpush', store, unpack(tabletools.slice(ids, k, k + 999)))
+	end
+	return # ids
+end
+
 -- loop over ids and gather the data if needed
 if num_fields == 0 then
 	result = {}
@@ -116,7 +438,9 @@ else
 	end
 end
 
--- handle related item loading
+-- handle related item loading. Relations with a parent are followed from
+-- the related instances loaded by the parent, each related instance is
+-- loaded once.
 local related_items = {}
 local related_fields = {}
 for r,rel in ipairs(related) do
@@ -135,11 +459,20 @@ for r,rel in ipairs(related) do
 		local processed = {}
 		local j = 0
 		local rbk = rel['bk']
-		for i,res in ipairs(result) do
-			local id = bk .. ':obj:' .. res[1]
+		local sources = {}
+		if rel['parent'] > 0 then
+			local parent = related[rel['parent']]
+			for i,item in ipairs(related_items[rel['parent']][2]) do
+				sources[i] = parent['bk'] .. ':obj:' .. item[1]
+			end
+		else
+			for i,res in ipairs(result) do
+				sources[i] = bk .. ':obj:' .. res[1]
+			end
+		end
+		for i,id in ipairs(sources) do
 			local rid = redis.call('hget', id, field)
-			local val = processed[rid]
-			if not val then
+			if rid and not processed[rid] then
 				j = j + 1
 				processed[rid] = j
 				if # fields > 0 then
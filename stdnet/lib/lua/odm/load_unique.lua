@@ -0,0 +1,29 @@
+-- LOAD AN INSTANCE FROM A LOOKUP ON THE ID OR ON A UNIQUE FIELD
+local bk = KEYS[1] -- base key for model
+local name = ARGV[1] -- unique field name, empty for an id lookup
+local value = ARGV[2]
+local s = ARGV[3] -- 's' for sets, 'z' for zsets
+local num_fields = ARGV[4] + 0
+local fields = tabletools.slice(ARGV, 5, 4 + num_fields)
+local id = value
+if name ~= '' then
+    id = redis.call('hget', bk .. ':uni:' .. name, value)
+    if not id then
+        return {}
+    end
+end
+if s == 's' then
+    if redis.call('sismember', bk .. ':id', id) + 0 == 0 then
+        return {}
+    end
+elseif not redis.call('zscore', bk .. ':id', id) then
+    return {}
+end
+local idkey = bk .. ':obj:' .. id
+if num_fields == 0 then
+    return {{id, redis.call('hgetall', idkey)}}
+elseif num_fields == 1 and fields[1] == 'id' then
+    return {id}
+else
+    return {{id, redis.call('hmget', idkey, unpack(fields))}}
+end
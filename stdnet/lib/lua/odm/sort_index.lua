@@ -0,0 +1,29 @@
+-- Utilities for sort indices. The sorted set at bk:srt:name contains all the
+-- ids of the model scored by the value of field name.
+-- Sort indices are flagged with '3' for numeric fields and '4' for text.
+local sort_kinds = {['3'] = 'n', ['4'] = 't'}
+
+-- Return the score of value. Text is encoded with its first six bytes, so
+-- that ids are sorted by the value prefix. Missing values score 0 as in SORT.
+local function sort_score(value, kind)
+    if not value or value == '' then
+        return 0
+    elseif kind == 'n' then
+        return tonumber(value) or 0
+    end
+    local score = 0
+    for i = 1, 6 do
+        score = 256*score + (value:byte(i) or 0)
+    end
+    return score
+end
+
+-- Add or remove id from the sort index of field name
+local function sort_index_update(bk, name, kind, value, id, add)
+    local key = bk .. ':srt:' .. name
+    if add then
+        return redis.call('zadd', key, sort_score(value, kind), id)
+    else
+        return redis.call('zrem', key, id)
+    end
+end
@@ -0,0 +1,147 @@
+-- UPDATE FIELDS OF INSTANCES IN A QUERY
+-- Process ids in the list rkey from start to stop, set the new data and
+-- update the indices of the changed fields.
+local bk = KEYS[1] -- base key for model
+local rkey = KEYS[2] -- list containing the ids of the query
+local start = ARGV[1] + 0
+local stop = ARGV[2] + 0
+local s = ARGV[3] -- 's' for sets, 'z' for zsets
+local score = ARGV[4] -- new score if the ordering field is updated
+local length_indices = ARGV[5] + 0
+local idx = 5
+local indices = tabletools.slice(ARGV,idx+1,idx+length_indices)
+local uniques = tabletools.slice(ARGV,idx+length_indices+1,idx+2*length_indices)
+local counted = index_counts(uniques)
+idx = idx + 2*length_indices + 1
+local length_data = ARGV[idx] + 0
+local data = tabletools.slice(ARGV,idx+1,idx+length_data)
+idx = idx + length_data + 1
+local length_removed = ARGV[idx] + 0
+local removed = tabletools.slice(ARGV,idx+1,idx+length_removed)
+idx = idx + length_removed + 1
+local log = ARGV[idx] -- change log key or empty
+local log_size = ARGV[idx+1] + 0
+local idset = bk .. ':id'
+-- names of fields updated
+local names = {}
+local changed = {}
+local k = 0
+while k < # data do
+    table.insert(names, data[k+1])
+    k = k + 2
+end
+for _,name in ipairs(removed) do
+    table.insert(names, name)
+end
+for _,name in ipairs(names) do
+    changed[name] = true
+end
+if score ~= '' then
+    -- The ordering field is updated, all indices need the new score
+    changed = nil
+end
+
+-- Add or remove indices of changed fields for an instance.
+-- Return the errors (constaints were violated)
+local function update_indices(id, idkey, iscore, add)
+    local errors = {}
+    local idxkey
+    for i,name in ipairs(indices) do
+        if not changed or index_changed(changed, name) then
+            local value = index_value(idkey, name)
+            if uniques[i] == '1' then
+                if value then
+                    idxkey = bk .. ':uni:' .. name
+                    if add then
+                        if redis.call('hsetnx', idxkey, value, id) + 0 == 0 and
+                           redis.call('hget', idxkey, value) ~= id then
+                            -- remove field `name` from the instance hashtable
+                            -- so that the rollback won't delete the index
+                            redis.call('hdel', idkey, name)
+                            table.insert(errors, 'Unique constraint "' .. name .. '" violated.')
+                        end
+                    elseif redis.call('hget', idxkey, value) == id then
+                        redis.call('hdel', idxkey, value)
+                    end
+                end
+            elseif sort_kinds[uniques[i]] then
+                sort_index_update(bk, name, sort_kinds[uniques[i]], value, id, add)
+            else
+                local changed
+                if uniques[i] == '2' then
+                    changed = bitmap_update(bk, name, value, id, add)
+                else
+                    idxkey = bk .. ':idx:' .. name .. ':'
+                    if value then
+                        idxkey = idxkey .. value
+                    end
+                    if not add then
+                        changed = redis.call(s .. 'rem', idxkey, id)
+                    elseif s == 's' then
+                        changed = redis.call('sadd', idxkey, id)
+                    else
+                        changed = redis.call('zadd', idxkey, iscore, id)
+                    end
+                end
+                if counted[i] and changed + 0 == 1 then
+                    count_update(bk, name, value, add and 1 or -1)
+                end
+            end
+        end
+    end
+    return errors
+end
+
+local ids = redis.call('lrange', rkey, start, stop)
+local updated = {}
+local failures = {}
+for _,id in ipairs(ids) do
+    local idkey = bk .. ':obj:' .. id
+    if redis.call('exists', idkey) + 0 == 1 then
+        local old_values = {}
+        local old_score = score
+        local values = redis.call('hmget', idkey, unpack(names))
+        for i,name in ipairs(names) do
+            if values[i] then
+                table.insert(old_values, name)
+                table.insert(old_values, values[i])
+            end
+        end
+        if s == 'z' then
+            old_score = redis.call('zscore', idset, id)
+        end
+        update_indices(id, idkey, old_score, false)
+        if # removed > 0 then
+            redis.call('hdel', idkey, unpack(removed))
+        end
+        if length_data > 0 then
+            redis.call('hmset', idkey, unpack(data))
+        end
+        local iscore = old_score
+        if score ~= '' then
+            iscore = score
+            redis.call('zadd', idset, score, id)
+        end
+        local errors = update_indices(id, idkey, iscore, true)
+        if # errors > 0 then
+            -- Rollback changes
+            update_indices(id, idkey, iscore, false)
+            redis.call('hdel', idkey, unpack(names))
+            if # old_values > 0 then
+                redis.call('hmset', idkey, unpack(old_values))
+            end
+            if score ~= '' then
+                redis.call('zadd', idset, old_score, id)
+            end
+            update_indices(id, idkey, old_score, true)
+            table.insert(failures, id .. ': ' .. errors[1])
+        else
+            if log_size > 0 then
+                changelog_append(log, log_size, id, 'update', names, iscore or '')
+            end
+            table.insert(updated, id)
+        end
+    end
+end
+
+return {updated, failures, # ids}
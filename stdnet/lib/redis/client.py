@@ -149,6 +149,32 @@ def bytes_to_string(request, response, args, **options):
     else:
         return response
 
+
+def scan_callback(request, response, args, **options):
+    cursor, keys = response
+    return int(cursor), list(bytes_to_string(request, keys, args))
+
+
+def zscan_callback(request, response, args, **options):
+    cursor, pairs = response
+    it = iter(bytes_to_string(request, pairs, args))
+    return int(cursor), [(v, float(s)) for v, s in zip(it, it)]
+
+
+def hscan_callback(request, response, args, **options):
+    cursor, pairs = response
+    return int(cursor), list(pairs_to_dict(pairs, request.client.encoding))
+
+
+def scan_args(cursor, match, count):
+    pieces = [cursor]
+    if match is not None:
+        pieces.extend(('MATCH', match))
+    if count is not None:
+        pieces.extend(('COUNT', count))
+    return pieces
+
+
 def config_callback(request, response, args, **options):
     if args[0] == 'GET':
         encoding = request.client.encoding
@@ -240,6 +266,10 @@ class Redis(object):
             'EVALSHA': eval_command_callback,
             'EVAL': eval_command_callback,
             'SCRIPT': script_command_callback,
+            'SCAN': scan_callback,
+            'SSCAN': scan_callback,
+            'ZSCAN': zscan_callback,
+            'HSCAN': hscan_callback,
             'CONFIG': config_callback,
             'SLOWLOG': slowlog_callback
         }
@@ -354,9 +384,9 @@ between the client and server.
         "Returns the number of keys in the current database"
         return self.execute_command('DBSIZE')
 
-    def delete(self, *names):
+    def delete(self, *names, **options):
         "Delete one or more keys specified by ``names``"
-        return self.execute_command('DEL', *names)
+        return self.execute_command('DEL', *names, **options)
     __delitem__ = delete
 
     def flushall(self):
@@ -475,6 +505,12 @@ instance is promoted to a master instead.
         "Returns a list of keys matching ``pattern``"
         return self.execute_command('KEYS', pattern)
 
+    def scan(self, cursor=0, match=None, count=None):
+        """Incrementally iterate the keys of the database. Returns a two
+elements tuple with the next cursor, 0 when the iteration is complete,
+and a list of keys."""
+        return self.execute_command('SCAN', *scan_args(cursor, match, count))
+
     def mget(self, keys, *args):
         """Returns a list of values ordered identically to ``keys``"""
         keys = list_or_args(keys, args)
@@ -738,6 +774,12 @@ can be one of: refcount, encoding, idletime.'''
     def smembers(self, name, **options):
         return self.execute_command('SMEMBERS', name, **options)
 
+    def sscan(self, name, cursor=0, match=None, count=None):
+        """Incrementally iterate the members of set ``name``, as
+:meth:`scan`."""
+        return self.execute_command('SSCAN', name,
+                                    *scan_args(cursor, match, count))
+
     def smove(self, src, dst, value, **options):
         return self.execute_command('SMOVE', src, dst, value, **options)
 
@@ -856,6 +898,12 @@ The first element is the score and the second is the value.'''
         "Return the score of element ``value`` in sorted set ``name``"
         return self.execute_command('ZSCORE', name, value, **options)
 
+    def zscan(self, name, cursor=0, match=None, count=None):
+        """Incrementally iterate the elements of sorted set ``name``, as
+:meth:`scan`. Elements are returned as a list of (value, score) pairs."""
+        return self.execute_command('ZSCAN', name,
+                                    *scan_args(cursor, match, count))
+
     def zinterstore(self, dest, keys, *args, **options):
         """
         Intersect multiple sorted sets specified by ``keys`` into
@@ -1027,6 +1075,12 @@ time ``start`` and time ``end`` sorted in ascending order.
         "Return a Python dict of the hash's name/value pairs"
         return self.execute_command('HGETALL', name)
 
+    def hscan(self, name, cursor=0, match=None, count=None):
+        """Incrementally iterate the fields of hash ``name``, as
+:meth:`scan`. Fields are returned as a list of (field, value) pairs."""
+        return self.execute_command('HSCAN', name,
+                                    *scan_args(cursor, match, count))
+
     def hincrby(self, name, key, amount=1):
         "Increment the value of ``key`` in hash ``name`` by ``amount``"
         return self.execute_command('HINCRBY', name, key, amount)
@@ -2,24 +2,30 @@
 import sys
 from copy import copy, deepcopy
 import hashlib
+import threading
+import time
 import weakref
 
 from stdnet import BackendRequest, AsyncObject
 from stdnet.utils import zip, to_string
+from stdnet.utils.structures import OrderedDict
 from stdnet.exceptions import *
 
 from . import signals
 from .globals import hashmodel, JSPLITTER, get_model_from_hash
-from .fields import Field, AutoField, orderinginfo
+from .fields import Field, AutoField, IntegerField, orderinginfo
 from .session import Manager, setup_managers
 
 
 __all__ = ['Metaclass',
            'Model',
+           'Record',
            'ModelBase',
            'autoincrement',
            'ModelType', # Metaclass for all stdnet ModelBase classes
            'StdNetType', # derived from ModelType, metaclass fro StdModel
+           'CompositeIndex',
+           'InstanceCache',
            'from_uuid']
 
 
@@ -36,6 +42,10 @@ def get_fields(bases, attrs):
     return fields
 
 
+def _function(method):
+    return getattr(method, '__func__', method)
+
+
 def make_app_label(new_class, app_label = None):
     if app_label is None:
         model_module = sys.modules[new_class.__module__]
@@ -51,6 +61,9 @@ def make_app_label(new_class, app_label = None):
 
 class ModelMeta(object):
     '''A class for storing meta data of a :class:`Model` class.'''
+    cache = None
+    changelog = None
+    
     def __init__(self, model, app_label = None, modelkey = None,
                  abstract = False):
         self.abstract = abstract
@@ -87,6 +100,134 @@ class ModelMeta(object):
         return to_string(id)
     
         
+class CompositeIndex(object):
+    '''An index on the values of two or more fields of a model, declared in
+the ``indexes`` attribute of the model ``Meta`` class.
+
+.. attribute:: fields
+
+    tuple of :class:`Field` in the index.
+    
+.. attribute:: attname
+
+    The name of the index in the backend, given by the comma separated
+    attribute names of :attr:`fields`.
+'''
+    index = True
+    unique = False
+    bitmap = False
+    counts = False
+    
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.attname = ','.join((f.attname for f in self.fields))
+        
+    def __repr__(self):
+        return self.attname
+    __str__ = __repr__
+    
+    def value(self, values):
+        '''The value of the index for the serialized *values* of
+:attr:`fields`. Values are joined by colons, after escaping backslashes and
+colons with a backslash, so that distinct values give distinct keys.'''
+        return ':'.join(('' if v is None else to_string(v).replace('\\',
+                         '\\\\').replace(':', '\\:') for v in values))
+    
+    
+class InstanceCache(object):
+    '''A bounded least recently used cache of the data of instances of a
+model, shared by all the :class:`Session` of a process. It is available as
+:attr:`Metaclass.cache` when ``cache_size`` is given in the ``Meta`` class
+of a model::
+
+    class Instrument(odm.StdModel):
+        ...
+        class Meta:
+            cache_size = 1000
+
+Entries are keyed by backend and primary key and contain the serialized data
+loaded from the backend, so that each session builds its own instance.
+Entries are evicted when instances are committed, updated or deleted in the
+process and expire after :attr:`max_age` seconds, so that changes committed
+by other processes are eventually seen.
+
+.. attribute:: size
+
+    The maximum number of entries.
+    
+.. attribute:: max_age
+
+    The number of seconds an entry is served after being loaded, given by
+    ``cache_max_age`` in the ``Meta`` class of the model. If ``None``
+    entries only expire when evicted.
+    
+    Default ``60``.
+'''
+    def __init__(self, size, max_age=60):
+        self.size = size
+        self.max_age = max_age
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def __len__(self):
+        return len(self._data)
+    
+    def _key(self, backend, id):
+        return (str(backend), to_string(id))
+    
+    def get(self, backend, id):
+        '''The serialized data of instance *id* loaded from *backend*, or
+``None`` if not available.'''
+        key = self._key(backend, id)
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return
+            loaded, data = entry
+            if self.max_age is not None and\
+                time.time() - loaded >= self.max_age:
+                return
+            self._data[key] = entry
+        return dict(data)
+    
+    def set(self, backend, id, data):
+        '''Store the serialized *data* of instance *id* loaded from
+*backend*, removing the least recently used entries above :attr:`size`.'''
+        key = self._key(backend, id)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time(), dict(data))
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                
+    def evict(self, backend, ids):
+        '''Remove the entries of *ids* loaded from *backend*.'''
+        with self._lock:
+            for id in ids:
+                self._data.pop(self._key(backend, id), None)
+                
+    def clear(self, backend=None):
+        '''Remove all the entries, or the entries of *backend* only.'''
+        with self._lock:
+            if backend is None:
+                self._data.clear()
+            else:
+                name = str(backend)
+                for key in [k for k in self._data if k[0] == name]:
+                    self._data.pop(key)
+                    
+    def evict_message(self, backend, message):
+        '''Evict the entries in a *message* published by *backend* on the
+channel given by :meth:`stdnet.BackendDataServer.invalidation_channel`.
+The message is a comma separated list of ids, or ``*`` when all the entries
+need to be removed.'''
+        message = to_string(message)
+        if message == '*':
+            self.clear(backend)
+        else:
+            self.evict(backend, message.split(','))
+    
+    
 class Metaclass(ModelMeta):
     '''An instance of :class:`Metaclass` stores all information
 which maps a :class:`StdModel` into an object in the in a remote
@@ -110,8 +251,12 @@ class of :class:`StdModel` in the following way::
 
 :parameter abstract: Check the :attr:`abstract` attribute.
 :parameter ordering: Check the :attr:`ordering` attribute.
+:parameter indexes: Check the :attr:`composite_indices` attribute.
 :parameter app_label: Check the :attr:`app_label` attribute.
 :parameter modelkey: Check the :attr:`modelkey` attribute.
+:parameter cache_size: Check the :attr:`cache` attribute.
+:parameter cache_max_age: Check the :attr:`cache` attribute.
+:parameter changelog: Check the :attr:`changelog` attribute.
 
 **Attributes and methods**:
 
@@ -154,7 +299,25 @@ mapper.
 .. attribute:: indices
 
     List of :class:`Field` which are indices (:attr:`Field.index` attribute
-    set to ``True``).
+    set to ``True``). Indices with :attr:`Field.bitmap` set to ``True`` are
+    stored as bitmaps and require integer ids.
+    
+.. attribute:: composite_indices
+
+    List of :class:`CompositeIndex` declared as tuples of field names in
+    the ``indexes`` attribute of the ``Meta`` class::
+    
+        class Trade(odm.StdModel):
+            ...
+            class Meta:
+                indexes = [('account', 'symbol', 'dt')]
+                
+    A query with equality lookups on all the fields of a composite index
+    is evaluated as a single lookup on the index.
+    
+.. attribute:: sort_indices
+
+    List of :class:`Field` with :attr:`Field.sort_index` set to ``True``.
     
 .. attribute:: modelkey
 
@@ -165,6 +328,24 @@ mapper.
 .. attribute:: pk
 
     The :class:`Field` representing the primary key.
+    
+.. attribute:: cache
+
+    An :class:`InstanceCache` of at most ``cache_size`` entries, expiring
+    after ``cache_max_age`` seconds, if ``cache_size`` is given in the
+    ``Meta`` class, used by
+    :meth:`Query.get` and :meth:`Query.get_many` on primary keys.
+    
+    Default ``None``.
+    
+.. attribute:: changelog
+
+    The maximum number of records in the change log of the model. If given,
+    the backend appends a :class:`ChangeRecord` for each instance committed,
+    updated or incremented in the server, or deleted, which can be consumed in other processes via
+    :meth:`Session.read_changes`.
+    
+    Default ``None``.
 '''
     searchengine = None
     connection_string = None
@@ -173,7 +354,8 @@ mapper.
                  abstract = False, app_label = '',
                  verbose_name = None,
                  ordering = None, modelkey = None,
-                 **kwargs):
+                 indexes = None, cache_size = None, changelog = None,
+                 cache_max_age = 60, **kwargs):
         super(Metaclass,self).__init__(model,
                                        app_label = app_label,
                                        modelkey = modelkey,
@@ -181,10 +363,17 @@ mapper.
         self.fields = []
         self.scalarfields = []
         self.indices = []
+        self.composite_indices = []
+        self.sort_indices = []
         self.multifields = []
         self.dfields = {}
         self.timeout = 0
         self.related = {}
+        self._decoders = {}
+        self._record_class = None
+        self.cache = InstanceCache(cache_size, cache_max_age)\
+                        if cache_size else None
+        self.changelog = changelog
         self.verbose_name = verbose_name or self.name
         # Check if PK field exists
         pk = None
@@ -204,6 +393,24 @@ mapper.
         self.pk = pk
         for name,field in fields.items():
             field.register_with_model(name, model)
+        if pk.type not in ('auto', 'integer'):
+            for field in self.indices:
+                if field.bitmap:
+                    raise ImproperlyConfigured('Bitmap index "{0}" requires\
+ integer ids'.format(field))
+        for names in indexes or ():
+            index_fields = []
+            for name in names:
+                field = self.dfields.get(name)
+                if field is None or field is pk or\
+                        field not in self.scalarfields:
+                    raise ImproperlyConfigured('Cannot index field "{0}" of\
+ {1}'.format(name, self))
+                index_fields.append(field)
+            if len(index_fields) < 2:
+                raise ImproperlyConfigured('A composite index requires two or\
+ more fields')
+            self.composite_indices.append(CompositeIndex(index_fields))
         self.ordering = None
         if ordering:
             self.ordering = self.get_sorting(ordering,ImproperlyConfigured)
@@ -246,6 +453,126 @@ Return ``True`` if the instance is ready to be saved to database.'''
                                 
         return len(errors) == 0
 
+    def loaded_fields(self, names = None):
+        '''Generator of scalar :class:`Field` corresponding to the field
+*names* loaded from the backend. If *names* is ``None`` all scalar fields
+are returned.'''
+        if names is None:
+            for field in self.scalarfields:
+                yield field
+        else:
+            fields = self.dfields
+            processed = set()
+            for name in names:
+                if name in processed:
+                    continue
+                if name in fields:
+                    processed.add(name)
+                    yield fields[name]
+                else:
+                    name = name.split(JSPLITTER)[0]
+                    if name in fields and name not in processed:
+                        field = fields[name]
+                        if field.type == 'json object':
+                            processed.add(name)
+                            yield field
+    
+    def decoder(self, loadedfields = None):
+        '''Return a function which set the state of a :attr:`model` instance
+from backend data. There is one decoder for each distinct tuple of
+*loadedfields*, built the first time it is requested and reused
+afterwards so that fields and converters are resolved once rather than
+for every row.
+
+:parameter loadedfields: ``None`` if all fields are loaded, otherwise a
+    tuple of loaded field names.
+:rtype: a callable accepting an instance and its state, a three elements
+    tuple ``(id, loadedfields, data)``.'''
+        key = (loadedfields, False)
+        decoder = self._decoders.get(key)
+        if decoder is None:
+            decoder = self._make_decoder(loadedfields)
+            self._decoders[key] = decoder
+        return decoder
+    
+    def record_decoder(self, loadedfields = None):
+        '''Same as :meth:`decoder` but the returned callable accepts
+the state only and returns a read-only :class:`Record` rather than
+setting the state of a :attr:`model` instance.'''
+        key = (loadedfields, True)
+        decoder = self._decoders.get(key)
+        if decoder is None:
+            decoder = self._make_record_decoder(loadedfields)
+            self._decoders[key] = decoder
+        return decoder
+    
+    @property
+    def record_class(self):
+        '''The :class:`Record` class for :attr:`model`, created the first
+time it is accessed.'''
+        if self._record_class is None:
+            attnames = tuple((f.attname for f in self.scalarfields))
+            name = '{0}Record'.format(self.model.__name__)
+            self._record_class = type(name, (Record,),
+                                      {'__slots__': ('id',) + attnames,
+                                       '_meta': self,
+                                       '_attnames': attnames})
+        return self._record_class
+    
+    def _converters(self, loadedfields):
+        # Fields which don't override Field.value_from_data are simply
+        # popped from data, the others (multi-valued JSONField) are delegated
+        # to the field.
+        base_value_from_data = _function(Field.value_from_data)
+        converters = []
+        for field in self.loaded_fields(loadedfields):
+            value_from_data = field.value_from_data
+            if _function(value_from_data) is base_value_from_data:
+                value_from_data = None
+            converters.append((field.attname, value_from_data,
+                               field.to_python))
+        return tuple(converters)
+    
+    def _make_record_decoder(self, loadedfields):
+        pk_to_python = self.pk.to_python
+        converters = self._converters(loadedfields)
+        record_class = self.record_class
+        new = record_class.__new__
+        setvalue = object.__setattr__
+        def decode(state):
+            id, _, data = state
+            pop = data.pop
+            record = new(record_class)
+            setvalue(record, 'id', pk_to_python(id))
+            setvalue(record, '_loadedfields', loadedfields)
+            for attname, value_from_data, to_python in converters:
+                if value_from_data is None:
+                    value = pop(attname, None)
+                else:
+                    value = value_from_data(None, data)
+                setvalue(record, attname, to_python(value))
+            return record
+        return decode
+        
+    def _make_decoder(self, loadedfields):
+        pk_to_python = self.pk.to_python
+        converters = self._converters(loadedfields)
+        def decode(instance, state):
+            # data is left unchanged, it is kept by make_objects as the
+            # original values of the instance
+            id, _, data = state
+            attrs = instance.__dict__
+            get = data.get
+            attrs['id'] = pk_to_python(id)
+            attrs['_loadedfields'] = loadedfields
+            for attname, value_from_data, to_python in converters:
+                if value_from_data is None:
+                    attrs[attname] = to_python(get(attname))
+                else:
+                    attrs[attname] = to_python(value_from_data(instance, data))
+            attrs['_dbdata'] = data.get('__dbdata__', {})
+        return decode
+        
     def get_sorting(self, sortby, errorClass = None):
         s = None
         desc = False
@@ -274,6 +601,20 @@ Return ``True`` if the instance is ready to be saved to database.'''
         raise errorClass('Cannot Order by attribute "{0}".\
  It is not a scalar field.'.format(sortby))
         
+    def counter_field(self, name):
+        '''Return the numeric :class:`Field` *name* which can be incremented
+on the backend server. Primary keys and unique fields are not counters.'''
+        field = self.dfields.get(name)
+        if not isinstance(field, IntegerField) or field is self.pk or\
+                field.unique or field not in self.scalarfields:
+            raise FieldError('"{0}" is not a numeric field of {1}'\
+                             .format(name, self))
+        for index in self.composite_indices:
+            if field in index.fields:
+                raise FieldError('"{0}" is in the composite index "{1}" of\
+ {2}'.format(name, index, self))
+        return field
+    
     def backend_fields(self, fields):
         '''Return a two elements tuple containing a list
 of fields names and a list of field attribute names.'''
@@ -385,12 +726,20 @@ def meta_options(abstract = False,
                  ordering = None,
                  modelkey = None,
                  unique_together = None,
+                 indexes = None,
+                 cache_size = None,
+                 changelog = None,
+                 cache_max_age = 60,
                  **kwargs):
     return {'abstract': abstract,
             'app_label':app_label,
             'ordering':ordering,
             'modelkey':modelkey,
-            'unique_together':unique_together}
+            'unique_together':unique_together,
+            'indexes':indexes,
+            'cache_size':cache_size,
+            'changelog':changelog,
+            'cache_max_age':cache_max_age}
     
 
 class ModelState(object):
@@ -428,6 +777,65 @@ class ModelState(object):
     __str__ = __repr__
     
     
+class Record(object):
+    '''A lightweight read-only representation of a :class:`StdModel`
+instance, obtained via the :meth:`Query.records` method. Each model has its
+own :class:`Record` class (available from :attr:`Metaclass.record_class`)
+with ``__slots__`` given by the field attribute names, therefore records
+don't carry an instance dictionary and are not registered with a
+:class:`Session`. Use :meth:`to_instance` to obtain an editable instance.'''
+    __slots__ = ('_loadedfields',)
+    _meta = None
+    _attnames = ()
+    
+    def __setattr__(self, name, value):
+        raise AttributeError('{0} is read-only'.format(self))
+    
+    def __delattr__(self, name):
+        raise AttributeError('{0} is read-only'.format(self))
+    
+    def __repr__(self):
+        return '{0}({1})'.format(self._meta, self.id)
+    __str__ = __repr__
+    
+    def __eq__(self, other):
+        if other.__class__ == self.__class__:
+            return self.id == other.id
+        else:
+            return False
+        
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    def __hash__(self):
+        return hash((self._meta.hash, self.id))
+    
+    def pkvalue(self):
+        return self.id
+    
+    def to_instance(self, session = None):
+        '''Promote this :class:`Record` to a persistent instance of its
+model.
+
+:parameter session: optional :class:`Session` where to add the instance as
+    loaded (not modified).
+:rtype: an instance of :attr:`Metaclass.model`.'''
+        meta = self._meta
+        instance = meta.maker()
+        attrs = instance.__dict__
+        attrs['id'] = self.id
+        attrs['_loadedfields'] = self._loadedfields
+        for attname in self._attnames:
+            try:
+                attrs[attname] = getattr(self, attname)
+            except AttributeError:
+                continue
+        instance._dbdata['id'] = self.id
+        if session is not None:
+            session.add(instance, modified = False)
+        return instance
+    
+    
 class Model(AsyncObject):
     '''A mixin class for :class:`StdModel`. It implements the :attr:`uuid`
 attribute which provides the univarsal unique identifier for an instance of a
@@ -77,8 +77,37 @@ Each field is specified as a :class:`stdnet.odm.StdModel` class attribute.
               No database queries are allowed for non indexed fields
               as a design decision (explicit better than implicit).
     
+    It can also be set to ``'bitmap'`` for models with integer ids,
+    in which case :attr:`Field.bitmap` is ``True``.
+    
     Default ``True``.
     
+.. attribute:: bitmap
+
+    If ``True`` the index stores one bitmap of ids for each value of the
+    field rather than a set. Best suited for boolean and low-cardinality
+    fields. Set by passing ``index='bitmap'``.
+    
+    Default ``False``.
+    
+.. attribute:: counts
+
+    If ``True`` the backend maintains the number of instances for each value
+    of the field, so that :meth:`stdnet.odm.Query.count` on a lookup on the
+    field and :meth:`stdnet.odm.Query.count_by` don't need to evaluate the
+    index. Available for indices which are not unique.
+    
+    Default ``False``.
+    
+.. attribute:: sort_index
+
+    If ``True`` the backend maintains the ids of the model sorted by the
+    value of the field, so that :meth:`stdnet.odm.Query.sort_by` on the field,
+    or on the field of a model related by a :class:`ForeignKey`, doesn't sort
+    the whole query. Available for numeric and text fields.
+    
+    Default ``False``.
+    
 .. attribute:: unique
 
     If ``True``, the field must be unique throughout the model.
@@ -152,6 +181,9 @@ Each field is specified as a :class:`stdnet.odm.StdModel` class attribute.
     type = None
     python_type = None
     index = True
+    bitmap = False
+    counts = False
+    sort_index = False
     ordered = False
     charset = None
     hidden = False
@@ -176,6 +208,17 @@ Each field is specified as a :class:`stdnet.odm.StdModel` class attribute.
             self.required = False
             self.unique = False
             self.index = False
+        if self.index == 'bitmap':
+            self.bitmap = True
+        self.index = bool(self.index)
+        self.counts = bool(extras.pop('counts', self.counts))
+        if self.counts and (self.unique or not self.index):
+            raise FieldError('Only non unique indices can be counted')
+        self.sort_index = bool(extras.pop('sort_index', self.sort_index))
+        if self.sort_index and (self.primary_key or
+                                self.internal_type not in ('numeric', 'text')):
+            raise FieldError('Only numeric and text fields can have a sort\
+ index')
         self.charset = extras.pop('charset',self.charset)
         self.ordered = ordered if ordered is not None else self.ordered
         self.hidden = hidden if hidden is not None else self.hidden
@@ -224,6 +267,8 @@ function users should never call.'''
         meta.scalarfields.append(self)
         if self.index:
             meta.indices.append(self)
+        if self.sort_index:
+            meta.sort_indices.append(self)
     
     def get_attname(self):
         '''Generate the :attr:`attname` at runtime'''
@@ -712,7 +757,7 @@ behaviour and how the field is stored in the back-end server.
         
     def value_from_data(self, instance, data):
         if self.as_string:
-            return data.pop(self.attname,None)
+            return data.get(self.attname)
         else:
             return flat_to_nested(data, instance = instance,
                                   attname = self.attname,
@@ -0,0 +1,161 @@
+'''Tools for building and repairing the indices of a model in a database
+in use. Instances and index keys are scanned in small batches, so that the
+server is never blocked for long, and each batch is processed atomically
+by the server without changing entries which are already correct. A tool
+can therefore run alongside the application and be stopped and resumed at
+any time.
+
+To index the existing instances after adding ``index=True`` to the
+``ccy`` field of a model::
+
+    from stdnet.odm import indextools
+
+    result = indextools.rebuild_indices(session, Instrument, fields=('ccy',))
+
+and to check, and repair, the indices of a model::
+
+    report = indextools.check_indices(session, Instrument, fix=True)
+'''
+import time
+from collections import namedtuple
+
+
+__all__ = ['rebuild_indices', 'check_indices', 'RebuildResult',
+           'IndexReport']
+
+
+RebuildResult = namedtuple('RebuildResult', 'cursor instances added errors')
+'''The result of :func:`rebuild_indices`. *cursor* is the cursor where to
+resume the scan, 0 if the scan is complete, *instances* the number of
+instance ids scanned, *added* the number of index entries added and
+*errors* the list of unique constraints violated by existing instances.'''
+
+IndexReport = namedtuple('IndexReport', 'checked stale unknown fixed')
+'''The result of :func:`check_indices`. *checked* is the number of index
+entries checked, *stale* the list of ``(key, entry)`` pairs of entries
+which don't match an instance, *unknown* the list of keys of indices which
+the model does not define and *fixed* is ``True`` if stale entries were
+repaired.'''
+
+
+def index_names(meta, fields):
+    # The attribute names of the indices of fields
+    indices = set((f.attname for f in meta.indices + meta.composite_indices +
+                   meta.sort_indices))
+    names = set()
+    for name in fields:
+        field = meta.dfields.get(name)
+        attname = field.attname if field is not None else name
+        if attname not in indices:
+            raise ValueError('{0} has no index on "{1}"'.format(meta, name))
+        names.add(attname)
+    return names
+
+
+def rebuild_indices(session, model, fields=None, cursor=0, batch_size=1000,
+                    pause=0, checkpoint=None, max_batches=None):
+    '''Add the instances of *model* to its indices. Instances are found by
+scanning the database, rather than from the model id set, so that the scan
+can be resumed from its cursor. Index entries already present are not
+changed, therefore the indices can be rebuilt while instances are added,
+updated and deleted.
+
+:parameter session: a :class:`Session`.
+:parameter model: a :class:`StdModel`.
+:parameter fields: optional names of fields, or of composite indices, whose
+    indices are rebuilt, for example fields with a new index. If not given
+    all indices are rebuilt.
+:parameter cursor: the cursor where to start the scan. Use the cursor of
+    an interrupted run to resume it or 0 to start a new scan.
+:parameter batch_size: the approximate number of instances processed in a
+    server call.
+:parameter pause: seconds to wait between batches, to throttle the load on
+    the server.
+:parameter checkpoint: optional callable invoked with the cursor after each
+    batch, for example to persist it.
+:parameter max_batches: optional maximum number of batches to process.
+:rtype: a :class:`RebuildResult`.
+
+When a scan completes, the composite and sort indices rebuilt are used by
+queries, which is needed when an index is added to a model with instances.
+'''
+    meta = model._meta
+    backend = session.backend
+    if fields is not None:
+        fields = index_names(meta, fields)
+    instances, added, errors = 0, 0, []
+    batches = 0
+    while True:
+        cursor, ids = backend.scan_instances(meta, cursor, batch_size)
+        n, errs = backend.rebuild_indices(meta, ids, fields)
+        instances += len(ids)
+        added += n
+        errors.extend(errs)
+        batches += 1
+        if checkpoint is not None:
+            checkpoint(cursor)
+        if not cursor or (max_batches and batches >= max_batches):
+            break
+        if pause:
+            time.sleep(pause)
+    if not cursor:
+        backend.set_indices_complete(meta, [idx.attname for idx in\
+                meta.composite_indices + meta.sort_indices\
+                if fields is None or idx.attname in fields])
+    return RebuildResult(cursor, instances, added, errors)
+
+
+def check_indices(session, model, fix=False, batch_size=1000, pause=0):
+    '''Check the entries of the indices of *model* against the instances
+they refer to. An entry is stale if its instance does not exist or has a
+different value for the index and a count is stale if it differs from the
+number of instances with its value.
+
+:parameter session: a :class:`Session`.
+:parameter model: a :class:`StdModel`.
+:parameter fix: if ``True`` stale entries are removed and stale counts are
+    corrected. Counts are then complete and used by queries, which is needed
+    when ``counts=True`` is added to a field of a model with instances. Keys
+    of indices the model does not define are only reported.
+:parameter batch_size: the approximate number of keys, and of entries of a
+    key, processed in a server call.
+:parameter pause: seconds to wait between batches, to throttle the load on
+    the server.
+:rtype: an :class:`IndexReport`.
+
+Missing entries are not detected, use :func:`rebuild_indices` to add them.
+'''
+    meta = model._meta
+    backend = session.backend
+    checked, stale, unknown = 0, [], []
+    seen = set()
+    cursor = 0
+    while True:
+        cursor, keys = backend.scan_indices(meta, cursor, batch_size)
+        for key in keys:
+            # a scan can return a key more than once
+            if key in seen:
+                continue
+            seen.add(key)
+            kcursor = 0
+            while True:
+                result = backend.check_index(meta, key, kcursor, batch_size,
+                                             fix)
+                if result is None:
+                    unknown.append(key)
+                    break
+                kcursor, n, entries = result
+                checked += n
+                stale.extend(entries)
+                if not kcursor:
+                    break
+                if pause:
+                    time.sleep(pause)
+        if not cursor:
+            break
+        if pause:
+            time.sleep(pause)
+    if fix:
+        backend.set_counts_complete(meta, [idx.attname for idx in\
+                    meta.indices + meta.composite_indices if idx.counts])
+    return IndexReport(checked, stale, unknown, bool(fix and stale))
@@ -59,25 +59,7 @@ loaded. This only apply to persistent instances.'''
     
     def loadedfields(self):
         '''Generator of fields loaded from database'''
-        if self._loadedfields is None:
-            for field in self._meta.scalarfields:
-                yield field
-        else:
-            fields = self._meta.dfields
-            processed = set()
-            for name in self._loadedfields:
-                if name in processed:
-                    continue
-                if name in fields:
-                    processed.add(name)
-                    yield fields[name]
-                else:
-                    name = name.split(JSPLITTER)[0]
-                    if name in fields and name not in processed:
-                        field = fields[name]
-                        if field.type == 'json object':
-                            processed.add(name)
-                            yield field
+        return self._meta.loaded_fields(self._loadedfields)
     
     def fieldvalue_pairs(self, exclude_cache = False):
         '''Generator of fields,values pairs. Fields correspond to
@@ -85,12 +67,13 @@ the ones which have been loaded (usually all of them) or
 not loaded but modified.
 Check the :ref:`load_only <performance-loadonly>` query function for more
 details.'''
+        attrs = self.__dict__
         for field in self._meta.scalarfields:
             if exclude_cache and field.as_cache:
                 continue
             name = field.attname
-            if hasattr(self,name):
-                yield field,getattr(self,name)
+            if name in attrs:
+                yield field,attrs[name]
     
     def set_field_value(self, field, value):
         value = field.to_python(value)
@@ -104,12 +87,34 @@ for information regarding fields which are considered cache.'''
             if field.as_cache:
                 setattr(self,field.name,None)
                 
+    def __getattr__(self, name):
+        # Fields not loaded by a lazy query are loaded on first access, for
+        # all the instances loaded by the same query.
+        deferred = self.__dict__.get('_dbdata', {}).get('deferred')
+        if deferred and not name.startswith('_'):
+            fields = self._meta.scalarfields
+            for field in fields:
+                if field.attname == name:
+                    instances = [r() for r in deferred]
+                    instances = [i for i in instances if i is not None]
+                    self.get_session().load_fields(instances, field.name)
+                    # Instances with all their fields loaded no longer need
+                    # the siblings.
+                    for instance in instances:
+                        attrs = instance.__dict__
+                        if all((f.attname in attrs for f in fields)):
+                            instance._dbdata.pop('deferred', None)
+                    return self.__dict__[name]
+        raise AttributeError("'{0}' object has no attribute '{1}'"\
+                             .format(self.__class__.__name__, name))
+        
     def get_attr_value(self, attr):
         '''Retrive the *value* for a *attr* name. The attr can be nested,
 for example ``group__name``.'''
-        if hasattr(self,attr):
-            return getattr(self,attr)
-        # no atribute, try to check for nested values
+        attrs = self.__dict__
+        if attr in attrs:
+            return attrs[attr]
+        # not loaded, try to check for nested values
         bits = tuple((a for a in attr.split(JSPLITTER) if a))
         if len(bits) > 1:
             instance = self
@@ -118,6 +123,8 @@ for example ``group__name``.'''
                 if instance is None:
                     return instance
             return instance
+        # a single getattr, a field deferred by a lazy query is loaded once
+        return getattr(self, attr, None)
     
     def clone(self, **data):
         '''Utility method for cloning the instance as a new object.
@@ -175,16 +182,30 @@ attribute set to ``True`` will be excluded.'''
         '''return a JSON serializable dictionary representation.'''
         return dict(self._to_json())
         
+    def incr(self, field, delta=1):
+        '''Atomically increment the numeric *field* of this persistent
+instance by *delta* in the backend server and return the new value.
+Other fields are not committed.'''
+        meta = self._meta
+        field = meta.counter_field(field)
+        if not self.state().persistent:
+            raise self.DoesNotExist('Object not saved. Cannot increment.')
+        backend = self.get_session().backend
+        result = backend.incr_field(meta, field, field.python_type(delta),
+                                    ids=(self.id,))
+        if not result:
+            raise self.DoesNotExist
+        backend.invalidate(meta, (self.id,))
+        value = result[0][1]
+        setattr(self, field.attname, field.to_python(value))
+        if 'original' in self._dbdata:
+            self._dbdata['original'][field.attname] = value
+        return getattr(self, field.attname)
+    
     def load_fields(self, *fields):
         '''Load extra fields to this :class:`StdModel`.'''
         if self._loadedfields is not None:
-            meta = self._meta
-            kwargs = {meta.pkname(): self.pkvalue()}
-            obj = self.__class__.objects.query().load_only(fields).get(**kwargs)
-            for name in fields:
-                field = meta.dfields.get(name)
-                if field is not None:
-                    setattr(self,field.attname,getattr(obj,field.attname,None))
+            self.get_session().load_fields((self,), *fields)
         
     # PICKLING SUPPORT
     
@@ -192,18 +213,10 @@ attribute set to ``True`` will be excluded.'''
         return (self.id, self._loadedfields, self.todict())
     
     def __setstate__(self, state):
-        id,loadedfields,data = state
-        meta = self._meta
-        field = meta.pk
-        setattr(self, 'id', field.to_python(id))
+        loadedfields = state[1]
         if loadedfields is not None:
             loadedfields = tuple(loadedfields)
-        self._loadedfields = loadedfields
-        fields = meta.dfields
-        for field in self.loadedfields():
-            value = field.value_from_data(self,data)
-            setattr(self,field.attname,field.to_python(value))
-        self._dbdata = data.get('__dbdata__',{})
+        self._meta.decoder(loadedfields)(self, state)
     
     @classmethod
     def from_base64_data(cls, **kwargs):
@@ -1,8 +1,9 @@
+import weakref
 from copy import copy
 from inspect import isgenerator
 
 from stdnet.exceptions import *
-from stdnet.utils import zip, JSPLITTER
+from stdnet.utils import zip, iteritems, JSPLITTER
 
 from .signals import *
 
@@ -53,13 +54,17 @@ class Q(object):
     name = ''
     def __init__(self, meta, session, select_related = None,
                  ordering = None, fields = None,
-                 get_field = None, name = None, keyword = None):
+                 get_field = None, name = None, keyword = None,
+                 readonly = False, prefetch_related = None, lazy = False):
         self._meta = meta
         self.session = session
         self.data = {'select_related': select_related,
                      'ordering': ordering,
                      'fields': fields,
-                     'get_field': get_field}
+                     'get_field': get_field,
+                     'readonly': readonly,
+                     'prefetch_related': prefetch_related,
+                     'lazy': lazy}
         self.name = name if name is not None else self.name
         self.keyword = keyword if keyword is not None else self.keyword 
         
@@ -86,6 +91,10 @@ class Q(object):
     @property
     def _get_field(self):
         return self.data['get_field']
+    
+    @property
+    def readonly(self):
+        return self.data['readonly']
         
     @property
     def backend(self):
@@ -212,6 +221,9 @@ class QuerySet(QueryElement):
     name = 'id'
     def __init__(self, *args, **kwargs):
         self.unique = kwargs.pop('unique',False)
+        self.bitmap = kwargs.pop('bitmap',False)
+        self.counts = kwargs.pop('counts',False)
+        self.composite = kwargs.pop('composite',False)
         self.lookup = kwargs.pop('lookup','in')
         super(QuerySet,self).__init__(*args,**kwargs)
     
@@ -338,7 +350,8 @@ criteria and options associated with it.
 
 .. attribute:: ordering
 
-    optional ordering field.
+    optional ordering field, or a tuple of ordering fields when sorting
+    by several fields.
     
 .. attribute:: text
 
@@ -454,16 +467,23 @@ the :meth:`union` method.'''
         q.intersections += queries
         return q
         
-    def sort_by(self, ordering):
-        '''Sort the query by the given field
+    def sort_by(self, *orderings):
+        '''Sort the query by the given fields
         
-:parameter ordering: a string indicating the class:`Field` name to sort by.
+:parameter orderings: strings indicating the class:`Field` names to sort by.
     If prefixed with ``-``, the sorting will be in descending order, otherwise
-    in ascending order.
+    in ascending order. Additional fields sort elements with equal values
+    of the previous ones::
+    
+        qs.sort_by('ccy', '-size', 'id')
+        
 :return type: a new :class:`Query` instance.
 '''
-        if ordering:
-            ordering = self._meta.get_sorting(ordering,QuerySetError)
+        get_sorting = self._meta.get_sorting
+        ordering = tuple((get_sorting(o, QuerySetError) for o in orderings\
+                          if o))
+        if len(ordering) < 2:
+            ordering = ordering[0] if ordering else None
         q = self._clone()
         q.data['ordering'] = ordering
         return q
@@ -506,16 +526,29 @@ If Your model contains more than one foreign key, you can use this function
 in a generative way::
 
     qs = myquery.load_related('rel1').load_related('rel2','field1','field2')
+    
+Foreign keys of related models are followed by joining field names with
+a double underscore, the intermediate models are loaded too::
+
+    qs = session.query(Position).load_related('instrument__issuer', 'name')
            
 :rtype: a new :class:`Query`.'''
         meta = self._meta
-        if related in meta.dfields:
-            field = meta.dfields[related]
-            if not hasattr(field,'relmodel'):
-                raise FieldError('Load related does not apply to "{0}"'\
-                                 .format(related))
-        else:
-            raise FieldError('Unknown field "{0}"'.format(related))
+        names = related.split(JSPLITTER)
+        for name in names:
+            if name in meta.dfields:
+                field = meta.dfields[name]
+                if not hasattr(field,'relmodel'):
+                    raise FieldError('Load related does not apply to "{0}"'\
+                                     .format(related))
+                # only foreign keys can be followed to other models
+                if len(names) > 1 and (field.relmodel is None or\
+                                       field in meta.multifields):
+                    raise FieldError('Cannot follow "{0}" in "{1}"'\
+                                     .format(name, related))
+                meta = field.relmodel._meta if field.relmodel else None
+            else:
+                raise FieldError('Unknown field "{0}"'.format(related))
         q = self._clone()
         rf = set(related_fields)
         # if is always loaded.
@@ -526,11 +559,49 @@ in a generative way::
         else:
             d = {}
         q.data['select_related'] = d
-        if field.name in d:
-            fields = d[field.name]
+        # intermediate models are loaded with all their fields by default
+        for n in range(1, len(names)):
+            d.setdefault(JSPLITTER.join(names[:n]), set())
+        if related in d:
+            fields = d[related]
             fields.update(rf)
         else:
-            d[field.name] = rf
+            d[related] = rf
+        # foreign keys followed by nested relations must be loaded
+        for name in d:
+            if JSPLITTER in name:
+                parent, child = name.rsplit(JSPLITTER, 1)
+                if d[parent]:
+                    d[parent].add(child)
+        return q
+    
+    def prefetch_related(self, *related):
+        '''It returns a new :class:`Query` which loads the instances of the
+related managers *related* of all loaded elements, one call to the server for
+each manager. *related* are the names of reverse :class:`ForeignKey` or
+:class:`ManyToManyField` relationships::
+
+    for fund in session.query(Fund).prefetch_related('positions'):
+        positions = fund.positions.query().all()
+        
+The first query of each related manager uses the loaded instances, until it
+is filtered further. All fields of the related instances are loaded.
+
+:rtype: a new :class:`Query`.'''
+        meta = self._meta
+        for name in related:
+            if name not in meta.related:
+                raise FieldError('Unknown related manager "{0}"'.format(name))
+            field = meta.related[name].field
+            if not field.index or field.bitmap:
+                raise FieldError('Cannot prefetch "{0}", field "{1}" is not\
+ an index'.format(name, field))
+        q = self._clone()
+        prefetch = list(q.data['prefetch_related'] or ())
+        for name in related:
+            if name not in prefetch:
+                prefetch.append(name)
+        q.data['prefetch_related'] = tuple(prefetch)
         return q
     
     def load_only(self, *fields):
@@ -548,6 +619,37 @@ data intensive fields you don't need.
         q.data['fields'] = tuple(fs) if fs else None
         return q
     
+    def lazy_load(self):
+        '''Returns a new :class:`Query` whose instances load the fields
+excluded by :meth:`load_only` or :meth:`dont_load` the first time they are
+accessed. The field is loaded, with one request, for all the instances loaded
+by the query which don't have it, rather than one instance at a time::
+
+    for inst in qs.load_only('name').lazy_load():
+        print(inst.description)
+'''
+        q = self._clone()
+        q.data['lazy'] = True
+        return q
+    
+    def records(self):
+        '''Returns a new :class:`Query` which loads read-only
+:class:`Record` rather than model instances. Records have the same
+attributes as the model instances but use much less memory since they
+have no instance dictionary and they are not added to the :attr:`session`.
+This is a :ref:`performance boost <increase-performance>` when loading
+large amount of data which won't be modified.
+It can be combined with :meth:`load_only` and :meth:`dont_load`::
+
+    for r in qs.load_only('name','ccy').records():
+        ...
+
+Use :meth:`Record.to_instance` to obtain an editable instance.
+'''
+        q = self._clone()
+        q.data['readonly'] = True
+        return q
+    
     def dont_load(self, *fields):
         '''Works like :meth:`load_only` to provides a
 :ref:`performance boost <increase-performance>` in cases when you need
@@ -573,7 +675,9 @@ is returned directly without performing any query.'''
                 return el
         # not there, perform the database query
         qs = self.filter(**kwargs)
-        items = qs.items()
+        items = qs._load_unique()
+        if items is None:
+            items = qs.items()
         if items:
             if len(items) == 1:
                 return items[0]
@@ -583,6 +687,40 @@ is returned directly without performing any query.'''
         else:
             raise self.model.DoesNotExist
     
+    def get_many(self, ids):
+        '''Return a list of instances of the model with primary keys in the
+iterable *ids*, in the same order. Instances are taken from the
+:attr:`session`, from the :attr:`Metaclass.cache` of the model, if
+available, and the remaining ones are loaded in one request. Primary keys
+of instances which don't exist are skipped and the filters of the query are
+not applied.'''
+        meta = self._meta
+        ids = [meta.pk_to_python(id) for id in ids]
+        session = self.session
+        cache = meta.cache
+        found = {}
+        data = []
+        missing = []
+        for id in ids:
+            if id in found:
+                continue
+            el = session.get(self.model, id)
+            if el is not None:
+                found[id] = el
+                continue
+            row = cache.get(self.backend, id) if cache is not None else None
+            if row is not None:
+                data.append((id, None, row))
+            else:
+                missing.append(id)
+        if data:
+            for el in self._loaded(self.backend.make_objects(meta, data)):
+                found[el.id] = el
+        if missing:
+            for el in session.query(self.model).filter(id__in=missing):
+                found[el.id] = el
+        return [found[id] for id in ids if id in found]
+    
     def count(self):
         '''Return the number of objects in ``self``.
 This method is efficient since the :class:`Query` does not
@@ -591,6 +729,35 @@ It construct the queries and count the
 objects on the server side.'''
         return self.backend_query().count()
     
+    def count_by(self, field):
+        '''Return a dictionary mapping the values of *field* to the number of
+matched elements with that value::
+
+    session.query(Instrument).count_by('ccy')
+    
+If *field* is counted (its :attr:`Field.counts` attribute is ``True``), its
+counts are complete and the :class:`Query` has no filters, the histogram is
+obtained from the index counts in one call. Otherwise the values of *field*
+are loaded.'''
+        meta = self._meta
+        fld = meta.dfields.get(field)
+        if fld is None or fld not in meta.scalarfields:
+            raise FieldError('Cannot count by field "{0}" of {1}'\
+                             .format(field, meta))
+        q = self.construct()
+        if isinstance(q, EmptyQuery):
+            return {}
+        if fld.counts and q.keyword == 'set' and q.name == 'id' and\
+                not q.underlying:
+            counts = self.backend.field_counts(meta, fld)
+            if counts is not None:
+                return dict(((fld.to_python(v), c) for v, c in\
+                             iteritems(counts) if c))
+        result = {}
+        for value in self.get_field(fld.name).all():
+            result[value] = result.get(value, 0) + 1
+        return result
+    
     def delete(self):
         '''Delete all matched elements of the :class:`Query`. It returns the
 list of ids deleted.'''
@@ -599,6 +766,103 @@ list of ids deleted.'''
             session.delete(self)
         return t.deleted.get(self._meta)
     
+    def update(self, **values):
+        '''Update scalar fields of all matched elements of the :class:`Query`
+in the backend server, without loading them. Indices of the updated fields
+are maintained by the server. For example::
+
+    qs = session.query(Instrument).filter(ccy='EUR')
+    qs.update(type='bond', description=None)
+    
+The ``post_update`` signal is sent with the list of updated ``ids``.
+It returns the number of instances updated.'''
+        meta = self._meta
+        if not values:
+            raise QuerySetError('Nothing to update')
+        data = {}
+        removed = []
+        pyvalues = {}
+        for name, value in values.items():
+            field = meta.dfields.get(name)
+            if field is None or field is meta.pk or\
+                                field not in meta.scalarfields:
+                raise FieldError('Cannot update field "{0}" of {1}'\
+                                 .format(name, meta))
+            value = field.to_python(value)
+            pyvalues[field.attname] = value
+            svalue = field.serialize(value)
+            if isinstance(svalue, dict):
+                raise FieldError('Cannot update field "{0}" of {1}'\
+                                 .format(name, meta))
+            if (svalue is None or svalue == '') and field.required:
+                raise FieldValueError("Field '{0}' is required for '{1}'."\
+                                      .format(name, meta))
+            if svalue is None:
+                removed.append(field.attname)
+            else:
+                data[field.attname] = svalue
+        score = ''
+        ordering = meta.ordering
+        if ordering and not ordering.auto and ordering.field.name in values:
+            value = pyvalues[ordering.field.attname]
+            if value is None:
+                raise FieldValueError('Cannot remove ordering field "{0}"'\
+                                      .format(ordering.field.name))
+            # the score of the python value, as when saving an instance
+            score = ordering.field.scorefun(value)
+        q = self.backend_query()
+        if isinstance(q, EmptyQuery) or not q.count():
+            return 0
+        ids, errors = self.backend.update_query(q, data, removed, score)
+        ids = [meta.pk_to_python(id) for id in ids]
+        self.backend.invalidate(meta, ids)
+        session = self.session
+        # Instances in the session get the new values
+        for id in ids:
+            instance = session.get(self.model, id)
+            if instance is not None:
+                for attname, value in pyvalues.items():
+                    setattr(instance, attname, value)
+                original = instance._dbdata.get('original')
+                if original is not None:
+                    original.update(data)
+                    for attname in removed:
+                        original.pop(attname, None)
+        if ids:
+            post_update.send(self.model, ids=ids, fields=tuple(values),
+                             session=session)
+        if errors:
+            raise CommitException('\n'.join(errors), failures=len(errors))
+        return len(ids)
+    
+    def incr(self, field, delta=1):
+        '''Atomically increment the numeric *field* of all matched elements
+of the :class:`Query` by *delta* in the backend server, without loading them.
+Indices of *field* are updated by the server::
+
+    session.query(Page).filter(site='blog').incr('views')
+    
+:rtype: a list of two elements tuples containing the id and the new value.'''
+        meta = self._meta
+        field = meta.counter_field(field)
+        q = self.backend_query()
+        if isinstance(q, EmptyQuery) or not q.count():
+            return []
+        result = self.backend.incr_field(meta, field, field.python_type(delta),
+                                         backend_query=q)
+        self.backend.invalidate(meta, [id for id, _ in result])
+        session = self.session
+        values = []
+        for id, value in result:
+            id = meta.pk_to_python(id)
+            instance = session.get(self.model, id)
+            if instance is not None:
+                setattr(instance, field.attname, field.to_python(value))
+                if 'original' in instance._dbdata:
+                    instance._dbdata['original'][field.attname] = value
+            values.append((id, field.to_python(value)))
+        return values
+    
     def construct(self):
         '''Build the :class:`QueryElement` representing this query.'''
         if self.__construct is None:
@@ -640,6 +904,33 @@ an exception is raised.
     ############################################################################
     # PRIVATE METHODS
     ############################################################################    
+    def _load_unique(self):
+        '''If the query is a lookup on a single value of the id or of a
+unique field, load the instance in one call to the backend.
+Return ``None`` otherwise.'''
+        if not self.fargs or len(self.fargs) != 1 or self.eargs or\
+                self.unions or self.intersections or self.text or\
+                self.exclude_fields or self.select_related or\
+                self._get_field:
+            return
+        name, value = tuple(self.fargs.items())[0]
+        meta = self._meta
+        field = meta.dfields.get(name)
+        if field is None or not field.unique or value is None or\
+                iterable(value) or isinstance(value, Q) or\
+                meta.pk.type == 'composite':
+            return
+        if field is meta.pk and meta.cache is not None and not self.fields\
+                and not self.readonly:
+            data = meta.cache.get(self.backend, value)
+            if data is not None:
+                return self._loaded(self.backend.make_objects(meta,
+                                                        [(value, None, data)]))
+        return self._loaded(self.backend.load_unique(meta, field,
+                                                     field.serialize(value),
+                                                     self.fields,
+                                                     self.readonly))
+    
     def clear(self):
         self.__construct = None
         self.__slice_cache = None
@@ -657,6 +948,7 @@ an exception is raised.
                 # no values to filter on. empty result.
                 if not f.valid:
                     return EmptyQuery(self._meta, self.session)
+            fargs = self.composite_lookups(fargs)
         else:
             fargs = None
         
@@ -702,6 +994,26 @@ an exception is raised.
 
     def aggregate(self, kwargs):
         return sorted(self._aggregate(kwargs), key = lambda x : x.name)
+    
+    def composite_lookups(self, fargs):
+        '''Replace equality lookups on all the fields of a composite index
+with a single lookup on the index, once the index includes all instances.'''
+        for index in self._meta.composite_indices:
+            lookups = {}
+            for q in fargs:
+                if q.lookup == 'in' and not q.unique and len(q) == 1 and\
+                        not isinstance(q.underlying[0], Q):
+                    lookups[q.name] = q
+            names = [f.attname for f in index.fields]
+            if all((name in lookups for name in names)) and\
+                    self.backend.index_complete(self._meta, index):
+                used = set((id(lookups[name]) for name in names))
+                value = index.value((lookups[name].underlying[0]\
+                                     for name in names))
+                fargs = [q for q in fargs if id(q) not in used]
+                fargs.append(queryset(self, name=index.attname,
+                                      underlying=(value,), composite=True))
+        return sorted(fargs, key = lambda x : x.name)
         
     def _aggregate(self, kwargs):
         '''Aggregate lookup parameters.'''
@@ -739,6 +1051,8 @@ an exception is raised.
             data = {'name':field.attname,
                     'underlying':tuple(values),
                     'unique':field.unique,
+                    'bitmap':field.bitmap,
+                    'counts':field.counts,
                     'lookup':lookup}
             yield queryset(self, **data)
         
@@ -757,17 +1071,63 @@ of instances of models.'''
         if seq is not None:
             return seq
         else:
-            seq = []
-            session = self.session
-            items = self.backend_query().items(slic)
-            if isinstance(items, Exception):
-                raise items
-            model = self.model
-            for el in items:
-                if isinstance(el,model):
-                    session.add(el,modified=False)
-                seq.append(el)
+            seq = self._loaded(self.backend_query().items(slic))
             cache[key] = seq
             return seq
+    
+    def sample(self, n):
+        '''Return a list of at most *n* elements of the :class:`Query`
+chosen at random by the server. For models without ordering it uses
+``SRANDMEMBER`` so that its cost does not depend on the size of the query::
+
+    session.query(Instrument).filter(ccy='EUR').sample(10)
+'''
+        q = self.backend_query()
+        if isinstance(q, EmptyQuery) or n <= 0:
+            return []
+        return self._loaded(q.sample(n))
+    
+    def _loaded(self, items):
+        # Add instances loaded from the backend to the session
+        if isinstance(items, Exception):
+            raise items
+        seq = []
+        session = self.session
+        model = self.model
+        for el in items:
+            if isinstance(el,model):
+                session.add(el,modified=False)
+            seq.append(el)
+        if self.data['lazy']:
+            # Weak references, so that the loaded instances don't keep each
+            # other alive.
+            instances = [el for el in seq if isinstance(el, model) and\
+                         el._loadedfields is not None]
+            deferred = [weakref.ref(el) for el in instances]
+            for el in instances:
+                el._dbdata['deferred'] = deferred
+        if self.data['prefetch_related']:
+            self._prefetch(seq)
+        return seq
+    
+    def _prefetch(self, seq):
+        # Load the instances of the related managers in prefetch_related
+        # with one call each and store them in the loaded instances.
+        instances = [el for el in seq if isinstance(el, self.model)]
+        if not instances:
+            return
+        ids = [el.pkvalue() for el in instances]
+        session = self.session
+        for name in self.data['prefetch_related']:
+            manager = self._meta.related[name]
+            target = None
+            if hasattr(manager, 'through'):
+                target = manager.through._meta.dfields[manager.name_formodel]
+            result = self.backend.prefetch(manager.field, ids, target)
+            cache_name = manager.get_cache_name()
+            for instance, items in zip(instances, result):
+                for el in items:
+                    session.add(el, modified=False)
+                setattr(instance, cache_name, items)
 
         
\ No newline at end of file
@@ -193,6 +193,30 @@ of a related model.'''
         raise QuerySetError('Related manager can be accessed only from\
  a loaded instance of its related model.')
     
+    def get_cache_name(self):
+        return '_%s_prefetch' % self.field.related_name
+    
+    def prefetched(self, query):
+        '''Fill the cache of *query* with the instances loaded by
+:meth:`Query.prefetch_related` for the related instance, if available.
+The prefetched instances are used by one query only, queries obtained
+afterwards load the related instances from the server.'''
+        instance = self.related_instance
+        cache_name = self.get_cache_name()
+        items = getattr(instance, cache_name, None)
+        if items is not None:
+            delattr(instance, cache_name)
+            query.cache()[None] = list(items)
+        return query
+    
+    def clear_prefetched(self):
+        '''Remove the instances loaded by :meth:`Query.prefetch_related`
+for the related instance.'''
+        instance = self.related_instance
+        cache_name = self.get_cache_name()
+        if getattr(instance, cache_name, None) is not None:
+            delattr(instance, cache_name)
+    
         
 class One2ManyRelatedManager(RelatedManager):
     '''A specialised :class:`RelatedManager` for handling one-to-many
@@ -206,8 +230,8 @@ via a simple attribute of the model.'''
     
     def query(self, transaction = None):
         kwargs = {self.field.name: self.related_instance}
-        return super(RelatedManager,self).query(transaction = transaction)\
-                                         .filter(**kwargs)
+        return self.prefetched(super(RelatedManager,self).query(
+                            transaction = transaction).filter(**kwargs))
     
     def query_from_query(self, query):
         session = query.session
@@ -237,6 +261,7 @@ attribute of the model.'''
             '''Add *value*, an instance of ``self.formodel``,
             to the throw model.'''
             session, kw = self.session_kwargs(value, transaction)
+            self.clear_through_prefetched(value)
             try:
                 m = session.query(self.model).get(**kw)
                 if not kwargs:
@@ -251,9 +276,19 @@ attribute of the model.'''
             '''Remove *value*, an instance of ``self.model`` from the set of
     elements contained by the field.'''
             session, kwargs = self.session_kwargs(value, transaction)
+            self.clear_through_prefetched(value)
             query = session.query(self.model).filter(**kwargs)
             session.delete(query)
         
+        def clear_through_prefetched(self, value):
+            # The prefetched instances of both sides of the relationship
+            # are out of date once the through model changes.
+            self.clear_prefetched()
+            field = self.model._meta.dfields[self.name_formodel]
+            cache_name = '_%s_prefetch' % field.related_name
+            if getattr(value, cache_name, None) is not None:
+                delattr(value, cache_name)
+        
         def throughquery(self, transaction = None):
             return super(Many2ManyRelatedManager,self).query(
                                                     transaction = transaction)
@@ -261,7 +296,8 @@ attribute of the model.'''
         def query(self, transaction = None):
             ids = self.throughquery().get_field(self.name_formodel)
             session = self.session(transaction)
-            return session.query(self.formodel).filter(id__in = ids)
+            return self.prefetched(session.query(self.formodel)\
+                                          .filter(id__in = ids))
             
     Many2ManyRelatedManager.formodel = formodel
     Many2ManyRelatedManager.name_relmodel = name_relmodel
@@ -1,6 +1,10 @@
 import json
+import logging
+import threading
+import weakref
 from copy import copy
 from itertools import chain
+from collections import namedtuple
 
 from stdnet import getdb, ServerOperation
 from stdnet.utils import itervalues, zip
@@ -18,7 +22,18 @@ __all__ = ['Session',
            'Manager',
            'Transaction',
            'commit_when_no_transaction',
-           'withsession']
+           'withsession',
+           'ChangeRecord',
+           'WriteBehindSession']
+
+logger = logging.getLogger('stdnet.odm')
+
+
+ChangeRecord = namedtuple('ChangeRecord', 'seq model id action fields score')
+'''A record of the change log of a model, obtained from
+:meth:`Session.read_changes`. The *action* is one of ``add``, ``update``
+and ``delete`` and *fields* is the tuple of attribute names of the fields
+changed.'''
 
 
 def is_query(query):
@@ -71,6 +86,59 @@ a :class:`SessionNotAvailable` exception.
     _.__doc__ = f.__doc__        
     return _
     
+class IdentityMap(object):
+    '''The map of unmodified instances loaded in a :class:`SessionModel`,
+used when :attr:`Session.weak` or :attr:`Session.max_loaded` are set.
+If *weak* is ``True`` instances are held by weak references and leave the
+map once they are no longer referenced. If *max_loaded* is given, the least
+recently used instances above *max_loaded* are evicted, or only lose their
+strong reference if *weak* is ``True``.'''
+    def __init__(self, weak=False, max_loaded=None):
+        self.weak = weak
+        self.max_loaded = max_loaded
+        self._data = weakref.WeakValueDictionary() if weak else {}
+        self._recent = OrderedDict() if max_loaded else None
+        
+    def __len__(self):
+        return len(self._data)
+    
+    def __contains__(self, iid):
+        return iid in self._data
+    
+    def __iter__(self):
+        return iter(list(self._data.keys()))
+    
+    def values(self):
+        return list(self._data.values())
+    itervalues = values
+    
+    def get(self, iid, default=None):
+        instance = self._data.get(iid)
+        if instance is None:
+            return default
+        self._touch(iid, instance)
+        return instance
+    
+    def __setitem__(self, iid, instance):
+        self._data[iid] = instance
+        self._touch(iid, instance)
+        
+    def pop(self, iid, *default):
+        if self._recent is not None:
+            self._recent.pop(iid, None)
+        return self._data.pop(iid, *default)
+    
+    def _touch(self, iid, instance):
+        recent = self._recent
+        if recent is not None:
+            recent.pop(iid, None)
+            recent[iid] = instance
+            while len(recent) > self.max_loaded:
+                old, _ = recent.popitem(last=False)
+                if not self.weak:
+                    self._data.pop(old, None)
+                    
+                    
 class SessionModel(SessionModelBase):
     '''A :class:`SessionModel` is the container of all objects for a given
 :class:`Model` in a stdnet :class:`Session`.'''
@@ -80,7 +148,10 @@ class SessionModel(SessionModelBase):
         self._deleted = OrderedDict()
         self._delete_query = []
         self._modified = OrderedDict()
-        self._loaded = {}
+        if session.weak or session.max_loaded:
+            self._loaded = IdentityMap(session.weak, session.max_loaded)
+        else:
+            self._loaded = {}
     
     def __len__(self):
         return len(self._new) + len(self._modified) + len(self._deleted) +\
@@ -277,6 +348,12 @@ Process results after a commit.
                     raise InvalidTransaction('{0} session received id "{1}"\
  which is not in the session.'.format(self,result.iid))
                 setattr(instance, instance._meta.pkname(), id)
+                dbdata = instance._dbdata
+                if result.persistent and 'cleaned_data' in dbdata:
+                    # The committed data is now the backend data
+                    original = dict.fromkeys(dbdata.get('original', ()))
+                    original.update(dbdata['cleaned_data'])
+                    dbdata['original'] = original
                 instance = self.add(instance,
                                     modified = False,
                                     persistent = result.persistent)
@@ -437,6 +514,9 @@ Results can contain errors.
             sm = session.model(meta, True)
             saved, deleted, errors = sm.post_commit(response)
             exceptions.extend(errors)
+            if meta.cache is not None:
+                meta.cache.evict(session.backend,
+                                 chain(deleted, (i.id for i in saved)))
             if deleted:
                 self.deleted[meta] = deleted
                 if self.signal_delete:
@@ -479,6 +559,87 @@ Results can contain errors.
         return sent
         
 
+def snapshot(instance):
+    '''A copy of the validated *instance* built from its serialized data, so
+that it can be committed by another thread while *instance* is changed.'''
+    meta = instance._meta
+    dbdata = instance._dbdata
+    data = dict(dbdata['cleaned_data'])
+    copy = meta.maker()
+    attrs = copy.__dict__
+    for field, _ in instance.fieldvalue_pairs():
+        attrs[field.attname] = field.to_python(field.value_from_data(copy,
+                                                                     data))
+    attrs['_loadedfields'] = instance._loadedfields
+    pkname = meta.pkname()
+    setattr(copy, pkname, instance.pkvalue())
+    if pkname in dbdata:
+        copy._dbdata[pkname] = dbdata[pkname]
+    if 'original' in dbdata:
+        copy._dbdata['original'] = dict(dbdata['original'])
+    return copy
+
+
+def set_persistent(instance, written):
+    # Copy the id and the committed values of the snapshot *written* into
+    # *instance*
+    pkname = instance._meta.pkname()
+    id = written.pkvalue()
+    setattr(instance, pkname, id)
+    instance._dbdata[pkname] = id
+    if 'original' in written._dbdata:
+        instance._dbdata['original'] = dict(written._dbdata['original'])
+    instance.state(update=True)
+    
+    
+class WriteBehindTransaction(Transaction):
+    '''The :class:`Transaction` of a :class:`WriteBehindSession`. Its commit
+validates the changed instances and hands a snapshot of them, and the ids of
+deleted instances, to the session queue. Instances are not accessed by the
+background thread, so that they can be changed once the commit returns.'''
+    def commit(self):
+        if not self.is_open:
+            raise InvalidTransaction('Invalid operation.\
+ Transaction already closed.')
+        session = self.session
+        session.sync()
+        models = []
+        structures = False
+        for sm in session:
+            if sm.meta.model._model_type == 'structure':
+                structures = structures or bool(sm.dirty)
+            else:
+                models.append(sm)
+        for sm in models:
+            for instance in sm.iterdirty():
+                if not instance.is_valid():
+                    raise FieldValueError(
+                                json.dumps(instance._dbdata['errors']))
+        entries = []
+        for sm in models:
+            for q in sm._delete_query:
+                entries.append((None, 'query', q._clone()))
+            sm._delete_query = []
+            for instance in tuple(sm.iterdirty()):
+                sm.pop(instance)
+                entries.append((instance, 'save',
+                                (instance, snapshot(instance))))
+            for instance in tuple(itervalues(sm._deleted)):
+                sm.pop(instance)
+                entries.append((instance, 'delete',
+                                (sm.meta, instance.pkvalue())))
+        session.enqueue(entries)
+        if structures:
+            # Structures are committed immediately
+            super(WriteBehindTransaction, self).commit()
+        else:
+            self.result = None
+            self.close()
+        # Errors of previous writes are raised once the commit is queued
+        session.raise_errors()
+        return self
+        
+        
 class Session(object):
     '''The manager of persistent operations on the backend data server for
 :class:`StdModel` classes.
@@ -495,10 +656,27 @@ class Session(object):
 .. attribute:: query_class
 
     class for querying. Default is :class:`Query`.
+    
+.. attribute:: weak
+
+    If ``True`` unmodified instances loaded in the session are held by weak
+    references, so that only new, modified and deleted instances are kept
+    alive by the session. Default ``False``.
+    
+.. attribute:: max_loaded
+
+    Optional maximum number of unmodified instances of each model held by
+    the session. The least recently used instances are evicted first.
+    Default ``None``.
 '''
     _structures = {}
-    def __init__(self, backend, query_class = None):
+    transaction_class = Transaction
+    
+    def __init__(self, backend, query_class = None, weak = False,
+                 max_loaded = None):
         self.backend = getdb(backend)
+        self.weak = weak
+        self.max_loaded = max_loaded
         self.transaction = None
         self._models = OrderedDict()
         self.query_class = query_class or Query
@@ -518,7 +696,8 @@ class Session(object):
     
     def session(self):
         '''Create a new session from this :class:`Session`'''
-        return self.__class__(self.backend,self.query_class)
+        return self.__class__(self.backend, self.query_class, self.weak,
+                              self.max_loaded)
         
     @property
     def dirty(self):
@@ -550,7 +729,7 @@ If this :class:`Session` is already within a transaction, an error is raised.'''
         if self.transaction is not None:
             raise InvalidTransaction("A transaction is already begun.")
         else:
-            self.transaction = Transaction(self, **options)
+            self.transaction = self.transaction_class(self, **options)
         return self.transaction
     
     def query(self, model, query_class = None, **kwargs):
@@ -584,6 +763,63 @@ from the **kwargs** parameters.
         sm = self._models.get(model._meta)
         if sm:
             return sm.get(id)
+    
+    def read_changes(self, model, count=100):
+        '''Read at most *count* :class:`ChangeRecord` from the change log of
+*model*, oldest first. Records are not removed until they are acknowledged
+with :meth:`ack_changes`, so that a consumer can process them in batches::
+
+    records = session.read_changes(Instrument)
+    ...
+    if records:
+        session.ack_changes(Instrument, records[-1].seq)
+'''
+        meta = model._meta
+        if not meta.changelog:
+            raise ValueError('{0} has no change log'.format(meta))
+        tpy = meta.pk_to_python
+        records = []
+        for seq, id, action, fields, score in\
+                self.backend.read_changes(meta, count):
+            fields = tuple(fields.split(',')) if fields else ()
+            records.append(ChangeRecord(seq, model, tpy(id), action, fields,
+                                        float(score) if score else None))
+        return records
+    
+    def ack_changes(self, model, seq):
+        '''Acknowledge the records of the change log of *model* with
+sequence number up to *seq*, removing them from the log.'''
+        return self.backend.ack_changes(model._meta, seq)
+    
+    def load_fields(self, instances, *fields):
+        '''Load *fields* of persistent *instances* of a model which don't
+have them, with one request to the backend server. Fields already available
+in an instance are not changed.
+        
+:parameter instances: an iterable over instances of the same model.
+:parameter fields: names of fields to load.
+'''
+        instances = [i for i in instances if i.state().persistent]
+        if not instances:
+            return
+        meta = instances[0]._meta
+        fields = [meta.dfields[name] for name in fields if name in meta.dfields]
+        attnames = set((f.attname for f in fields))
+        instances = [i for i in instances if attnames.difference(i.__dict__)]
+        if not instances:
+            return
+        ids = [i.pkvalue() for i in instances]
+        result = self.backend.load_fields(meta, ids,
+                                          [f.attname for f in fields])
+        for instance, values in zip(instances, result):
+            attrs = instance.__dict__
+            loaded = instance._loadedfields
+            for field, value in zip(fields, values):
+                if field.attname not in attrs:
+                    attrs[field.attname] = field.to_python(value)
+                    if loaded is not None and field.name not in loaded:
+                        loaded += (field.name,)
+            instance._loadedfields = loaded
         
     @commit_element_when_no_transaction
     def add(self, instance, modified = True):
@@ -648,6 +884,173 @@ If no transaction is in progress, this method open one a."""
         pass
       
         
+class WriteBehindSession(Session):
+    '''A :class:`Session` which writes changes to the backend server in a
+background thread, for models which can accept eventual consistency.
+A commit queues the changed and deleted instances and returns immediately.
+Repeated changes of the same instance are coalesced into one write and
+queued instances are committed in chunks of *chunk_size*, one request per
+chunk. At most *max_pending* instances are queued, further commits block
+until the background thread has written enough of them.
+
+A commit queues a snapshot of the serialized data of the instances, which
+are not accessed by the background thread. The ids of new instances are set
+by the next commit or :meth:`flush` in the thread using the session.
+Errors which occurred while writing are raised by the next commit, once its
+changes are queued, or by :meth:`flush`.
+
+Use :meth:`flush` to wait until all queued instances are written and
+:meth:`close` to stop the background thread. Commit signals are sent by
+the background thread with the snapshots of the instances.
+
+:parameter max_pending: maximum number of queued instances.
+:parameter chunk_size: maximum number of instances committed in one
+    request.
+'''
+    transaction_class = WriteBehindTransaction
+    
+    def __init__(self, backend, query_class=None, max_pending=10000,
+                 chunk_size=1000, weak=False, max_loaded=None):
+        super(WriteBehindSession, self).__init__(backend, query_class, weak,
+                                                 max_loaded)
+        self.max_pending = max_pending
+        self.chunk_size = chunk_size
+        self.errors = []
+        self._pending = OrderedDict()
+        self._written = []
+        self._writing = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        
+    def session(self):
+        return self.__class__(self.backend, self.query_class,
+                              self.max_pending, self.chunk_size, self.weak,
+                              self.max_loaded)
+        
+    @property
+    def pending(self):
+        '''Number of instances queued and not yet written.'''
+        return len(self._pending) + self._writing
+        
+    def enqueue(self, entries):
+        '''Queue a list of ``(instance, action, element)`` entries. Entries
+for an instance already queued replace the previous one.'''
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            for instance, action, element in entries:
+                if instance is None:
+                    key = id(element)
+                else:
+                    key = (instance._meta, instance.state().iid)
+                if key in self._pending:
+                    self._pending.pop(key)
+                else:
+                    while len(self._pending) >= self.max_pending:
+                        self._condition.wait()
+                self._pending[key] = (action, element)
+            self._condition.notify_all()
+            
+    def flush(self):
+        '''Wait until all queued instances have been written. If errors
+occurred while writing, the first one is raised.'''
+        with self._condition:
+            while self._pending or self._writing:
+                self._condition.wait()
+        self.sync()
+        self.raise_errors()
+        
+    def sync(self):
+        '''Set the ids and committed values of the instances written by the
+background thread. Called by commits and :meth:`flush`.'''
+        with self._condition:
+            written, self._written = self._written, []
+        for instance, written in written:
+            state = instance.state()
+            if state.deleted:
+                continue
+            sm = self.model(instance._meta, True)
+            iid = state.iid
+            modified = iid in sm._new or iid in sm._modified
+            sm.pop(instance)
+            set_persistent(instance, written)
+            sm.add(instance, modified=modified)
+        
+    def raise_errors(self):
+        '''Raise the first error which occurred while writing, if any, and
+clear the errors.'''
+        with self._condition:
+            errors, self.errors = self.errors, []
+        if errors:
+            raise errors[0]
+        
+    def close(self):
+        '''Write all queued instances and stop the background thread.'''
+        try:
+            self.flush()
+        finally:
+            with self._condition:
+                thread, self._thread = self._thread, None
+                if thread is not None:
+                    self._pending[None] = None
+                    self._condition.notify_all()
+            if thread is not None:
+                thread.join()
+                
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                entries = []
+                while self._pending and len(entries) < self.chunk_size:
+                    key, (action, element) = self._pending.popitem(last=False)
+                    if key is None:
+                        # closing
+                        return
+                    entries.append((key, action, element))
+                self._writing = len(entries)
+                self._condition.notify_all()
+            error = None
+            try:
+                self._write(entries)
+            except Exception as e:
+                logger.error('Write behind commit failed. %s', e)
+                error = e
+            written = [(key, element) for key, action, element in entries\
+                       if action == 'save' and element[1].state().persistent]
+            with self._condition:
+                if error is not None:
+                    self.errors.append(error)
+                for key, (instance, copy) in written:
+                    self._written.append((instance, copy))
+                    # a new instance queued again while it was written
+                    entry = self._pending.get(key)
+                    if entry and entry[0] == 'save' and\
+                            not entry[1][1].state().persistent:
+                        set_persistent(entry[1][1], copy)
+                self._writing = 0
+                self._condition.notify_all()
+                
+    def _write(self, entries):
+        session = Session(self.backend, self.query_class)
+        deleted = OrderedDict()
+        with session.begin():
+            for key, action, element in entries:
+                if action == 'query':
+                    element.session = session
+                    session.delete(element)
+                elif action == 'delete':
+                    meta, id = element
+                    deleted.setdefault(meta, []).append(id)
+                else:
+                    session.add(element[1])
+            for meta, ids in deleted.items():
+                session.delete(session.query(meta.model).filter(id__in=ids))
+        
+        
 class Manager(object):
     '''A manager class for models. Each :class:`StdModel`
 contains at least one manager which can be accessed via the ``objects``
@@ -755,6 +1158,77 @@ if their managers have the same backend database.'''
             el,created = session.get_or_create(self.model, **kwargs)
         return el,created
     
+    def bulk_create(self, instances, batch_size=1000, return_ids=True,
+                    signal=False):
+        '''Add a large number of new *instances* to the backend server
+bypassing the :class:`Session`. Instances are validated, serialized and sent
+to the server in batches, they are not added to any session. Models with
+structure fields cannot be bulk created.
+
+:parameter instances: iterable over new instances of :attr:`model`.
+:parameter batch_size: number of instances sent to the server in one request.
+:parameter return_ids: if ``True`` the instances are updated with the
+    id from the backend server and the list of ids is returned.
+:parameter signal: if ``True`` the ``pre_commit`` and ``post_commit``
+    signals are sent for each batch, with a new :class:`Session` and a
+    :class:`Transaction` which is not begun, as for a session commit.
+:rtype: a list of ids if *return_ids* is ``True``, otherwise the number
+    of instances added.'''
+        if not self.backend:
+            raise ModelNotRegistered("Model '{0}' is not registered with a\
+ backend database. Cannot use manager.".format(self.model._meta))
+        meta = self.model._meta
+        if meta.multifields:
+            raise ValueError('{0} has structure fields which bulk_create does'
+                             ' not save'.format(meta))
+        if signal:
+            session = self.session()
+            transaction = session.transaction_class(session,
+                                                    name='bulk create')
+        ids = []
+        count = 0
+        errors = []
+        batch = []
+        instances = iter(instances)
+        while True:
+            for instance in instances:
+                batch.append(instance)
+                if len(batch) == batch_size:
+                    break
+            if not batch:
+                break
+            if signal:
+                pre_commit.send(self.model, instances=batch,
+                                transaction=transaction)
+            saved = []
+            results = self.backend.bulk_commit(meta, batch)
+            for instance, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    errors.append(result)
+                    continue
+                count += 1
+                if return_ids or signal:
+                    pkname = meta.pkname()
+                    id = meta.pk_to_python(result.id)
+                    setattr(instance, pkname, id)
+                    dbdata = instance._dbdata
+                    dbdata[pkname] = id
+                    dbdata['original'] = dbdata['cleaned_data']
+                    dbdata.pop('state', None)
+                    saved.append(instance)
+                    if return_ids:
+                        ids.append(id)
+            if signal and saved:
+                transaction.saved.setdefault(meta, []).extend(saved)
+                post_commit.send(self.model, instances=saved, session=session,
+                                 transaction=transaction)
+            batch = []
+        if errors:
+            failures = len(errors)
+            raise CommitException('\n\n'.join((str(e) for e in errors)),
+                                  failures=failures)
+        return ids if return_ids else count
+    
     def __copy__(self):
         cls = self.__class__
         obj = cls.__new__(cls)
@@ -6,7 +6,8 @@ __all__ = ['class_prepared',
            'pre_commit',
            'pre_delete',
            'post_commit',
-           'post_delete']
+           'post_delete',
+           'post_update']
 
 
 class_prepared = Signal(providing_args=["class"])
@@ -17,4 +18,5 @@ post_init = Signal(providing_args=["instance"])
 pre_commit = Signal(providing_args=["instances", "transaction"])
 pre_delete = Signal(providing_args=["instances", "transaction"])
 post_commit = Signal(providing_args=["instances", "session", "transaction"])
-post_delete = Signal(providing_args=["instances", "session", "transaction"])
+post_delete = Signal(providing_args=["instances", "session", "transaction"])
+post_update = Signal(providing_args=["ids", "fields", "session"])
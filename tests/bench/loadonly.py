@@ -1,10 +1,73 @@
 '''Benchmark deletion of instances.'''
-from stdnet import test
+from datetime import date
+
+from stdnet import test, odm
 from stdnet.utils import populate, zip
 
 from examples.data import FinanceTest, Instrument, Fund, Position
 
 
+class WideModel(odm.StdModel):
+    '''A model with 10 scalar fields for benchmarking row decoding.'''
+    code = odm.SymbolField()
+    group = odm.SymbolField()
+    ccy = odm.SymbolField()
+    description = odm.CharField()
+    quantity = odm.IntegerField()
+    counter = odm.IntegerField()
+    price = odm.FloatField()
+    volatility = odm.FloatField()
+    dt = odm.DateField()
+    active = odm.BooleanField()
+    
+    
+def legacy_decode(instance, state):
+    '''The per-field decoding performed by ``StdModel.__setstate__`` before
+the introduction of :meth:`stdnet.odm.Metaclass.decoder`.'''
+    id, loadedfields, data = state
+    meta = instance._meta
+    setattr(instance, 'id', meta.pk.to_python(id))
+    if loadedfields is not None:
+        loadedfields = tuple(loadedfields)
+    instance._loadedfields = loadedfields
+    for field in meta.loaded_fields(loadedfields):
+        value = field.value_from_data(instance, data)
+        setattr(instance, field.attname, field.to_python(value))
+    instance._dbdata = data.get('__dbdata__',{})
+    
+    
+class DecodeRows(test.TestCase):
+    '''Decode rows of a 10-fields model without hitting the server. Compare
+``testLegacyDecode`` with ``testDecoder`` for the speedup.'''
+    model = WideModel
+    sizes = {'tiny': 1000,
+             'small': 10000,
+             'normal': 50000,
+             'big': 200000,
+             'huge': 1000000}
+    
+    def setUp(self):
+        size = self.sizes[getattr(self, 'size', 'small')]
+        codes = populate('string', size, min_len = 5, max_len = 10)
+        prices = populate('float', size)
+        dt = date.today().isoformat()
+        self.rows = [(str(i+1), None,
+                      {'code': code, 'group': 'group', 'ccy': 'EUR',
+                       'description': 'a description', 'quantity': '10',
+                       'counter': str(i), 'price': str(price),
+                       'volatility': '0.2', 'dt': '1343822400',
+                       'active': '1'}) for i, code, price in\
+                     zip(range(size), codes, prices)]
+        
+    def testLegacyDecode(self):
+        maker = self.model._meta.maker
+        for state in self.rows:
+            legacy_decode(maker(), state)
+            
+    def testDecoder(self):
+        list(self.backend.make_objects(self.model._meta, self.rows))
+
+
 class Load(FinanceTest):
     
     def setUp(self):
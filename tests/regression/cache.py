@@ -1,7 +1,94 @@
-from stdnet import test, getcache
+from stdnet import test, getcache, odm
+
+from examples.models import CachedCurrency, SimpleModel
+
 
 class TestCache(test.TestCase):
     
     def testSimple(self):
         c = getcache()
-        self.assertTrue(c)
\ No newline at end of file
+        self.assertTrue(c)
+
+
+class TestInstanceCache(test.TestCase):
+    models = (CachedCurrency,)
+    
+    def setUp(self):
+        CachedCurrency._meta.cache.clear()
+        session = self.session()
+        with session.begin():
+            for code in ('EUR', 'USD', 'GBP', 'JPY', 'CHF'):
+                session.add(CachedCurrency(code=code, name=code.lower()))
+                
+    def testMeta(self):
+        cache = CachedCurrency._meta.cache
+        self.assertTrue(isinstance(cache, odm.InstanceCache))
+        self.assertEqual(cache.size, 3)
+        self.assertEqual(SimpleModel._meta.cache, None)
+        
+    def testGet(self):
+        meta = CachedCurrency._meta
+        backend = self.session().backend
+        ccy = self.session().query(CachedCurrency).get(id=1)
+        self.assertEqual(ccy.code, 'EUR')
+        self.assertTrue(meta.cache.get(backend, 1))
+        # remove the instance on the server, the cache still serves it
+        backend.client.delete(backend.basekey(meta, 'obj', 1))
+        ccy2 = self.session().query(CachedCurrency).get(id=1)
+        self.assertFalse(ccy2 is ccy)
+        self.assertEqual(ccy2.code, 'EUR')
+        self.assertEqual(ccy2.rounding, 2)
+        
+    def testMaxAge(self):
+        meta = CachedCurrency._meta
+        backend = self.session().backend
+        self.assertEqual(meta.cache.max_age, 60)
+        self.session().query(CachedCurrency).get(id=1)
+        self.assertTrue(meta.cache.get(backend, 1))
+        meta.cache.max_age = 0
+        try:
+            self.assertFalse(meta.cache.get(backend, 1))
+        finally:
+            meta.cache.max_age = 60
+        self.assertEqual(len(meta.cache), 0)
+        
+    def testLRU(self):
+        meta = CachedCurrency._meta
+        backend = self.session().backend
+        self.session().query(CachedCurrency).all()
+        self.assertEqual(len(meta.cache), 3)
+        self.assertFalse(meta.cache.get(backend, 1))
+        self.assertTrue(meta.cache.get(backend, 5))
+        
+    def testGetMany(self):
+        session = self.session()
+        query = session.query(CachedCurrency)
+        query.get(id=2)
+        ccys = self.session().query(CachedCurrency).get_many((3, 2, 10, 1))
+        self.assertEqual([c.code for c in ccys], ['GBP', 'USD', 'EUR'])
+        
+    def testCommitEvicts(self):
+        meta = CachedCurrency._meta
+        session = self.session()
+        ccy = session.query(CachedCurrency).get(id=1)
+        backend = session.backend
+        self.assertTrue(meta.cache.get(backend, 1))
+        ccy.rounding = 4
+        ccy.save()
+        self.assertFalse(meta.cache.get(backend, 1))
+        ccy = self.session().query(CachedCurrency).get(id=1)
+        self.assertEqual(ccy.rounding, 4)
+        ccy.delete()
+        self.assertFalse(meta.cache.get(backend, 1))
+        
+    def testUpdateEvicts(self):
+        meta = CachedCurrency._meta
+        query = self.session().query(CachedCurrency)
+        query.all()
+        self.assertEqual(len(meta.cache), 3)
+        query.update(rounding=0)
+        self.assertEqual(len(meta.cache), 0)
+        ccy = self.session().query(CachedCurrency).get(id=5)
+        self.assertEqual(ccy.rounding, 0)
+        ccy.incr('rounding')
+        self.assertFalse(meta.cache.get(query.backend, 5))
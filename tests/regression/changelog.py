@@ -0,0 +1,87 @@
+'''Change log of committed writes'''
+from stdnet import odm, test
+
+from examples.models import LoggedItem, SimpleModel
+
+
+class TestChangeLog(test.TestCase):
+    model = LoggedItem
+    
+    def testMeta(self):
+        self.assertEqual(self.model._meta.changelog, 5)
+        self.assertEqual(SimpleModel._meta.changelog, None)
+        session = self.session()
+        self.assertRaises(ValueError, session.read_changes, SimpleModel)
+        
+    def testAddUpdateDelete(self):
+        session = self.session()
+        with session.begin():
+            item = session.add(self.model(name='a'))
+        item.value = 4
+        item.save()
+        item.delete()
+        records = session.read_changes(self.model)
+        self.assertEqual(len(records), 3)
+        self.assertEqual([r.action for r in records],
+                         ['add', 'update', 'delete'])
+        for r in records:
+            self.assertTrue(isinstance(r, odm.ChangeRecord))
+            self.assertEqual(r.model, self.model)
+            self.assertEqual(r.id, item.id)
+        self.assertEqual(set(records[0].fields), set(('name', 'value')))
+        self.assertEqual(records[1].fields, ('value',))
+        self.assertEqual(records[2].fields, ())
+        seqs = [r.seq for r in records]
+        self.assertEqual(seqs, sorted(seqs))
+        
+    def testAcknowledge(self):
+        session = self.session()
+        with session.begin():
+            for name in ('a', 'b', 'c'):
+                session.add(self.model(name=name))
+        records = session.read_changes(self.model, 2)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(session.ack_changes(self.model, records[-1].seq), 2)
+        records = session.read_changes(self.model)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].action, 'add')
+        session.ack_changes(self.model, records[0].seq)
+        self.assertEqual(session.read_changes(self.model), [])
+        
+    def testCapped(self):
+        session = self.session()
+        with session.begin():
+            for n in range(8):
+                session.add(self.model(name='x', value=n))
+        records = session.read_changes(self.model)
+        self.assertEqual(len(records), 5)
+        query = session.query(self.model)
+        self.assertEqual(records[0].id, query.get(value=3).id)
+        query.delete()
+        records = session.read_changes(self.model)
+        self.assertEqual(len(records), 5)
+        for r in records:
+            self.assertEqual(r.action, 'delete')
+            
+    def testUpdateAndIncr(self):
+        session = self.session()
+        with session.begin():
+            a = session.add(self.model(name='a'))
+            b = session.add(self.model(name='b'))
+        session.ack_changes(self.model, session.read_changes(self.model)[-1].seq)
+        query = session.query(self.model)
+        query.filter(name='a').update(name='c')
+        records = session.read_changes(self.model)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].action, 'update')
+        self.assertEqual(records[0].id, a.id)
+        self.assertEqual(records[0].fields, ('name',))
+        query.incr('value', 2)
+        b.incr('value')
+        records = session.read_changes(self.model)[1:]
+        self.assertEqual(len(records), 3)
+        self.assertEqual(set((r.id for r in records[:2])), set((a.id, b.id)))
+        self.assertEqual(records[2].id, b.id)
+        for r in records:
+            self.assertEqual(r.action, 'update')
+            self.assertEqual(r.fields, ('value',))
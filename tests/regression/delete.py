@@ -6,7 +6,8 @@ from stdnet import odm, test
 from stdnet.utils import populate, zip
 from stdnet.exceptions import QuerySetError
 
-from examples.models import Instrument, Fund, Position, Dictionary, SimpleModel
+from examples.models import Instrument, Fund, Position, Dictionary, SimpleModel,\
+                            User, Post
 from examples.data import FinanceTest
 
 DICT_LEN    = 200
@@ -175,6 +176,18 @@ test as it involves lots of operations and consistency checks.'''
         self.assertEqual(session.query(Instrument).all(),[])
         self.assertEqual(session.query(Position).all(),[])
         
+    def testDeleteRelatedCascadeResult(self):
+        '''Instances deleted in cascade are reported by the transaction.'''
+        session = self.data.makePositions(self)
+        instruments = set(session.query(Instrument).get_field('id').all())
+        positions = set(session.query(Position).get_field('id').all())
+        self.assertTrue(positions)
+        with session.begin() as t:
+            session.delete(session.query(Instrument))
+        self.assertEqual(set(t.deleted[Instrument._meta]), instruments)
+        self.assertEqual(set(t.deleted[Position._meta]), positions)
+        self.assertEqual(session.query(Position).count(), 0)
+        
     def __testDeleteRelatedCounting(self):
         '''Test delete on models with related models. This is a crucial
 test as it involves lots of operations and consistency checks.'''
@@ -231,3 +244,61 @@ class TestDeleteStructuredFields(test.TestCase):
             keys = list(session.keys(Dictionary))
             self.assertEqual(keys,[])
     
+
+
+class TestScriptSlice(FinanceTest):
+    '''Commit, load and delete with script calls processing a bounded
+number of instances.'''
+    def backend_params(self):
+        return {'script_slice': 7}
+    
+    def testCommitAndLoad(self):
+        session = self.data.create(self)
+        query = session.query(Instrument)
+        self.assertEqual(query.count(), len(self.data.inst_names))
+        names = [i.name for i in query.sort_by('name').all()]
+        self.assertEqual(names, sorted(self.data.inst_names))
+        self.assertEqual(len(query.all()), len(self.data.inst_names))
+        self.assertEqual(len(query[3:20]), 17)
+        
+    def testDeleteRelated(self):
+        session = self.data.makePositions(self)
+        positions = session.query(Position).count()
+        self.assertTrue(positions > 7)
+        with session.begin() as t:
+            session.delete(session.query(Instrument))
+        self.assertEqual(len(t.deleted[Position._meta]), positions)
+        self.assertEqual(session.query(Instrument).count(), 0)
+        self.assertEqual(session.query(Position).count(), 0)
+        
+    def testDeleteSliceKeepsRelations(self):
+        # A delete call stops before the cascade is complete, the instances
+        # left don't refer to deleted instances.
+        session = self.data.makePositions(self)
+        backend = session.backend
+        pipe = backend.client.pipeline()
+        query = session.query(Instrument).backend_query(pipe=pipe)
+        backend.accumulate_delete(pipe, query)
+        result = pipe.execute(load_script=True)[-1]
+        self.assertTrue(result.remaining)
+        instruments = set(session.query(Instrument).get_field('id').all())
+        self.assertTrue(instruments)
+        for position in session.query(Position).load_only('instrument'):
+            self.assertTrue(position.instrument_id in instruments)
+        
+        
+class TestScriptSliceNotIndexed(test.TestCase):
+    '''Related instances through a foreign key without index are not
+found within a script slice.'''
+    models = (User, Post)
+    
+    def backend_params(self):
+        return {'script_slice': 7}
+    
+    def testDeleteRefused(self):
+        session = self.session()
+        user = session.add(User(username='pluto'))
+        session.add(Post(data='hello', user=user))
+        self.assertRaises(QuerySetError, session.query(User).delete)
+        self.assertEqual(session.query(User).count(), 1)
+        self.assertEqual(session.query(Post).count(), 1)
@@ -0,0 +1,170 @@
+'''Rebuild and check indices of a model'''
+from datetime import date
+
+from stdnet import test
+from stdnet.odm import indextools
+from stdnet.utils import populate, zip
+
+from examples.models import Ticket, Instrument2, SortedDateModel
+
+
+SIZE = 60
+statuses = populate('choice', SIZE, choice_from=['open', 'closed', 'wontfix'])
+priorities = populate('choice', SIZE, choice_from=[1, 2, 3])
+
+
+class TestIndexTools(test.TestCase):
+    model = Ticket
+
+    def setUp(self):
+        session = self.session()
+        with session.begin():
+            for status, priority in zip(statuses, priorities):
+                session.add(self.model(status=status, priority=priority))
+
+    def histogram(self, values):
+        result = {}
+        for v in values:
+            result[v] = result.get(v, 0) + 1
+        return result
+
+    def key(self, *args):
+        backend = self.session().backend
+        return backend.basekey(self.model._meta, *args)
+
+    def testRebuildIntact(self):
+        result = indextools.rebuild_indices(self.session(), self.model)
+        self.assertTrue(isinstance(result, indextools.RebuildResult))
+        self.assertEqual(result.cursor, 0)
+        self.assertTrue(result.instances >= SIZE)
+        self.assertEqual(result.added, 0)
+        self.assertEqual(result.errors, [])
+
+    def testRebuildLostIndex(self):
+        session = self.session()
+        client = session.backend.client
+        client.delete(self.key('idx', 'status', 'open'))
+        client.hdel(self.key('cnt', 'status'), 'open')
+        query = session.query(self.model)
+        self.assertEqual(query.filter(status='open').count(), 0)
+        result = indextools.rebuild_indices(session, self.model,
+                                            fields=('status',))
+        expected = self.histogram(statuses)
+        self.assertEqual(result.added, expected['open'])
+        self.assertEqual(query.filter(status='open').count(),
+                         expected['open'])
+        self.assertEqual(query.count_by('status'), expected)
+        self.assertRaises(ValueError, indextools.rebuild_indices, session,
+                          self.model, fields=('foo',))
+
+    def testResume(self):
+        session = self.session()
+        cursors = []
+        result = indextools.rebuild_indices(session, self.model,
+                                            batch_size=10, max_batches=1,
+                                            checkpoint=cursors.append)
+        self.assertEqual(cursors, [result.cursor])
+        while result.cursor:
+            result = indextools.rebuild_indices(session, self.model,
+                                                cursor=result.cursor,
+                                                batch_size=10,
+                                                checkpoint=cursors.append)
+        self.assertEqual(cursors[-1], 0)
+
+    def testCheckClean(self):
+        report = indextools.check_indices(self.session(), self.model)
+        self.assertTrue(isinstance(report, indextools.IndexReport))
+        self.assertTrue(report.checked >= 2*SIZE)
+        self.assertEqual(report.stale, [])
+        self.assertEqual(report.unknown, [])
+        self.assertFalse(report.fixed)
+
+    def testCheckAndFix(self):
+        session = self.session()
+        client = session.backend.client
+        key = self.key('idx', 'status', 'open')
+        client.sadd(key, 1000)
+        client.hincrby(self.key('cnt', 'status'), 'open', 1)
+        client.execute_command('SETBIT', self.key('bit', 'priority', 1),
+                               1000, 1)
+        # an instance changed without updating its indices
+        t = session.query(self.model).get(id=1)
+        client.hset(self.key('obj', 1), 'status', 'reopened')
+        client.sadd(self.key('idx', 'foo', 'x'), 1)
+        report = indextools.check_indices(session, self.model, batch_size=7)
+        stale = set(report.stale)
+        self.assertTrue((key, '1000') in stale)
+        self.assertTrue((self.key('bit', 'priority', 1), '1000') in stale)
+        self.assertTrue((self.key('idx', 'status', t.status), '1') in stale)
+        self.assertEqual(report.unknown, [self.key('idx', 'foo', 'x')])
+        report = indextools.check_indices(session, self.model, fix=True)
+        self.assertTrue(report.fixed)
+        indextools.rebuild_indices(session, self.model)
+        report = indextools.check_indices(session, self.model)
+        self.assertEqual(report.stale, [])
+        query = session.query(self.model)
+        self.assertEqual(query.filter(status='reopened').count(), 1)
+        self.assertEqual(query.filter(priority=1).count(),
+                         self.histogram(priorities)[1])
+        counts = self.histogram(statuses)
+        counts[t.status] -= 1
+        counts['reopened'] = 1
+        self.assertEqual(query.count_by('status'),
+                         dict(((k, v) for k, v in counts.items() if v)))
+
+
+class TestIndexToolsUnique(test.TestCase):
+    model = Instrument2
+
+    def setUp(self):
+        session = self.session()
+        with session.begin():
+            for n in range(10):
+                session.add(self.model(name='i%s' % n, ccy='EUR', type='x'))
+
+    def testUniqueConflict(self):
+        session = self.session()
+        backend = session.backend
+        meta = self.model._meta
+        client = backend.client
+        client.delete(backend.basekey(meta, 'uni', 'name'))
+        client.hset(backend.basekey(meta, 'obj', 2), 'name', 'i0')
+        result = indextools.rebuild_indices(session, self.model)
+        self.assertEqual(result.added, 9)
+        self.assertEqual(len(result.errors), 1)
+        report = indextools.check_indices(session, self.model)
+        self.assertEqual(report.stale, [])
+        self.assertEqual(session.query(self.model).get(name='i9').id, 10)
+
+
+class TestIndexToolsSortIndex(test.TestCase):
+    # name has both an index and a sort index
+    model = SortedDateModel
+    
+    def setUp(self):
+        session = self.session()
+        with session.begin():
+            for n in range(10):
+                session.add(self.model(person='p%s' % (n % 3),
+                                       name='n%s' % (n % 4),
+                                       dt=date(2012, 1, n+1)))
+                
+    def testCheckClean(self):
+        session = self.session()
+        report = indextools.check_indices(session, self.model)
+        self.assertEqual(report.unknown, [])
+        self.assertEqual(report.stale, [])
+        self.assertTrue(report.checked >= 40)
+        
+    def testCheckAndFix(self):
+        session = self.session()
+        backend = session.backend
+        meta = self.model._meta
+        key = backend.basekey(meta, 'idx', 'name', 'n0')
+        backend.client.sadd(key, 1000)
+        report = indextools.check_indices(session, self.model, fix=True)
+        self.assertEqual(report.unknown, [])
+        self.assertEqual(report.stale, [(key, '1000')])
+        self.assertTrue(report.fixed)
+        self.assertEqual(session.query(self.model).filter(name='n0').count(),
+                         3)
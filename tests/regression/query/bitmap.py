@@ -0,0 +1,81 @@
+from stdnet import test, odm
+from stdnet.utils import populate, zip
+
+from examples.models import Subscriber
+
+
+SIZE = 100
+plans = ['free', 'basic', 'premium']
+names = populate('string', SIZE, min_len=5, max_len=20)
+actives = populate('choice', SIZE, choice_from=[True, False])
+user_plans = populate('choice', SIZE, choice_from=plans)
+
+
+class TestBitmapIndex(test.TestCase):
+    model = Subscriber
+
+    def setUp(self):
+        session = self.session()
+        with session.begin():
+            for name, active, plan in zip(names, actives, user_plans):
+                session.add(self.model(name=name, active=active, plan=plan))
+
+    def expected(self, active=None, plans=None):
+        ids = set()
+        for id, a, p in zip(range(1, SIZE+1), actives, user_plans):
+            if (active is None or a == active) and\
+                (plans is None or p in plans):
+                ids.add(id)
+        return ids
+
+    def testMeta(self):
+        meta = self.model._meta
+        self.assertTrue(meta.dfields['active'].bitmap)
+        self.assertTrue(meta.dfields['active'].index)
+        self.assertFalse(meta.dfields['name'].bitmap)
+
+    def testCount(self):
+        query = self.session().query(self.model)
+        qs = query.filter(active=True)
+        self.assertTrue(qs.backend_query().bitmap)
+        self.assertEqual(qs.count(), len(self.expected(True)))
+        qs = query.filter(active=True, plan__in=('basic', 'premium'))
+        self.assertEqual(qs.count(),
+                         len(self.expected(True, ('basic', 'premium'))))
+        qs = query.filter(active=False).exclude(plan='free')
+        self.assertEqual(qs.count(),
+                         len(self.expected(False, ('basic', 'premium'))))
+
+    def testItems(self):
+        query = self.session().query(self.model)
+        qs = query.filter(active=True, plan='premium')
+        ids = set((s.id for s in qs))
+        self.assertEqual(ids, self.expected(True, ('premium',)))
+        for s in qs:
+            self.assertTrue(s.active)
+            self.assertEqual(s.plan, 'premium')
+
+    def testMixedQuery(self):
+        query = self.session().query(self.model)
+        qs = query.filter(active=True, name=names[0])
+        self.assertFalse(qs.backend_query().bitmap)
+        if actives[0]:
+            self.assertEqual(qs.count(), 1)
+            self.assertEqual(qs[0].name, names[0])
+        else:
+            self.assertEqual(qs.count(), 0)
+
+    def testUpdateAndDelete(self):
+        session = self.session()
+        query = session.query(self.model)
+        s = query.get(id=1)
+        s.active = not s.active
+        s.save()
+        self.assertTrue(s.id in set((i.id for i in
+                                     query.filter(active=s.active))))
+        self.assertFalse(s.id in set((i.id for i in
+                                      query.filter(active=not s.active))))
+        N = query.filter(plan='free').count()
+        query.filter(plan='free').delete()
+        self.assertEqual(query.filter(plan='free').count(), 0)
+        self.assertEqual(query.count(), SIZE - N)
@@ -0,0 +1,124 @@
+'''Composite indices declared in the model Meta class.'''
+from datetime import date
+
+from stdnet import test, odm, ImproperlyConfigured
+from stdnet.odm import indextools
+
+from examples.models import Trade
+
+
+class TestCompositeIndex(test.TestCase):
+    model = Trade
+    accounts = ('a', 'b', 'c')
+    symbols = ('x', 'y')
+    dates = (date(2012, 1, 2), date(2012, 1, 3))
+
+    def setUp(self):
+        session = self.session()
+        with session.begin():
+            size = 0
+            for account in self.accounts:
+                for symbol in self.symbols:
+                    for dt in self.dates:
+                        for n in range(2):
+                            size += 1
+                            session.add(Trade(account=account, symbol=symbol,
+                                              dt=dt, size=size))
+        self.num_trades = session.query(Trade).count()
+
+    def expected(self, account, symbol, dt):
+        return set((t.id for t in self.session().query(Trade)\
+                    if t.account == account and t.symbol == symbol\
+                    and t.dt == dt))
+
+    def testMeta(self):
+        meta = Trade._meta
+        self.assertEqual(len(meta.composite_indices), 1)
+        index = meta.composite_indices[0]
+        self.assertEqual(index.attname, 'account,symbol,dt')
+        self.assertEqual(index.fields, (meta.dfields['account'],
+                                        meta.dfields['symbol'],
+                                        meta.dfields['dt']))
+
+    def testBadIndex(self):
+        def make(indexes):
+            class Bad(odm.StdModel):
+                name = odm.SymbolField()
+                code = odm.SymbolField()
+                Meta = type('Meta', (), {'indexes': indexes})
+        self.assertRaises(ImproperlyConfigured, make, [('name',)])
+        self.assertRaises(ImproperlyConfigured, make, [('name', 'foo')])
+
+    def testQuery(self):
+        session = self.session()
+        trade = session.query(Trade).all()[0]
+        qs = session.query(Trade).filter(account=trade.account,
+                                         symbol=trade.symbol, dt=trade.dt)
+        q = qs.construct()
+        self.assertEqual(q.keyword, 'set')
+        self.assertTrue(q.composite)
+        ids = set((t.id for t in qs))
+        self.assertTrue(trade.id in ids)
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(ids, self.expected(trade.account, trade.symbol,
+                                            trade.dt))
+        self.assertEqual(qs.count(), len(ids))
+
+    def testPartialCover(self):
+        session = self.session()
+        trade = session.query(Trade).all()[0]
+        qs = session.query(Trade).filter(account=trade.account, dt=trade.dt)
+        self.assertEqual(qs.construct().keyword, 'intersect')
+        qs = session.query(Trade).filter(account=trade.account,
+                                         symbol=trade.symbol,
+                                         dt=trade.dt, size__in=(trade.size,))
+        q = qs.construct()
+        self.assertEqual(q.keyword, 'intersect')
+        self.assertTrue(trade.id in set((t.id for t in qs)))
+
+    def testChangeAndDelete(self):
+        session = self.session()
+        query = session.query(Trade)
+        trade = query.filter(account='a').all()[0]
+        symbol, dt = trade.symbol, trade.dt
+        trade.account = 'b'
+        trade.save()
+        self.assertFalse(trade.id in set((t.id for t in query.filter(
+                                    account='a', symbol=symbol, dt=dt))))
+        qs = query.filter(account='b', symbol=symbol, dt=dt)
+        self.assertTrue(trade.id in set((t.id for t in qs)))
+        self.assertEqual(qs.count(), 3)
+        qs.delete()
+        qs = query.filter(account='b', symbol=symbol, dt=dt)
+        self.assertEqual(qs.count(), 0)
+        self.assertEqual(query.count(), self.num_trades - 3)
+
+    def testIndexNotBuilt(self):
+        # the index is added to a model with instances
+        session = self.session()
+        backend = session.backend
+        meta = Trade._meta
+        index = meta.composite_indices[0]
+        backend.client.delete(backend.basekey(meta, 'built'))
+        backend._complete_indices.clear()
+        keys = backend.client.keys(backend.basekey(meta, 'idx',
+                                                   index.attname, '*'))
+        backend.client.delete(*keys)
+        trade = session.query(Trade).all()[0]
+        qs = session.query(Trade).filter(account=trade.account,
+                                         symbol=trade.symbol, dt=trade.dt)
+        self.assertEqual(qs.construct().keyword, 'intersect')
+        ids = set((t.id for t in qs))
+        self.assertEqual(ids, self.expected(trade.account, trade.symbol,
+                                            trade.dt))
+        indextools.rebuild_indices(session, Trade, fields=(index.attname,))
+        qs = session.query(Trade).filter(account=trade.account,
+                                         symbol=trade.symbol, dt=trade.dt)
+        self.assertTrue(qs.construct().composite)
+        self.assertEqual(set((t.id for t in qs)), ids)
+
+    def testEscapedValues(self):
+        index = Trade._meta.composite_indices[0]
+        self.assertNotEqual(index.value(('a:b', 'c', 'd')),
+                            index.value(('a', 'b:c', 'd')))
+        self.assertEqual(index.value(('a\\', 'b', '')), 'a\\\\:b:')
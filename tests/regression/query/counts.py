@@ -0,0 +1,119 @@
+from stdnet import test, odm, FieldError
+from stdnet.odm import indextools
+from stdnet.utils import populate, zip
+
+from examples.models import Ticket
+
+
+SIZE = 60
+statuses = populate('choice', SIZE, choice_from=['open', 'closed', 'wontfix'])
+priorities = populate('choice', SIZE, choice_from=[1, 2, 3])
+
+
+class TestCountedIndex(test.TestCase):
+    model = Ticket
+
+    def setUp(self):
+        session = self.session()
+        with session.begin():
+            for status, priority in zip(statuses, priorities):
+                session.add(self.model(status=status, priority=priority))
+
+    def histogram(self, values):
+        result = {}
+        for v in values:
+            result[v] = result.get(v, 0) + 1
+        return result
+
+    def testMeta(self):
+        meta = self.model._meta
+        self.assertTrue(meta.dfields['status'].counts)
+        self.assertTrue(meta.dfields['priority'].counts)
+        self.assertTrue(meta.dfields['priority'].bitmap)
+        self.assertFalse(meta.pk.counts)
+        self.assertRaises(FieldError, odm.SymbolField, unique=True,
+                          counts=True)
+        self.assertRaises(FieldError, odm.SymbolField, index=False,
+                          counts=True)
+
+    def testCount(self):
+        query = self.session().query(self.model)
+        qs = query.filter(status='open')
+        self.assertTrue(qs.backend_query().counts)
+        self.assertEqual(qs.count(), statuses.count('open'))
+        qs = query.filter(status__in=('open', 'closed', 'open'))
+        self.assertEqual(qs.count(),
+                         statuses.count('open') + statuses.count('closed'))
+        qs = query.filter(priority=2)
+        self.assertTrue(qs.backend_query().counts)
+        self.assertEqual(qs.count(), priorities.count(2))
+        self.assertEqual(query.filter(status='foo').count(), 0)
+        qs = query.filter(status='open', priority=2)
+        self.assertFalse(qs.backend_query().counts)
+
+    def testItems(self):
+        query = self.session().query(self.model)
+        qs = query.filter(status='closed')
+        self.assertEqual(qs.count(), statuses.count('closed'))
+        tickets = list(qs)
+        self.assertEqual(len(tickets), statuses.count('closed'))
+        for t in tickets:
+            self.assertEqual(t.status, 'closed')
+
+    def testCountBy(self):
+        query = self.session().query(self.model)
+        self.assertEqual(query.count_by('status'), self.histogram(statuses))
+        self.assertEqual(query.count_by('priority'),
+                         self.histogram(priorities))
+        qs = query.filter(priority=1)
+        expected = self.histogram((s for s, p in zip(statuses, priorities)\
+                                   if p == 1))
+        self.assertEqual(qs.count_by('status'), expected)
+        self.assertRaises(FieldError, query.count_by, 'foo')
+
+    def testChangeAndDelete(self):
+        session = self.session()
+        query = session.query(self.model)
+        t = query.get(id=1)
+        old = t.status
+        t.status = 'reopened'
+        t.save()
+        counts = query.count_by('status')
+        self.assertEqual(counts['reopened'], 1)
+        self.assertEqual(counts.get(old, 0), statuses.count(old) - 1)
+        N = query.filter(status='open').count()
+        self.assertEqual(query.filter(status='open').update(status='closed'),
+                         N)
+        self.assertEqual(query.filter(status='open').count(), 0)
+        query.filter(status='closed').delete()
+        counts = query.count_by('status')
+        self.assertFalse('closed' in counts)
+        self.assertEqual(sum(counts.values()), query.count())
+
+    def testIncr(self):
+        query = self.session().query(self.model)
+        N = priorities.count(3)
+        query.filter(priority=3).incr('priority')
+        self.assertEqual(query.filter(priority=3).count(), 0)
+        self.assertEqual(query.filter(priority=4).count(), N)
+        self.assertEqual(query.count_by('priority').get(4), N)
+
+    def testIncompleteCounts(self):
+        # counts=True added to a field of a model with instances
+        session = self.session()
+        backend = session.backend
+        meta = self.model._meta
+        backend.client.delete(backend.basekey(meta, 'counted'),
+                              backend.basekey(meta, 'cnt', 'status'))
+        query = session.query(self.model)
+        expected = self.histogram(statuses)
+        self.assertEqual(query.filter(status='open').count(),
+                         expected['open'])
+        self.assertEqual(query.count_by('status'), expected)
+        self.assertEqual(backend.field_counts(meta, meta.dfields['status']),
+                         None)
+        indextools.check_indices(session, self.model, fix=True)
+        counts = backend.field_counts(meta, meta.dfields['status'])
+        self.assertEqual(counts, expected)
+        self.assertEqual(query.filter(status='open').count(),
+                         expected['open'])
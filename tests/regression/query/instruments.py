@@ -184,3 +184,41 @@ class TestFilter(FinanceTest):
         res = set((q.id for q in qt))
         self.assertTrue(res)
         self.assertFalse(res.intersection(set((2,3,4))))
+
+    def temporary_keys(self, session):
+        return [k for k in session.keys(self.model) if ':tmp:' in k]
+        
+    def testTemporaryKeysDeleted(self):
+        session = self.session()
+        query = session.query(self.model)
+        qs = query.filter(ccy = 'EUR').union(query.filter(ccy = 'EUR',
+                                                          type = 'future'))
+        instances = qs.all()
+        self.assertTrue(instances)
+        if session.backend.name == 'redis':
+            # keys of the query and of its elements are deleted once loaded
+            self.assertEqual(self.temporary_keys(session), [])
+        # the query key is built again when needed
+        self.assertTrue(instances[0] in qs)
+        
+    def testCountKeepsKey(self):
+        session = self.session()
+        qs = session.query(self.model).filter(ccy = 'EUR')
+        N = qs.count()
+        self.assertTrue(N > 1)
+        if session.backend.name == 'redis':
+            # the key of the query is used by the next slice
+            keys = self.temporary_keys(session)
+            self.assertEqual(len(keys), 1)
+            self.assertEqual(qs.backend_query().query_key, keys[0])
+        self.assertEqual(len(qs[0:2]), 2)
+        
+    def testCleanTemporaryKeys(self):
+        session = self.session()
+        qs = session.query(self.model).filter(ccy = 'EUR')
+        # a sliced load keeps the key of the query for other slices
+        self.assertEqual(len(qs[0:1]), 1)
+        if session.backend.name == 'redis':
+            self.assertTrue(self.temporary_keys(session))
+            self.assertTrue(session.clean(self.model) >= 1)
+            self.assertEqual(self.temporary_keys(session), [])
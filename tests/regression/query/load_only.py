@@ -1,5 +1,7 @@
 '''test load_only and dont_load methods'''
-from stdnet import test
+import weakref
+
+from stdnet import test, odm
 from stdnet.utils import zip
 
 from examples.models import SimpleModel, Person, Group, Statistics3
@@ -134,6 +136,140 @@ loaded. The correct behavior should be to updated the field and indexes.'''
                                          .dont_load('description')
         for m in query.all():
             self.assertEqual(m._loadedfields,('group',))
+            
+    def test_decoder(self):
+        meta = self.model._meta
+        decoder = meta.decoder(('code','group'))
+        self.assertEqual(meta.decoder(('code','group')), decoder)
+        self.assertNotEqual(meta.decoder(), decoder)
+        m = meta.maker()
+        decoder(m, ('3', ('code','group'), {'code': 'x', 'group': 'y'}))
+        self.assertEqual(m.id, 3)
+        self.assertEqual(m.code, 'x')
+        self.assertEqual(m.group, 'y')
+        self.assertEqual(m._loadedfields, ('code','group'))
+        self.assertFalse(hasattr(m,'description'))
+        
+    def test_decoder_shared_by_rows(self):
+        # rows carry equal but distinct lists of loaded fields
+        meta = self.model._meta
+        backend = self.session().backend
+        decoder = meta.decoder
+        requested = []
+        def counted_decoder(loadedfields=None):
+            requested.append(loadedfields)
+            return decoder(loadedfields)
+        meta.decoder = counted_decoder
+        try:
+            data = [(str(i), ['code','group'], {'code': 'x', 'group': 'y'})\
+                    for i in range(1, 4)]
+            objs = list(backend.make_objects(meta, data))
+        finally:
+            del meta.decoder
+        self.assertEqual(requested, [('code','group')])
+        self.assertEqual([m.id for m in objs], [1, 2, 3])
+        # the row is not copied, it is kept as the original values
+        self.assertTrue(objs[0]._dbdata['original'] is data[0][2])
+        self.assertEqual(data[0][2], {'code': 'x', 'group': 'y'})
+        
+    def test_lazy_load(self):
+        query = self.session().query(self.model)
+        qs = query.load_only('code').lazy_load().all()
+        self.assertEqual(len(qs), 5)
+        for m in qs:
+            self.assertFalse('group' in m.__dict__)
+        # accessing the field on one instance loads it on all of them
+        self.assertTrue(qs[0].group)
+        for m in qs:
+            self.assertTrue('group' in m.__dict__)
+            self.assertFalse('description' in m.__dict__)
+            self.assertEqual(m._loadedfields, ('code','group'))
+        expected = dict(((m.id, m.group) for m in query))
+        for m in qs:
+            self.assertEqual(m.group, expected[m.id])
+            self.assertEqual(m.description, 'blabla')
+        self.assertRaises(AttributeError, getattr, qs[0], 'foo')
+        
+    def test_lazy_load_releases_siblings(self):
+        query = self.session().query(self.model)
+        qs = query.load_only('code').lazy_load().all()
+        m = qs[0]
+        # siblings are weak references
+        for ref in m._dbdata['deferred']:
+            self.assertTrue(isinstance(ref, weakref.ref))
+        self.assertEqual(m.get_attr_value('group'), m.group)
+        self.assertTrue('deferred' in m._dbdata)
+        for field in self.model._meta.scalarfields:
+            getattr(m, field.attname)
+        for m in qs:
+            self.assertFalse('deferred' in m._dbdata)
+            
+    def test_load_fields(self):
+        query = self.session().query(self.model)
+        m = query.load_only('code').get(code='b')
+        self.assertFalse(hasattr(m, 'group'))
+        m.load_fields('group', 'description')
+        self.assertEqual(m.group, 'group2')
+        self.assertEqual(m.description, 'blabla')
+        
+class Records(test.TestCase):
+    model = SimpleModel
+    
+    def setUp(self):
+        s = self.session()
+        with s.begin():
+            s.add(self.model(code = 'a', group = 'group1',
+                             description = 'blabla'))
+            s.add(self.model(code = 'b', group = 'group2',
+                             description = 'blabla'))
+            s.add(self.model(code = 'c', group = 'group1',
+                             description = 'blabla'))
+            s.add(self.model(code = 'd', group = 'group3',
+                             description = 'blabla'))
+            s.add(self.model(code = 'e', group = 'group1',
+                             description = 'blabla'))
+    
+    def test_records(self):
+        session = self.session()
+        query = session.query(self.model)
+        qs = query.records()
+        self.assertTrue(qs.readonly)
+        self.assertFalse(query.readonly)
+        records = qs.all()
+        self.assertEqual(len(records), 5)
+        for r in records:
+            self.assertTrue(isinstance(r, self.model._meta.record_class))
+            self.assertTrue(isinstance(r, odm.Record))
+            self.assertFalse(hasattr(r, '__dict__'))
+            self.assertTrue(r.id)
+            self.assertTrue(r.code)
+            self.assertEqual(r.description, 'blabla')
+            self.assertRaises(AttributeError, setattr, r, 'code', 'bla')
+        # records are not added to the session
+        self.assertEqual(len(session.model(self.model._meta)), 0)
+        
+    def test_records_load_only(self):
+        query = self.session().query(self.model)
+        for r in query.load_only('code').records():
+            self.assertEqual(r._loadedfields, ('code',))
+            self.assertTrue(r.code)
+            self.assertFalse(hasattr(r, 'group'))
+            
+    def test_to_instance(self):
+        session = self.session()
+        query = session.query(self.model)
+        r = query.records().get(code = 'a')
+        m = r.to_instance(session)
+        self.assertTrue(isinstance(m, self.model))
+        self.assertEqual(m.id, r.id)
+        self.assertEqual(m.code, 'a')
+        self.assertTrue(m.state().persistent)
+        self.assertTrue(m in session)
+        m.group = 'group5'
+        with session.begin():
+            session.add(m)
+        self.assertEqual(query.filter(group = 'group5').count(), 1)
+        
         
 class LoadOnlyRelated(test.TestCase):
     models = (Person, Group)
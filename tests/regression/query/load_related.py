@@ -1,6 +1,6 @@
 from stdnet import test, FieldError
 
-from examples.models import Dictionary
+from examples.models import Dictionary, Folder, PortfolioView
 from examples.data import FinanceTest, Position, Instrument, Fund
 
 
@@ -138,4 +138,53 @@ class load_related_structure(test.TestCase):
         self.assertEqual(len(cache),3)
         self.assertEqual(cache,remote)
         
-    
\ No newline at end of file
+            
+class load_related_nested(test.TestCase):
+    models = (Folder, PortfolioView, Fund)
+    
+    def setUp(self):
+        session = self.session()
+        with session.begin():
+            funds = [session.add(Fund(name='fund%s' % n, ccy='EUR'))\
+                     for n in range(2)]
+        with session.begin():
+            views = [session.add(PortfolioView(name='view%s' % n,
+                                               portfolio=funds[n % 2]))\
+                     for n in range(4)]
+        with session.begin():
+            for n in range(12):
+                session.add(Folder(name='folder%s' % n, view=views[n % 4]))
+                
+    def testMeta(self):
+        query = self.session().query(Folder)
+        q = query.load_related('view__portfolio', 'name')
+        self.assertEqual(q.select_related, {'view': set(),
+                                            'view__portfolio': set(('name',))})
+        q = q.load_related('view', 'name')
+        self.assertEqual(q.select_related['view'], set(('name', 'portfolio')))
+        self.assertRaises(FieldError, query.load_related, 'view__foo')
+        self.assertRaises(FieldError, query.load_related, 'positions__fund')
+        
+    def testNested(self):
+        query = self.session().query(Folder)
+        folders = list(query.load_related('view__portfolio'))
+        self.assertEqual(len(folders), 12)
+        view_cache = Folder._meta.dfields['view'].get_cache_name()
+        fund_cache = PortfolioView._meta.dfields['portfolio'].get_cache_name()
+        for folder in folders:
+            view = getattr(folder, view_cache, None)
+            self.assertTrue(isinstance(view, PortfolioView))
+            fund = getattr(view, fund_cache, None)
+            self.assertTrue(isinstance(fund, Fund))
+            self.assertEqual(fund.name, 'fund%s' % (int(view.name[4:]) % 2))
+            
+    def testNestedLoadOnly(self):
+        query = self.session().query(Folder)
+        q = query.load_related('view', 'name')\
+                 .load_related('view__portfolio', 'name')
+        fund_cache = PortfolioView._meta.dfields['portfolio'].get_cache_name()
+        for folder in q:
+            view = folder.view
+            self.assertEqual(set(view._loadedfields), set(('name', 'portfolio')))
+            fund = getattr(view, fund_cache, None)
+            self.assertEqual(fund._loadedfields, ('name',))
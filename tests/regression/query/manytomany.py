@@ -118,6 +118,37 @@ class TestManyToMany(test.TestCase):
         p1.roles.remove(role)
         profiles = role.profiles.query()
         self.assertEqual(profiles.count(),0)
+        
+    def testPrefetchRelated(self):
+        self.addsome()
+        session = self.session()
+        profiles = session.query(Profile).prefetch_related('roles').all()
+        self.assertEqual(len(profiles),3)
+        cache_name = Profile.roles.get_cache_name()
+        for profile in profiles:
+            roles = getattr(profile, cache_name)
+            self.assertEqual(set(roles), set(profile.roles.query()))
+        profile = session.query(Profile).get(id = 1)
+        self.assertEqual(profile.roles.query().count(),2)
+        roles = session.query(Role).prefetch_related('profiles').all()
+        for role in roles:
+            self.assertEqual(getattr(role, Role.profiles.get_cache_name()),
+                             [profile])
+            
+    def testPrefetchClearedOnChange(self):
+        self.addsome()
+        session = self.session()
+        profile = session.query(Profile).prefetch_related('roles').get(id=2)
+        role = session.query(Role).prefetch_related('profiles')\
+                                  .get(name='admin')
+        self.assertEqual(getattr(profile, Profile.roles.get_cache_name()), [])
+        self.assertTrue(getattr(role, Role.profiles.get_cache_name()))
+        with session.begin():
+            profile.roles.add(role)
+        self.assertFalse(hasattr(profile, Profile.roles.get_cache_name()))
+        self.assertFalse(hasattr(role, Role.profiles.get_cache_name()))
+        self.assertEqual(profile.roles.query().all(), [role])
+        self.assertEqual(role.profiles.query().count(), 2)
 
 
 class TestManyToManyThrough(test.TestCase):
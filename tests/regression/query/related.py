@@ -1,7 +1,7 @@
 import datetime
 import random
 
-from stdnet import test
+from stdnet import test, FieldError
 
 from examples.models import Node, Role, Profile, Dictionary
 from examples.data import FinanceTest, Position, Instrument, Fund
@@ -148,5 +148,50 @@ class TestRelatedManager(FinanceTest):
         for p in pos:
             self.assertFalse(p.instrument == inst)
             self.assertEqual(p.fund,fund)
-        
 
+
+class TestPrefetchRelated(FinanceTest):
+    
+    def testReverseForeignKey(self):
+        self.data.makePositions(self)
+        session = self.session()
+        funds = session.query(Fund).prefetch_related('positions').all()
+        self.assertTrue(funds)
+        cache_name = Fund.positions.get_cache_name()
+        for fund in funds:
+            items = getattr(fund, cache_name)
+            positions = fund.positions.query()
+            self.assertEqual(positions.cache()[None], items)
+            expected = self.session().query(Position).filter(fund=fund)
+            self.assertEqual(set((p.id for p in positions)),
+                             set((p.id for p in expected)))
+            for p in positions:
+                self.assertEqual(p.fund_id, fund.id)
+                
+    def testPrefetchedOnce(self):
+        self.data.makePositions(self)
+        session = self.session()
+        fund = session.query(Fund).prefetch_related('positions').get(id=1)
+        cache_name = Fund.positions.get_cache_name()
+        self.assertTrue(fund.positions.query().cache())
+        self.assertFalse(hasattr(fund, cache_name))
+        positions = fund.positions.query()
+        self.assertFalse(positions.cache())
+        expected = session.query(Position).filter(fund=fund)
+        self.assertEqual(set((p.id for p in positions)),
+                         set((p.id for p in expected)))
+                
+    def testFilterPrefetched(self):
+        self.data.makePositions(self)
+        session = self.session()
+        fund = session.query(Fund).prefetch_related('positions').get(id=1)
+        inst = session.query(Instrument).get(id=1)
+        positions = fund.positions.filter(instrument=inst)
+        self.assertFalse(positions.cache())
+        for p in positions:
+            self.assertEqual(p.instrument_id, inst.id)
+            
+    def testErrors(self):
+        query = self.session().query(Fund)
+        self.assertRaises(FieldError, query.prefetch_related, 'foo')
+        self.assertRaises(FieldError, query.prefetch_related, 'name')
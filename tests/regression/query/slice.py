@@ -18,52 +18,92 @@ class TestFilter(FinanceTest):
         q1 = qs.all()
         self.assertEqual(len(q1),qs.count())
         
+    def ids(self, items):
+        # Unsorted slices follow the set iteration order of the backend,
+        # not the order of ids, so only size and membership are checked.
+        ids = [q.id for q in items]
+        self.assertEqual(len(set(ids)), len(ids))
+        return set(ids)
+        
     def testUnsortedSliceSimple(self):
         session = self.session()
         qs = session.query(self.model)
         self.assertTrue(qs.count() > 0)
+        all_ids = set(qs.get_field('id').all())
         q1 = qs[0:2]
         self.assertEqual(len(q1),2)
-        self.assertEqual([q.id for q in q1],[1,2])
+        self.assertTrue(self.ids(q1).issubset(all_ids))
         
     def testUnsortedSliceComplex(self):
         session = self.session()
         qs = session.query(self.model)
         N = qs.count()
         self.assertTrue(N)
+        all_ids = set(qs.get_field('id').all())
         q1 = qs[0:-1]
         self.assertEqual(len(q1),N-1)
-        for id,q in enumerate(q1,1):
-            self.assertEqual(q.id,id)
+        self.assertTrue(self.ids(q1).issubset(all_ids))
         q1 = qs[2:4]
         self.assertEqual(len(q1),2)
-        self.assertEqual(q1[0].id,3)
-        self.assertEqual(q1[1].id,4)
+        self.assertTrue(self.ids(q1).issubset(all_ids))
             
     def testUnsortedSliceToEnd(self):
         session = self.session()
         qs = session.query(self.model)
         N = qs.count()
         self.assertTrue(N)
+        all_ids = set(qs.get_field('id').all())
         q1 = qs[0:]
         self.assertEqual(len(q1),N)
-        # This time the result is sorted by ids
+        self.assertEqual(self.ids(q1), all_ids)
         q1 = qs[3:]
         self.assertEqual(len(q1),N-3)
-        for id,q in enumerate(q1,4):
-            self.assertEqual(q.id,id)
+        self.assertTrue(self.ids(q1).issubset(all_ids))
             
     def testSliceBack(self):
         session = self.session()
         qs = session.query(self.model)
         N = qs.count()
         self.assertTrue(N)
+        all_ids = set(qs.get_field('id').all())
         q1 = qs[-2:]
         self.assertEqual(len(q1),2)
-        self.assertEqual(q1[0].id,N-1)
-        self.assertEqual(q1[1].id,N)
-        # This time the result is sorted by ids
+        self.assertTrue(self.ids(q1).issubset(all_ids))
         q1 = qs[-2:-1]
         self.assertEqual(len(q1),1)
-        self.assertEqual(q1[0].id,N-1)
-    
\ No newline at end of file
+        self.assertTrue(self.ids(q1).issubset(all_ids))
+    
+    def testSortedSlice(self):
+        session = self.session()
+        qs = session.query(self.model).sort_by('-name')
+        names = [i.name for i in session.query(self.model).sort_by('-name')]
+        q1 = qs[:5]
+        # the query is counted and loaded in the same request
+        self.assertTrue(qs.backend_query().executed)
+        self.assertEqual([i.name for i in q1], names[:5])
+        self.assertEqual([i.name for i in qs[-3:]], names[-3:])
+        self.assertEqual([i.name for i in qs[2:-2]], names[2:-2])
+        self.assertEqual(qs[5:2], [])
+        self.assertEqual(qs.count(), len(names))
+        
+    def testUnsortedSliceIsPartial(self):
+        session = self.session()
+        qs = session.query(self.model)
+        ids = set(qs.get_field('id').all())
+        q1 = qs[:5]
+        self.assertEqual(len(q1), 5)
+        self.assertTrue(set((q.id for q in q1)).issubset(ids))
+        
+    def testSample(self):
+        session = self.session()
+        qs = session.query(self.model).filter(ccy='EUR')
+        ids = set(qs.get_field('id').all())
+        N = len(ids)
+        self.assertTrue(N > 3)
+        sample = qs.sample(3)
+        self.assertEqual(len(sample), 3)
+        sids = set((q.id for q in sample))
+        self.assertEqual(len(sids), 3)
+        self.assertTrue(sids.issubset(ids))
+        self.assertEqual(len(qs.sample(N+5)), N)
+        self.assertEqual(qs.filter(ccy='XXX').sample(3), [])
@@ -106,3 +106,29 @@ class TestUniqueFilter(test.TestCase):
         self.assertRaises(ValueError,
                     query.test_unique,'code',m.code,m2,ValueError)
 
+        
+    def testGetSingleCall(self):
+        session = self.session()
+        query = session.query(self.model)
+        code = randomcode()
+        self.assertTrue(query.filter(code=code)._load_unique())
+        self.assertEqual(query.filter(code='xxxxxxxxxx')._load_unique(), [])
+        self.assertEqual(query.filter(id=-1)._load_unique(), [])
+        self.assertEqual(query.filter(group='rugby')._load_unique(), None)
+        self.assertEqual(query.filter(code=code, group='rugby')\
+                         ._load_unique(), None)
+        self.assertRaises(self.model.DoesNotExist, query.get,
+                          code='xxxxxxxxxx')
+        
+    def testGetLoadOnly(self):
+        session = self.session()
+        code = randomcode()
+        obj = session.query(self.model).load_only('group').get(code=code)
+        self.assertEqual(obj._loadedfields, ('group',))
+        self.assertFalse(hasattr(obj, 'code'))
+        self.assertTrue(obj.group)
+        obj = self.session().query(self.model).load_only('id').get(code=code)
+        self.assertEqual(obj._loadedfields, ())
+        self.assertFalse(hasattr(obj, 'group'))
+        record = self.session().query(self.model).records().get(code=code)
+        self.assertEqual(record.code, code)
@@ -1,4 +1,7 @@
-from stdnet import test, odm, getdb
+import gc
+import time
+
+from stdnet import test, odm, getdb, CommitException
 
 from stdnet.conf import settings
 from stdnet.utils import gen_unique_id
@@ -85,4 +88,204 @@ class TestSession(test.TestCase):
         # now filter on old group
         qs = session.query(self.model).filter(group = 'planet')
         self.assertEqual(qs.count(),0)
-    
\ No newline at end of file
+        
+    def testChangedData(self):
+        session = self.session()
+        with session.begin():
+            session.add(SimpleModel(code='pluto', group='planet',
+                                    description='a dwarf planet'))
+        el = session.query(SimpleModel).get(code='pluto')
+        self.assertTrue('original' in el._dbdata)
+        el.description = 'not a planet'
+        self.assertTrue(el.is_valid())
+        data, removed = self.backend.changed_data(el._meta,
+                                                  el._dbdata['cleaned_data'],
+                                                  el._dbdata['original'])
+        self.assertEqual(data, {'description': 'not a planet'})
+        self.assertEqual(removed, [])
+        el.group = None
+        self.assertTrue(el.is_valid())
+        data, removed = self.backend.changed_data(el._meta,
+                                                  el._dbdata['cleaned_data'],
+                                                  el._dbdata['original'])
+        self.assertEqual(removed, ['group'])
+        
+    def testRemoveIndexField(self):
+        session = self.session()
+        with session.begin():
+            session.add(SimpleModel(code='pluto', group='planet'))
+        el = session.query(SimpleModel).get(code='pluto')
+        el.group = None
+        with session.begin():
+            session.add(el)
+        qs = session.query(SimpleModel).filter(group='planet')
+        self.assertEqual(qs.count(), 0)
+        el = session.query(SimpleModel).get(code='pluto')
+        self.assertEqual(el.group, None)
+        # a second commit without changes leaves the instance untouched
+        with session.begin():
+            session.add(el)
+        el = session.query(SimpleModel).get(id=el.id)
+        self.assertEqual(el.code, 'pluto')
+        
+    def testChangeUniqueRollback(self):
+        session = self.session()
+        with session.begin():
+            session.add(SimpleModel(code='pluto', group='planet'))
+            session.add(SimpleModel(code='mars', group='planet'))
+        el = session.query(SimpleModel).get(code='pluto')
+        el.code = 'mars'
+        el.group = 'smallplanet'
+        self.assertRaises(CommitException, el.save)
+        session = self.session()
+        el = session.query(SimpleModel).get(code='pluto')
+        self.assertEqual(el.group, 'planet')
+        qs = session.query(SimpleModel).filter(group='planet')
+        self.assertEqual(qs.count(), 2)
+    
+
+
+class TestWriteBehindSession(test.TestCase):
+    model = SimpleModel
+    
+    def write_behind(self, **kwargs):
+        session = odm.WriteBehindSession(self.backend, **kwargs)
+        self.addCleanup(session.close)
+        return session
+    
+    def testAdd(self):
+        session = self.write_behind(chunk_size=3)
+        for code in ('a', 'b', 'c', 'd', 'e', 'f', 'g'):
+            session.add(SimpleModel(code=code, group='letter'))
+        session.flush()
+        self.assertEqual(session.pending, 0)
+        query = self.session().query(SimpleModel)
+        self.assertEqual(query.filter(group='letter').count(), 7)
+        
+    def testCoalesce(self):
+        session = self.write_behind()
+        m = session.add(SimpleModel(code='a', group='first'))
+        session.flush()
+        self.assertTrue(m.id)
+        with session.begin():
+            m.group = 'second'
+            session.add(m)
+        m.group = 'third'
+        session.add(m)
+        session.flush()
+        m = self.session().query(SimpleModel).get(id=m.id)
+        self.assertEqual(m.group, 'third')
+        
+    def testBackpressure(self):
+        session = self.write_behind(max_pending=2, chunk_size=2)
+        with session.begin():
+            for n in range(20):
+                session.add(SimpleModel(code='c%s' % n))
+        session.close()
+        self.assertEqual(session.pending, 0)
+        self.assertEqual(self.session().query(SimpleModel).count(), 20)
+        
+    def testDelete(self):
+        session = self.write_behind()
+        with session.begin():
+            m1 = session.add(SimpleModel(code='a'))
+            m2 = session.add(SimpleModel(code='b'))
+        session.flush()
+        session.delete(m1)
+        session.delete(session.query(SimpleModel).filter(code='b'))
+        session.flush()
+        self.assertEqual(self.session().query(SimpleModel).count(), 0)
+        
+    def testErrors(self):
+        session = self.write_behind()
+        session.add(SimpleModel(code='a'))
+        session.flush()
+        session.add(SimpleModel(code='a'))
+        self.assertRaises(CommitException, session.flush)
+        session.flush()
+        # errors are raised by the next commit, which is still queued
+        session.add(SimpleModel(code='a'))
+        while session.pending:
+            time.sleep(0.01)
+        self.assertRaises(CommitException, session.add,
+                          SimpleModel(code='b'))
+        session.flush()
+        query = self.session().query(SimpleModel)
+        self.assertEqual(query.filter(code='b').count(), 1)
+        
+    def testSnapshot(self):
+        session = self.write_behind()
+        with session.begin():
+            m = session.add(SimpleModel(code='a', group='first'))
+        # changes after the commit are not written by the queued commit
+        m.group = 'second'
+        session.flush()
+        self.assertTrue(m.id)
+        self.assertEqual(m.group, 'second')
+        query = self.session().query(SimpleModel)
+        self.assertEqual(query.get(id=m.id).group, 'first')
+        session.add(m)
+        session.flush()
+        self.assertEqual(query.filter(group='second').count(), 1)
+        self.assertEqual(query.count(), 1)
+        
+    def testArguments(self):
+        session = odm.WriteBehindSession(self.backend, None, 5, 2)
+        self.assertEqual(session.max_pending, 5)
+        self.assertEqual(session.chunk_size, 2)
+        session = session.session()
+        self.assertEqual(session.max_pending, 5)
+        self.assertFalse(session.weak)
+
+
+
+class TestIdentityMap(test.TestCase):
+    model = SimpleModel
+    
+    def setUp(self):
+        session = self.session()
+        with session.begin():
+            for n in range(10):
+                session.add(SimpleModel(code='c%s' % n, group='g'))
+                
+    def testWeak(self):
+        session = self.session(weak=True)
+        self.assertTrue(session.session().weak)
+        sm = session.model(SimpleModel._meta)
+        self.assertEqual(len(session.query(SimpleModel).all()), 10)
+        gc.collect()
+        self.assertEqual(len(sm), 0)
+        instances = session.query(SimpleModel).all()
+        self.assertEqual(len(sm), 10)
+        self.assertEqual(session.query(SimpleModel).get(id=instances[0].id),
+                         instances[0])
+        
+    def testWeakPinsModified(self):
+        session = self.session(weak=True)
+        session.begin()
+        m = session.query(SimpleModel).get(code='c1')
+        m.group = 'modified'
+        session.add(m)
+        m = None
+        gc.collect()
+        sm = session.model(SimpleModel._meta)
+        self.assertEqual(len(sm.modified), 1)
+        session.commit()
+        self.assertEqual(session.query(SimpleModel).filter(group='modified')\
+                         .count(), 1)
+        
+    def testMaxLoaded(self):
+        session = self.session(max_loaded=4)
+        sm = session.model(SimpleModel._meta)
+        instances = session.query(SimpleModel).all()
+        self.assertEqual(len(instances), 10)
+        self.assertEqual(len(sm), 4)
+        self.assertEqual(set(sm.loaded), set(instances[-4:]))
+        # new and modified instances are not evicted
+        session.begin()
+        for m in instances[:6]:
+            m.group = 'h'
+            session.add(m)
+        self.assertEqual(len(sm.modified), 6)
+        session.commit()
+        self.assertEqual(len(sm.loaded), 4)
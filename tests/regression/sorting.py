@@ -1,10 +1,12 @@
 from datetime import date, datetime
 
 from stdnet import test, QuerySetError, odm
+from stdnet.odm import indextools
 from stdnet.utils import populate, zip, range
 
 from examples.models import SportAtDate, SportAtDate2, Person,\
-                             TestDateModel, Group
+                             TestDateModel, Group, SortedDateModel,\
+                             SortedPerson, SortedGroup
 
 NUM_DATES = 200
 
@@ -95,12 +97,13 @@ class TestSortByForeignKeyField(TestSort):
         
     def fill(self):
         session = self.session()
+        group = self.models[1]
         with session.begin():
             for g in groups:
-                session.add(Group(name = g))
+                session.add(group(name = g))
                 
         model = self.model
-        gps = populate('choice', NUM_DATES, choice_from = session.query(Group))
+        gps = populate('choice', NUM_DATES, choice_from = session.query(group))
         with session.begin():
             for p,g in zip(persons,gps):
                 session.add(model(name = p, group = g))
@@ -162,4 +165,108 @@ class TestOrderingModel(TestSort):
 class TestOrderingModelDesc(TestOrderingModel):
     model = SportAtDate2
     desc = True
-
+    
+    
+class TestSortIndex(TestSort, ExplicitOrderingMixin):
+    '''Sorting on fields with a sort index.'''
+    model = SortedDateModel
+    
+    def testMeta(self):
+        meta = self.model._meta
+        self.assertEqual(set((f.name for f in meta.sort_indices)),
+                         set(('name', 'dt')))
+        
+    def testSlices(self):
+        qs = self.fill().sort_by('name')
+        names = [o.name for o in qs]
+        self.assertEqual(len(names), NUM_DATES)
+        self.assertEqual([o.name for o in qs[10:30]], names[10:30])
+        self.assertEqual([o.name for o in qs[-5:]], names[-5:])
+        ids = [o.id for o in qs[:50]] + [o.id for o in qs[50:]]
+        self.assertEqual(len(set(ids)), NUM_DATES)
+        qs = qs.sort_by('-name')
+        self.assertEqual([o.name for o in qs[:20]], list(reversed(names))[:20])
+        
+    def testUpdate(self):
+        qs = self.fill()
+        N = qs.filter(name='rugby').update(name='aaa')
+        qs = self.session().query(self.model).sort_by('name')
+        self.assertEqual([o.name for o in qs[:N]], ['aaa']*N)
+        self.checkOrder(qs, 'name')
+        
+    def testDelete(self):
+        qs = self.fill()
+        qs.filter(name='cycling').delete()
+        qs = self.session().query(self.model).sort_by('-name')
+        N = qs.count()
+        self.assertEqual(len(qs[:N]), N)
+        self.checkOrder(qs, 'name', True)
+        
+    def testIndexNotBuilt(self):
+        # the sort index is added to a model with instances
+        session = self.session()
+        backend = session.backend
+        meta = self.model._meta
+        self.fill()
+        self.assertTrue(backend.index_complete(meta, meta.dfields['name']))
+        backend.client.delete(backend.basekey(meta, 'srt', 'name'),
+                              backend.basekey(meta, 'built'))
+        backend._complete_indices.clear()
+        self.assertFalse(backend.index_complete(meta, meta.dfields['name']))
+        qs = session.query(self.model).sort_by('name')
+        self.assertEqual(len(qs[:NUM_DATES]), NUM_DATES)
+        self.checkOrder(qs, 'name')
+        indextools.rebuild_indices(session, self.model, fields=('name',))
+        self.assertTrue(backend.index_complete(meta, meta.dfields['name']))
+        qs = session.query(self.model).sort_by('name')
+        self.assertEqual(len(qs[:NUM_DATES]), NUM_DATES)
+        self.checkOrder(qs, 'name')
+        
+        
+class TestSortIndexForeignKey(TestSortByForeignKeyField):
+    model = SortedPerson
+    models = (SortedPerson, SortedGroup)
+    
+    def testSortByFKSlice(self):
+        qs = self.fill().sort_by('group__name')
+        names = [p.group.name for p in qs]
+        self.assertEqual([p.group.name for p in qs[5:15]], names[5:15])
+        self.checkOrder(qs.sort_by('-group__name')[:20], 'group__name', True)
+        
+        
+class TestMultiSortBy(TestSort):
+    model = TestDateModel
+    models = (TestDateModel, Person, Group)
+    
+    def testSortBy(self):
+        qs = self.fill().sort_by('name', '-dt', 'id')
+        self.assertEqual(len(qs.ordering), 3)
+        data = [(o.name, o.dt, o.id) for o in qs]
+        self.assertEqual(len(data), NUM_DATES)
+        for d0, d1 in zip(data, data[1:]):
+            self.assertTrue(d0[0] <= d1[0])
+            if d0[0] == d1[0]:
+                self.assertTrue(d0[1] >= d1[1])
+                if d0[1] == d1[1]:
+                    self.assertTrue(d0[2] < d1[2])
+        ids = [d[2] for d in data]
+        self.assertEqual([o.id for o in qs[10:30]], ids[10:30])
+        self.assertEqual([o.id for o in qs[-5:]], ids[-5:])
+        
+    def testSingleField(self):
+        qs = self.fill().sort_by('dt', None)
+        self.assertEqual(qs.ordering.name, 'dt')
+        self.checkOrder(qs, 'dt')
+        
+    def testForeignKey(self):
+        session = self.session()
+        with session.begin():
+            for g in ('rugby', 'football'):
+                group = session.add(Group(name=g))
+                for p in ('luca', 'carl', 'paul'):
+                    session.add(Person(name=p, group=group))
+        qs = session.query(Person).sort_by('group__name', '-name')
+        self.assertEqual([(p.group.name, p.name) for p in qs],
+                         [('football', 'paul'), ('football', 'luca'),
+                          ('football', 'carl'), ('rugby', 'paul'),
+                          ('rugby', 'luca'), ('rugby', 'carl')])
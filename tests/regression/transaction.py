@@ -1,6 +1,6 @@
 import random
 
-from stdnet import odm, test, InvalidTransaction
+from stdnet import odm, test, InvalidTransaction, CommitException
 from examples.models import SimpleModel, Dictionary
 from stdnet.utils import populate
 
@@ -93,6 +93,62 @@ class TestTransactions(test.TestCase):
         self.assertEqual(len(session.query(self.model).all()),1)
         
         
+class TestBulkCreate(test.TestCase):
+    model = SimpleModel
+    models = (SimpleModel, Dictionary)
+    
+    def setUp(self):
+        self.register()
+        
+    def testBulkCreate(self):
+        objects = self.model.objects
+        instances = [self.model(code=name, description='bulk')\
+                     for name in set(names)]
+        ids = objects.bulk_create(instances, batch_size=7)
+        self.assertEqual(len(ids), len(instances))
+        self.assertEqual(ids, [m.id for m in instances])
+        for m in instances:
+            self.assertTrue(m.state().persistent)
+            self.assertEqual(m.session, None)
+        query = objects.query()
+        self.assertEqual(query.count(), len(instances))
+        m = query.get(code=instances[0].code)
+        self.assertEqual(m.id, instances[0].id)
+        
+    def testNoIds(self):
+        objects = self.model.objects
+        data = ((self.model(code=name) for name in set(names)))
+        n = objects.bulk_create(data, batch_size=10, return_ids=False)
+        self.assertEqual(n, len(set(names)))
+        self.assertEqual(objects.query().count(), n)
+        
+    def testUniqueErrors(self):
+        objects = self.model.objects
+        instances = [self.model(code='foo'), self.model(code='bla'),
+                     self.model(code='foo')]
+        self.assertRaises(CommitException, objects.bulk_create, instances)
+        self.assertEqual(objects.query().count(), 2)
+        
+    def testSignals(self):
+        receiver = TransactionReceiver()
+        odm.post_commit.connect(receiver, self.model)
+        objects = self.model.objects
+        instances = [self.model(code=name) for name in set(names)]
+        objects.bulk_create(instances, batch_size=30)
+        self.assertEqual(len(receiver.transactions), 0)
+        instances = [self.model(code=name+'_') for name in set(names)]
+        objects.bulk_create(instances, batch_size=30, signal=True)
+        self.assertEqual(sum((len(t[1]) for t in receiver.transactions)),
+                         len(instances))
+        for sender, instances, transaction, session in receiver.transactions:
+            self.assertTrue(isinstance(transaction, odm.Transaction))
+            self.assertTrue(isinstance(session, odm.Session))
+        
+    def testStructureFields(self):
+        self.assertRaises(ValueError, Dictionary.objects.bulk_create,
+                          [Dictionary(name='a')])
+        
+        
 class TestMultiFieldTransaction(test.TestCase):
     model = Dictionary
     
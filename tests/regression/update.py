@@ -0,0 +1,185 @@
+'''Update queries on the server'''
+from datetime import date, datetime
+
+from stdnet import odm, test, CommitException, FieldError
+
+from examples.models import Instrument, Instrument2, SimpleModel, Page, Node,\
+                            SportAtDate
+from examples.data import FinanceTest
+
+
+class UpdateReceiver(object):
+
+    def __init__(self):
+        self.updates = []
+
+    def __call__(self, sender, ids=None, fields=None, **kwargs):
+        self.updates.append((sender, ids, fields))
+
+
+class TestUpdateQuery(FinanceTest):
+    model = Instrument
+
+    def setUp(self):
+        self.data.create(self)
+
+    def testUpdateIndex(self):
+        session = self.session()
+        query = session.query(self.model)
+        qs = query.filter(ccy='EUR')
+        N = qs.count()
+        self.assertTrue(N)
+        ids = set(qs.get_field('id').all())
+        receiver = UpdateReceiver()
+        odm.post_update.connect(receiver, self.model)
+        self.assertEqual(qs.update(ccy='CHF', description='updated'), N)
+        self.assertEqual(len(receiver.updates), 1)
+        sender, uids, fields = receiver.updates[0]
+        self.assertEqual(sender, self.model)
+        self.assertEqual(set(uids), ids)
+        self.assertEqual(query.filter(ccy='EUR').count(), 0)
+        qs = query.filter(ccy='CHF')
+        self.assertTrue(ids.issubset(set(qs.get_field('id').all())))
+        for inst in query.filter(id__in=ids):
+            self.assertEqual(inst.ccy, 'CHF')
+            self.assertEqual(inst.description, 'updated')
+
+    def testEmpty(self):
+        session = self.session()
+        qs = session.query(self.model).filter(ccy='XXX')
+        self.assertEqual(qs.update(ccy='EUR'), 0)
+
+    def testBadField(self):
+        session = self.session()
+        qs = session.query(self.model)
+        self.assertRaises(FieldError, qs.update, id=5)
+        self.assertRaises(FieldError, qs.update, foo='bla')
+
+    def testUnique(self):
+        session = self.session()
+        qs = session.query(self.model).filter(ccy='EUR')
+        N = qs.count()
+        self.assertTrue(N > 1)
+        self.assertRaises(CommitException, qs.update, name='foo')
+        # only one instance was updated
+        query = session.query(self.model)
+        self.assertEqual(query.filter(name='foo').count(), 1)
+        self.assertEqual(query.filter(ccy='EUR').count(), N)
+
+
+class TestUpdateOrdered(test.TestCase):
+    model = Instrument2
+
+    def setUp(self):
+        session = self.session()
+        with session.begin():
+            for n in range(10):
+                session.add(self.model(name='inst%s' % n, ccy='EUR',
+                                       type='bond' if n % 2 else 'future'))
+
+    def testUpdate(self):
+        session = self.session()
+        query = session.query(self.model)
+        qs = query.filter(type='bond')
+        self.assertEqual(qs.update(type='future', ccy='USD'), 5)
+        qs = query.filter(type='future')
+        self.assertEqual(qs.count(), 10)
+        # ordering is preserved
+        ids = [i.id for i in qs]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(query.filter(ccy='USD').count(), 5)
+
+
+class TestUpdateSession(test.TestCase):
+    model = SimpleModel
+
+    def testLoadedInstance(self):
+        session = self.session()
+        with session.begin():
+            session.add(self.model(code='pluto', group='planet'))
+        query = session.query(self.model)
+        el = query.get(code='pluto')
+        self.assertEqual(query.update(group='dwarf'), 1)
+        self.assertEqual(el.group, 'dwarf')
+        # the instance in the session is committed with all its data
+        el.group = 'planet'
+        el.save()
+        el = self.session().query(self.model).get(code='pluto')
+        self.assertEqual(el.group, 'planet')
+
+
+class TestUpdateOrderingField(test.TestCase):
+    model = SportAtDate
+
+    def setUp(self):
+        session = self.session()
+        with session.begin():
+            for n in range(1, 4):
+                session.add(self.model(person='p%s' % n, name='run',
+                                       dt=date(2012, 1, n)))
+
+    def testScoreOfConvertedValue(self):
+        # the value is converted to a date before the score is computed
+        session = self.session()
+        query = session.query(self.model)
+        qs = query.filter(person='p1')
+        self.assertEqual(qs.update(dt=datetime(2012, 1, 5, 12)), 1)
+        self.assertEqual([m.person for m in query.all()], ['p2', 'p3', 'p1'])
+        m = query.get(person='p1')
+        self.assertEqual(m.dt, date(2012, 1, 5))
+        backend = session.backend
+        score = backend.client.zscore(backend.basekey(self.model._meta, 'id'),
+                                      m.id)
+        field = self.model._meta.dfields['dt']
+        self.assertEqual(float(score), field.scorefun(date(2012, 1, 5)))
+
+
+class TestIncr(test.TestCase):
+    models = (Page, Node)
+
+    def setUp(self):
+        session = self.session()
+        with session.begin():
+            for n in range(6):
+                session.add(Page(in_navigation=n % 2))
+                session.add(Node(weight=n))
+
+    def testQueryIncr(self):
+        session = self.session()
+        query = session.query(Page)
+        qs = query.filter(in_navigation=1)
+        ids = set(qs.get_field('id').all())
+        values = qs.incr('in_navigation', 2)
+        self.assertEqual(len(values), 3)
+        self.assertEqual(set((id for id, v in values)), ids)
+        self.assertEqual(set((v for id, v in values)), set([3]))
+        self.assertEqual(query.filter(in_navigation=1).count(), 0)
+        self.assertEqual(set(query.filter(in_navigation=3).get_field('id')\
+                             .all()), ids)
+        self.assertEqual(query.filter(in_navigation=0).count(), 3)
+
+    def testInstanceIncr(self):
+        session = self.session()
+        page = session.query(Page).get(id=1)
+        self.assertEqual(page.in_navigation, 0)
+        self.assertEqual(page.incr('in_navigation'), 1)
+        self.assertEqual(page.in_navigation, 1)
+        self.assertEqual(page.incr('in_navigation', -5), -4)
+        page = self.session().query(Page).get(in_navigation=-4)
+        self.assertEqual(page.id, 1)
+
+    def testFloat(self):
+        session = self.session()
+        node = session.query(Node).get(id=2)
+        self.assertEqual(node.weight, 1.0)
+        self.assertEqual(node.incr('weight', 0.5), 1.5)
+        self.assertEqual(node.incr('weight', 0.5), 2.0)
+        values = session.query(Node).filter(id=2).incr('weight', 1)
+        self.assertEqual(values, [(2, 3.0)])
+
+    def testNotCounter(self):
+        session = self.session()
+        page = session.query(Page).get(id=1)
+        self.assertRaises(FieldError, page.incr, 'id')
+        self.assertRaises(FieldError, session.query(Page).incr, 'foo')
+        self.assertRaises(Page.DoesNotExist, Page().incr, 'in_navigation')